@@ -1,30 +1,167 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
 import logging
+import multiprocessing
+from abc import ABC, abstractmethod
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr, ConfigDict
-from typing import List, Optional
+from pydantic import BaseModel, EmailStr, ConfigDict
+from typing import List, Literal, Optional
 import uuid
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, timezone, timedelta
 import jwt
 from passlib.context import CryptContext
 import csv
+import codecs
 import io
+import json
+import base64
 import zipfile
-import httpx
+from decimal import Decimal, ROUND_HALF_UP
+from xml.etree import ElementTree
 import re
+import hashlib
+import shutil
+import mimetypes
+from email.utils import formatdate
+import copy
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ============== METRICS ==============
+
+# Off by default; when off no collectors exist and the hot paths only test
+# `if metrics`. Set up before the MongoDB client, which takes the command
+# listener at construction.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'false').lower() == 'true'
+
+class Metrics:
+    """Prometheus collectors for the instrumented hot paths"""
+    
+    def __init__(self):
+        # Optional dependency, only needed with METRICS_ENABLED
+        import prometheus_client
+        self.prometheus_client = prometheus_client
+        self.registry = prometheus_client.CollectorRegistry()
+        self.http_request_duration = prometheus_client.Histogram(
+            "finzen_http_request_duration_seconds", "HTTP request latency by route",
+            ["method", "route", "status"], registry=self.registry
+        )
+        self.imap_command_duration = prometheus_client.Histogram(
+            "finzen_imap_command_duration_seconds", "IMAP command round-trip time",
+            ["command"], registry=self.registry
+        )
+        self.mail_search_strategy_duration = prometheus_client.Histogram(
+            "finzen_mail_search_strategy_duration_seconds", "Time spent in each search_emails strategy",
+            ["strategy"], registry=self.registry
+        )
+        self.mongo_operation_duration = prometheus_client.Histogram(
+            "finzen_mongo_operation_duration_seconds", "MongoDB command duration",
+            ["collection", "operation"], registry=self.registry,
+            buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+        )
+        self.statement_rows_ingested = prometheus_client.Counter(
+            "finzen_statement_rows_ingested", "Statement rows read by uploads; rate() gives rows per second",
+            ["format"], registry=self.registry
+        )
+        self.zip_export_bytes = prometheus_client.Counter(
+            "finzen_zip_export_bytes", "Bytes written by ZIP exports", registry=self.registry
+        )
+    
+    def instrument_imap(self, connection):
+        """Time every command an imaplib connection sends (UID commands as "UID FETCH" etc.)"""
+        simple_command = connection._simple_command
+        histogram = self.imap_command_duration
+        
+        def timed_simple_command(name, *args):
+            command = f"UID {args[0].upper()}" if name == "UID" and args else name
+            started = time.perf_counter()
+            try:
+                return simple_command(name, *args)
+            finally:
+                histogram.labels(command).observe(time.perf_counter() - started)
+        
+        connection._simple_command = timed_simple_command
+    
+    def exposition(self) -> tuple:
+        """(body, content type) of the text exposition format"""
+        return self.prometheus_client.generate_latest(self.registry), self.prometheus_client.CONTENT_TYPE_LATEST
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Feeds MongoDB command durations, per collection, into a histogram"""
+    
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.collections = {}  # request_id -> collection of commands in flight
+    
+    def started(self, event):
+        target = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+        if isinstance(target, str):
+            self.collections[event.request_id] = target
+    
+    def succeeded(self, event):
+        self._observe(event)
+    
+    def failed(self, event):
+        self._observe(event)
+    
+    def _observe(self, event):
+        collection = self.collections.pop(event.request_id, None)
+        if collection is not None:
+            self.histogram.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+class RequestMetricsMiddleware:
+    """ASGI middleware timing each request, including streamed bodies.
+    
+    Requests are labelled with the route template, so path parameters
+    don't multiply the series; anything unrouted is "unmatched".
+    """
+    
+    def __init__(self, app, routes: list):
+        self.app = app
+        self.route_paths = {route.endpoint: route.path for route in routes if hasattr(route, "endpoint")}
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status_code = 500
+        
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+        
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = self.route_paths.get(scope.get("endpoint"), "unmatched")
+            metrics.http_request_duration.labels(scope["method"], route, str(status_code)).observe(
+                time.perf_counter() - started
+            )
+
+metrics = Metrics() if METRICS_ENABLED else None
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    event_listeners=[MongoCommandTimer(metrics.mongo_operation_duration)] if metrics else []
+)
 db = client[os.environ['DB_NAME']]
 
 # JWT Configuration
@@ -35,11 +172,14 @@ if not JWT_SECRET:
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_HOURS = 24
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing; hashes made with another cost are upgraded on the next login
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 # Security
 security = HTTPBearer()
+# Accounts allowed to see the operational endpoints (query plans, pool and cache stats)
+ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()}
 
 app = FastAPI(title="FinZen API", version="1.0.0")
 # Define router without prefix so we can mount it at both '/api' and root
@@ -110,11 +250,20 @@ class TransactionResponse(BaseModel):
     vendor_id: Optional[str] = None
     created_at: datetime
 
+# The counters keep one status.<value> key per status, so nothing else may be stored
+TransactionStatus = Literal["pending", "found", "downloaded", "manual"]
+
 class TransactionUpdate(BaseModel):
-    status: Optional[str] = None
+    status: Optional[TransactionStatus] = None
     invoice_filename: Optional[str] = None
     invoice_url: Optional[str] = None
 
+class TransactionPatch(TransactionUpdate):
+    id: str
+
+class TransactionBulkUpdate(BaseModel):
+    updates: List[TransactionPatch]
+
 class BatchResponse(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str
@@ -124,6 +273,7 @@ class BatchResponse(BaseModel):
     year: str
     transaction_count: int
     downloaded_count: int
+    status: str = "completed"
     created_at: datetime
 
 # ============== HELPERS ==============
@@ -131,8 +281,62 @@ class BatchResponse(BaseModel):
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple:
+    """(valid, new_hash); new_hash is set when the stored hash uses outdated settings"""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(os.cpu_count() or 1, 4))))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', '32'))  # waiting jobs before 429
+
+class PasswordHasher:
+    """Runs bcrypt in a process pool so logins don't stall the event loop.
+    
+    At most PASSWORD_HASH_WORKERS jobs run and PASSWORD_HASH_QUEUE wait;
+    beyond that requests are refused with 429 instead of queueing
+    without bound during a login rush.
+    """
+    
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, queue_size: int = PASSWORD_HASH_QUEUE):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.pending = 0
+        self.rejected = 0
+        self._executor = None
+    
+    async def run(self, fn, *args):
+        if self.pending >= self.capacity:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Previše zahtjeva za prijavu, pokušajte ponovno",
+                headers={"Retry-After": "1"}
+            )
+        if self._executor is None:
+            # Created on first use so importing the module doesn't spawn
+            # processes. Workers must not be forked from the running server,
+            # which holds event loop, thread pool and MongoDB client state
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(start_method)
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+    
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_password, password)
+    
+    async def verify_and_update(self, plain_password: str, hashed_password: str) -> tuple:
+        return await self.run(verify_and_update_password, plain_password, hashed_password)
+    
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+password_hasher = PasswordHasher()
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
@@ -146,7 +350,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         user_id = payload.get("sub")
         if not user_id:
             raise HTTPException(status_code=401, detail="Nevažeći token")
-        user = await db.users.find_one({"id": user_id}, {"_id": 0})
+        user = await user_cache.load(user_id)
         if not user:
             raise HTTPException(status_code=401, detail="Korisnik nije pronađen")
         return user
@@ -155,23 +359,280 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Nevažeći token")
 
+async def get_admin_user(user: dict = Depends(get_current_user)):
+    """The current user, if listed in ADMIN_EMAILS"""
+    if user.get("email", "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=403, detail="Pristup dozvoljen samo administratorima")
+    return user
+
 def normalize_vendor_name(name: str) -> str:
     """Normalize vendor name for matching"""
     return re.sub(r'[^a-z0-9]', '', name.lower())
 
-def match_vendor(transaction_recipient: str, transaction_desc: str, vendors: list) -> Optional[dict]:
-    """Try to match a transaction to a vendor"""
-    search_text = f"{transaction_recipient} {transaction_desc}".lower()
-    
-    for vendor in vendors:
-        # Check vendor name
-        if normalize_vendor_name(vendor['name']) in normalize_vendor_name(search_text):
-            return vendor
-        # Check keywords
-        for keyword in vendor.get('keywords', []):
-            if keyword.lower() in search_text:
-                return vendor
-    return None
+class TTLCache:
+    """Size-bounded LRU cache whose entries also expire after `ttl` seconds.
+    
+    Thread-safe, so it can be shared between the event loop and the mail
+    executor threads.
+    """
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+    
+    def set(self, key, value, ttl: float = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def delete_where(self, predicate) -> int:
+        """Drop every entry whose key matches the predicate"""
+        with self._lock:
+            keys = [k for k in self._data if predicate(k)]
+            for k in keys:
+                del self._data[k]
+        return len(keys)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._data)
+        lookups = self.hits + self.misses
+        return {
+            "size": size,
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+        }
+
+class _PatternAutomaton:
+    """Aho-Corasick automaton mapping patterns to the lowest vendor index"""
+    
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.best = [None]  # lowest vendor index ending at this state, via fail links too
+    
+    def add(self, pattern: str, index: int):
+        state = 0
+        for ch in pattern:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.best.append(None)
+            state = nxt
+        if self.best[state] is None or index < self.best[state]:
+            self.best[state] = index
+    
+    def build(self):
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, nxt in self.goto[state].items():
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                inherited = self.best[self.fail[nxt]]
+                if inherited is not None and (self.best[nxt] is None or inherited < self.best[nxt]):
+                    self.best[nxt] = inherited
+                queue.append(nxt)
+    
+    def search(self, text: str, best: Optional[int] = None) -> Optional[int]:
+        """Lowest vendor index of any pattern occurring in text, in one pass"""
+        goto, fail, found = self.goto, self.fail, self.best
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            hit = found[state]
+            if hit is not None and (best is None or hit < best):
+                best = hit
+                if best == 0:
+                    break
+        return best
+
+class VendorMatcher:
+    """Matches transactions to vendors from a fixed vendor list.
+    
+    Vendor names are matched on the alphanumeric-only text and keywords on
+    the lowercased text; when several vendors match, the one listed first
+    wins.
+    """
+    
+    def __init__(self, vendors: list):
+        self.vendors = vendors
+        self.names = _PatternAutomaton()
+        self.keywords = _PatternAutomaton()
+        self.always = None  # first vendor with an empty pattern matches every row
+        for index, vendor in enumerate(vendors):
+            patterns = [(self.names, normalize_vendor_name(vendor['name']))]
+            patterns += [(self.keywords, keyword.lower()) for keyword in vendor.get('keywords', [])]
+            for automaton, pattern in patterns:
+                if pattern:
+                    automaton.add(pattern, index)
+                elif self.always is None:
+                    self.always = index
+        self.names.build()
+        self.keywords.build()
+    
+    @staticmethod
+    def fingerprint(vendors: list) -> tuple:
+        return tuple((v['id'], v['name'], tuple(v.get('keywords', []))) for v in vendors)
+    
+    def match(self, transaction_recipient: str, transaction_desc: str) -> Optional[dict]:
+        search_text = f"{transaction_recipient} {transaction_desc}".lower()
+        best = self.keywords.search(search_text, self.always)
+        if best != 0:
+            best = self.names.search(normalize_vendor_name(search_text), best)
+        return self.vendors[best] if best is not None else None
+
+VENDOR_MATCHER_CACHE_SIZE = int(os.environ.get('VENDOR_MATCHER_CACHE_SIZE', '256'))
+vendor_matchers = TTLCache(VENDOR_MATCHER_CACHE_SIZE, 24 * 3600)
+
+def get_vendor_matcher(user_id: str, vendors: list) -> VendorMatcher:
+    """Compiled matcher for a user's vendors, rebuilt only when they change"""
+    fingerprint = VendorMatcher.fingerprint(vendors)
+    cached = vendor_matchers.get(user_id)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+    matcher = VendorMatcher(vendors)
+    vendor_matchers.set(user_id, (fingerprint, matcher))
+    return matcher
+
+# ============== USER CACHE ==============
+
+USER_CACHE_ENABLED = os.environ.get('USER_CACHE_ENABLED', 'true').lower() == 'true'
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', '10000'))  # entries
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', '60'))  # seconds, upper bound on staleness
+USER_CACHE_SYNC_INTERVAL = int(os.environ.get('USER_CACHE_SYNC_INTERVAL', '2'))  # seconds between version stamp polls
+
+class UserCache:
+    """User documents for get_current_user, keyed by the JWT subject.
+    
+    Profile writes go through update_user_profile, which bumps the user's
+    version stamp (profile_updated_at) and drops the local entry. Other
+    workers learn about the write from a change stream on the users
+    collection, or, where change streams are unavailable (standalone
+    MongoDB), by polling for stamps newer than their last poll.
+    """
+    
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: int = USER_CACHE_TTL):
+        self.memory = TTLCache(maxsize, ttl)
+        # Bumped by every invalidation; a load that overlapped one must not be cached
+        self.epoch = 0
+        self.invalidations = 0
+        self.sync_mode = None
+    
+    async def load(self, user_id: str) -> Optional[dict]:
+        if not USER_CACHE_ENABLED:
+            return await db.users.find_one({"id": user_id}, {"_id": 0})
+        user = self.memory.get(user_id)
+        if user is None:
+            epoch = self.epoch
+            user = await db.users.find_one({"id": user_id}, {"_id": 0})
+            if user is None:
+                return None
+            if epoch == self.epoch:
+                self.memory.set(user_id, user)
+        # Endpoints build on the user dict, hand out a private copy
+        return dict(user)
+    
+    def invalidate(self, user_id: str = None):
+        """Drop one user, or everyone when user_id is None"""
+        self.epoch += 1
+        self.invalidations += 1
+        if user_id is None:
+            self.memory.delete_where(lambda key: True)
+        else:
+            self.memory.delete(user_id)
+    
+    async def _watch_changes(self):
+        pipeline = [{"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}}]
+        async with db.users.watch(pipeline, full_document="updateLookup") as stream:
+            self.sync_mode = "change_stream"
+            async for change in stream:
+                document = change.get("fullDocument")
+                # Deletes only carry the _id, forget everyone rather than keep a reverse map
+                self.invalidate(document.get("id") if document else None)
+    
+    async def _poll_versions(self):
+        self.sync_mode = "poll"
+        since = datetime.now(timezone.utc)
+        while True:
+            await asyncio.sleep(USER_CACHE_SYNC_INTERVAL)
+            polled_at = datetime.now(timezone.utc)
+            # Overlap the previous window so clock skew between workers can't hide a write
+            stamp = (since - timedelta(seconds=USER_CACHE_SYNC_INTERVAL)).isoformat()
+            async for doc in db.users.find({"profile_updated_at": {"$gt": stamp}}, {"_id": 0, "id": 1}):
+                self.invalidate(doc["id"])
+            since = polled_at
+    
+    async def sync_worker(self):
+        """Apply profile writes made by other workers to this worker's cache"""
+        while True:
+            try:
+                await self._watch_changes()
+            except Exception as e:
+                if self.sync_mode != "change_stream":
+                    # Standalone servers refuse to open a change stream
+                    logger.info(f"User cache: change streams unavailable ({e}), polling version stamps")
+                    break
+                logger.warning(f"User cache change stream interrupted: {e}")
+                self.invalidate()
+                await asyncio.sleep(USER_CACHE_SYNC_INTERVAL)
+        while True:
+            try:
+                await self._poll_versions()
+            except Exception as e:
+                logger.warning(f"User cache version poll failed: {e}")
+                self.invalidate()
+                await asyncio.sleep(USER_CACHE_SYNC_INTERVAL)
+    
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        stats["enabled"] = USER_CACHE_ENABLED
+        stats["invalidations"] = self.invalidations
+        stats["sync_mode"] = self.sync_mode
+        return stats
+
+user_cache = UserCache()
+
+async def update_user_profile(user_id: str, fields: dict):
+    """$set profile fields, bumping the version stamp other workers watch"""
+    await db.users.update_one(
+        {"id": user_id},
+        {"$set": {**fields, "profile_updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    user_cache.invalidate(user_id)
 
 # ============== AUTH ROUTES ==============
 
@@ -185,13 +646,17 @@ async def register(data: UserCreate):
     user_doc = {
         "id": user_id,
         "email": data.email,
-        "password_hash": hash_password(data.password),
+        "password_hash": await password_hasher.hash(data.password),
         "name": data.name,
         "zoho_email": None,
         "zoho_app_password": None,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration (unique email index)
+        raise HTTPException(status_code=400, detail="Email već postoji")
     
     token = create_access_token({"sub": user_id, "email": data.email})
     return TokenResponse(
@@ -207,8 +672,13 @@ async def register(data: UserCreate):
 @api_router.post("/auth/login", response_model=TokenResponse)
 async def login(data: UserLogin):
     user = await db.users.find_one({"email": data.email}, {"_id": 0})
-    if not user or not verify_password(data.password, user["password_hash"]):
+    if not user:
+        raise HTTPException(status_code=401, detail="Pogrešan email ili lozinka")
+    valid, new_hash = await password_hasher.verify_and_update(data.password, user["password_hash"])
+    if not valid:
         raise HTTPException(status_code=401, detail="Pogrešan email ili lozinka")
+    if new_hash:
+        await update_user_profile(user["id"], {"password_hash": new_hash})
     
     token = create_access_token({"sub": user["id"], "email": user["email"]})
     return TokenResponse(
@@ -221,6 +691,11 @@ async def login(data: UserLogin):
         )
     )
 
+@api_router.get("/auth/cache-stats")
+async def get_user_cache_stats(user: dict = Depends(get_admin_user)):
+    """Hit rate of the authenticated user cache"""
+    return user_cache.stats()
+
 @api_router.get("/auth/me", response_model=UserResponse)
 async def get_me(user: dict = Depends(get_current_user)):
     return UserResponse(
@@ -234,13 +709,18 @@ async def get_me(user: dict = Depends(get_current_user)):
 
 @api_router.post("/settings/zoho")
 async def save_zoho_config(config: ZohoConfig, user: dict = Depends(get_current_user)):
-    await db.users.update_one(
-        {"id": user["id"]},
-        {"$set": {
+    await update_user_profile(user["id"], {
+        "zoho_email": config.zoho_email,
+        "zoho_app_password": config.zoho_app_password
+    })
+    await asyncio.get_running_loop().run_in_executor(mail_executor, mail_pool.close_user, user["id"])
+    await mail_cache.invalidate_user(user["id"])
+    if MAIL_INDEX_ENABLED:
+        schedule_mail_index_sync({
+            **user,
             "zoho_email": config.zoho_email,
             "zoho_app_password": config.zoho_app_password
-        }}
-    )
+        })
     return {"message": "Zoho konfiguracija spremljena"}
 
 @api_router.get("/settings/zoho")
@@ -252,13 +732,10 @@ async def get_zoho_config(user: dict = Depends(get_current_user)):
 
 @api_router.post("/settings/search")
 async def save_search_settings(settings: SearchSettings, user: dict = Depends(get_current_user)):
-    await db.users.update_one(
-        {"id": user["id"]},
-        {"$set": {
-            "date_range_days": settings.date_range_days,
-            "search_all_fields": settings.search_all_fields
-        }}
-    )
+    await update_user_profile(user["id"], {
+        "date_range_days": settings.date_range_days,
+        "search_all_fields": settings.search_all_fields
+    })
     return {"message": "Postavke pretrage spremljene"}
 
 @api_router.get("/settings/search")
@@ -320,325 +797,1301 @@ async def delete_vendor(vendor_id: str, user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=404, detail="Dobavljač nije pronađen")
     return {"message": "Dobavljač obrisan"}
 
-# ============== CSV UPLOAD & TRANSACTIONS ==============
+# ============== STATEMENT PARSERS ==============
 
-@api_router.post("/upload/csv")
-async def upload_csv(
-    file: UploadFile = File(...),
-    month: str = "12",
-    year: str = "2025",
-    user: dict = Depends(get_current_user)
-):
-    if not file.filename.endswith('.csv'):
-        raise HTTPException(status_code=400, detail="Samo CSV datoteke su dozvoljene")
-    
-    content = await file.read()
-    
-    # Try different encodings
-    for encoding in ['utf-8', 'cp1250', 'iso-8859-2', 'latin-1']:
+CSV_ENCODINGS = ['utf-8', 'cp1250', 'iso-8859-2', 'latin-1']
+CSV_ENCODING_PROBE_BYTES = int(os.environ.get('CSV_ENCODING_PROBE_BYTES', '65536'))
+STATEMENT_FIELDS = ("datum", "primatelj", "opis", "iznos")
+
+def detect_csv_encoding(prefix: bytes) -> int:
+    """Index into CSV_ENCODINGS of the first encoding that decodes the prefix"""
+    for i, encoding in enumerate(CSV_ENCODINGS):
         try:
-            text_content = content.decode(encoding)
-            break
+            # final=False: the prefix may end in the middle of a multi-byte character
+            codecs.getincrementaldecoder(encoding)().decode(prefix, final=False)
+            return i
         except UnicodeDecodeError:
             continue
-    else:
-        raise HTTPException(status_code=400, detail="Nije moguće pročitati CSV datoteku")
-    
-    # Parse CSV
-    reader = csv.DictReader(io.StringIO(text_content))
+    return len(CSV_ENCODINGS) - 1
+
+class ColumnMapping:
+    """Statement fields resolved to column positions for one header.
     
-    batch_id = str(uuid.uuid4())
-    transactions = []
+    Each field keeps the positions of its candidate columns in priority
+    order; a row value is the first non-empty candidate, which matches the
+    old `row.get(a) or row.get(b) or ...` chains.
+    """
     
-    # Get user's vendors for matching
-    vendors = await db.vendors.find({"user_id": user["id"]}, {"_id": 0}).to_list(1000)
+    def __init__(self, header: list, columns: dict):
+        # Like csv.DictReader, the last of several equally named columns wins
+        positions = {name: i for i, name in enumerate(header)}
+        self.width = len(header)
+        self.indices = tuple(
+            tuple(positions[name] for name in columns.get(field, ()) if name in positions)
+            for field in STATEMENT_FIELDS
+        )
     
-    # Log available columns for debugging
-    logger.info(f"CSV columns: {reader.fieldnames}")
-    
-    for row in reader:
-        # Map CSV columns - try multiple possible column names
-        datum = (
-            row.get('Datum izvršenja') or 
-            row.get('Datum izvrsenja') or
-            row.get('Datum knjiženja') or
-            row.get('Datum knjizenja') or
-            row.get('Datum') or 
-            ''
-        ).strip()
-        
-        primatelj = (
-            row.get('Primatelj') or 
-            row.get('Naziv') or
-            row.get('Naziv primatelja') or
-            ''
-        ).strip()
-        
-        opis = (
-            row.get('Opis transakcije') or 
-            row.get('Opis transa') or
-            row.get('Opis') or
-            row.get('Napomena') or
-            ''
-        ).strip()
-        
-        iznos = (
-            row.get('Ukupan iznos') or 
-            row.get('Ukupan izn') or
-            row.get('Iznos') or
-            row.get('Iznos transakcije') or
-            ''
-        ).strip()
-        
-        # Skip empty rows
-        if not primatelj and not opis:
-            continue
-        
-        # Try to match vendor
-        matched_vendor = match_vendor(primatelj, opis, vendors)
-        
-        trans_id = str(uuid.uuid4())
-        transaction_doc = {
-            "id": trans_id,
-            "user_id": user["id"],
-            "batch_id": batch_id,
-            "datum_izvrsenja": datum,
-            "primatelj": primatelj,
-            "opis_transakcije": opis,
-            "iznos": iznos,
-            "status": "pending",
-            "invoice_filename": None,
-            "invoice_url": None,
-            "vendor_id": matched_vendor["id"] if matched_vendor else None,
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        transactions.append(transaction_doc)
+    def mapped(self, field: str) -> bool:
+        return bool(self.indices[STATEMENT_FIELDS.index(field)])
     
-    if transactions:
-        await db.transactions.insert_many(transactions)
+    def extract(self, row: list) -> tuple:
+        if len(row) < self.width:
+            row = row + [''] * (self.width - len(row))
+        values = []
+        for indices in self.indices:
+            value = ''
+            for i in indices:
+                value = row[i]
+                if value:
+                    break
+            values.append(value.strip() if value else '')
+        return tuple(values)
+
+class StatementLayout:
+    """Column names a bank uses for each statement field"""
     
-    # Create batch record
-    batch_doc = {
-        "id": batch_id,
-        "user_id": user["id"],
-        "filename": file.filename,
-        "month": month,
-        "year": year,
-        "transaction_count": len(transactions),
-        "downloaded_count": 0,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    await db.batches.insert_one(batch_doc)
+    def __init__(self, name: str, columns: dict, required: tuple = ()):
+        self.name = name
+        self.columns = columns
+        self.required = required
     
-    return {
-        "batch_id": batch_id,
-        "transaction_count": len(transactions),
-        "message": f"Učitano {len(transactions)} transakcija"
-    }
+    def resolve(self, header: list) -> Optional[ColumnMapping]:
+        """Column mapping for this header, None if it is not this layout"""
+        mapping = ColumnMapping(header, self.columns)
+        if all(mapping.mapped(field) for field in self.required):
+            return mapping
+        return None
 
-@api_router.get("/batches", response_model=List[BatchResponse])
-async def get_batches(user: dict = Depends(get_current_user)):
-    batches = await db.batches.find({"user_id": user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(100)
+STATEMENT_LAYOUTS = []
+
+def register_statement_layout(layout: StatementLayout) -> StatementLayout:
+    """Register a bank layout; layouts registered later are tried first"""
+    STATEMENT_LAYOUTS.insert(0, layout)
+    return layout
+
+# The bank export FinZen was built for; some of its exports cut the long
+# column names short
+register_statement_layout(StatementLayout("hr_bank_export", {
+    "datum": ('Datum izvršenja', 'Datum izvrsenja'),
+    "primatelj": ('Primatelj',),
+    "opis": ('Opis transakcije', 'Opis transa'),
+    "iznos": ('Ukupan iznos', 'Ukupan izn'),
+}, required=STATEMENT_FIELDS))
+
+# Fallback for other Croatian bank exports, tried after every more specific layout
+DEFAULT_STATEMENT_LAYOUT = StatementLayout("hr_generic", {
+    "datum": ('Datum izvršenja', 'Datum izvrsenja', 'Datum knjiženja', 'Datum knjizenja', 'Datum'),
+    "primatelj": ('Primatelj', 'Naziv', 'Naziv primatelja'),
+    "opis": ('Opis transakcije', 'Opis transa', 'Opis', 'Napomena'),
+    "iznos": ('Ukupan iznos', 'Ukupan izn', 'Iznos', 'Iznos transakcije'),
+})
+
+def resolve_statement_layout(header: list) -> tuple:
+    """(layout, mapping) for a statement header"""
+    for layout in STATEMENT_LAYOUTS:
+        mapping = layout.resolve(header)
+        if mapping:
+            return layout, mapping
+    return DEFAULT_STATEMENT_LAYOUT, DEFAULT_STATEMENT_LAYOUT.resolve(header)
+
+STATEMENT_DATE_FORMATS = ["%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%d-%m-%Y", "%m/%d/%Y"]
+CURRENCY_SYMBOLS = {"€": "EUR", "$": "USD", "£": "GBP", "kn": "HRK"}
+DEFAULT_CURRENCY = os.environ.get('DEFAULT_CURRENCY', 'EUR')
+
+def parse_statement_date(value: str) -> Optional[datetime]:
+    """Bank date string as a UTC midnight datetime, None if unrecognised"""
+    value = (value or '').strip()
+    if not value:
+        return None
+    # "01.12.2025." and "01.12.2025 10:15" are common in Croatian exports
+    value = value.split()[0].rstrip('.')
+    for fmt in STATEMENT_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    return None
+
+def parse_statement_amount(value: str) -> tuple:
+    """(amount in cents, currency) from a bank amount string.
     
-    if not batches:
-        return []
+    Accepts decimal commas and points with either used as the thousands
+    separator, a currency code or symbol on either side, and a leading or
+    trailing minus sign. Returns (None, None) when the text is not an amount.
+    """
+    text = (value or '').replace('\xa0', ' ').strip()
+    if not text:
+        return None, None
     
-    # Get all batch IDs
-    batch_ids = [b["id"] for b in batches]
+    currency = None
+    match = re.search(r'[A-Za-z]{3}|€|\$|£|\bkn\b', text)
+    if match:
+        token = match.group(0)
+        currency = CURRENCY_SYMBOLS.get(token, token.upper())
+        text = (text[:match.start()] + text[match.end():]).strip()
     
-    # Single aggregation query to get downloaded counts for all batches
-    pipeline = [
-        {"$match": {
-            "user_id": user["id"],
-            "batch_id": {"$in": batch_ids},
-            "status": {"$in": ["downloaded", "found"]}
-        }},
-        {"$group": {
-            "_id": "$batch_id",
-            "count": {"$sum": 1}
-        }}
-    ]
+    negative = False
+    if text.startswith('(') and text.endswith(')'):
+        negative, text = True, text[1:-1]
+    if text.startswith('-') or text.endswith('-'):
+        negative, text = True, text.strip('-')
+    text = text.lstrip('+').replace(' ', '').replace("'", '')
     
-    counts_cursor = db.transactions.aggregate(pipeline)
-    counts_list = await counts_cursor.to_list(1000)
+    if ',' in text and '.' in text:
+        # The separator that comes last is the decimal one
+        thousands = '.' if text.rfind(',') > text.rfind('.') else ','
+        text = text.replace(thousands, '')
+    elif text.count('.') > 1:
+        text = text.replace('.', '')
+    elif text.count(',') > 1:
+        text = text.replace(',', '')
+    text = text.replace(',', '.')
     
-    # Create a lookup dict for counts
-    counts_dict = {item["_id"]: item["count"] for item in counts_list}
+    if not re.fullmatch(r'\d+(\.\d*)?|\.\d+', text):
+        return None, None
+    cents = int((Decimal(text) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+    return (-cents if negative else cents), (currency or DEFAULT_CURRENCY)
+
+def typed_transaction_fields(datum: str, iznos: str) -> dict:
+    """Native-typed copies of a transaction's date and amount strings"""
+    amount_cents, currency = parse_statement_amount(iznos)
+    return {
+        "transaction_date": parse_statement_date(datum),
+        "amount_cents": amount_cents,
+        "currency": currency
+    }
+
+def transaction_date(trans: dict) -> Optional[datetime]:
+    """Parsed execution date of a transaction document"""
+    if "transaction_date" in trans:
+        return trans["transaction_date"]
+    return parse_statement_date(trans.get("datum_izvrsenja", ""))
+
+def format_statement_amount(value) -> str:
+    """Amount in the decimal-comma notation of the bank CSV exports"""
+    return f"{value:.2f}".replace('.', ',')
+
+def format_statement_date(value) -> str:
+    return value.strftime("%d.%m.%Y")
+
+class StatementParser(ABC):
+    """A statement file format.
     
-    # Update batches with counts
-    for b in batches:
-        if isinstance(b['created_at'], str):
-            b['created_at'] = datetime.fromisoformat(b['created_at'])
-        b['downloaded_count'] = counts_dict.get(b["id"], 0)
+    `rows` is a synchronous generator of (datum, primatelj, opis, iznos)
+    tuples read incrementally from the upload's file; it runs in a worker
+    thread. `attempts` lists the options `rows` can be retried with when
+    the file turns out not to be readable with the first one (CSV
+    encodings); a retry raises UnicodeDecodeError.
+    """
     
-    return batches
-
-@api_router.get("/transactions", response_model=List[TransactionResponse])
-async def get_transactions(
-    batch_id: Optional[str] = None,
-    status: Optional[str] = None,
-    user: dict = Depends(get_current_user)
-):
-    query = {"user_id": user["id"]}
-    if batch_id:
-        query["batch_id"] = batch_id
-    if status:
-        query["status"] = status
+    name = ""
     
-    transactions = await db.transactions.find(query, {"_id": 0}).sort("datum_izvrsenja", -1).to_list(1000)
-    for t in transactions:
-        if isinstance(t['created_at'], str):
-            t['created_at'] = datetime.fromisoformat(t['created_at'])
-    return transactions
-
-@api_router.put("/transactions/{transaction_id}", response_model=TransactionResponse)
-async def update_transaction(
-    transaction_id: str,
-    data: TransactionUpdate,
-    user: dict = Depends(get_current_user)
-):
-    update_data = {k: v for k, v in data.model_dump().items() if v is not None}
-    if not update_data:
-        raise HTTPException(status_code=400, detail="Nema podataka za ažuriranje")
+    @abstractmethod
+    def detect(self, filename: str, prefix: bytes) -> bool:
+        """Whether the upload is in this format, from its name and first bytes"""
     
-    result = await db.transactions.update_one(
-        {"id": transaction_id, "user_id": user["id"]},
-        {"$set": update_data}
-    )
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Transakcija nije pronađena")
+    def attempts(self, prefix: bytes) -> list:
+        return [None]
     
-    transaction = await db.transactions.find_one({"id": transaction_id}, {"_id": 0})
-    if isinstance(transaction['created_at'], str):
-        transaction['created_at'] = datetime.fromisoformat(transaction['created_at'])
-    return TransactionResponse(**transaction)
+    @abstractmethod
+    def rows(self, raw, option):
+        """Statement rows of the file read with the given attempt option"""
 
-@api_router.delete("/transactions/{transaction_id}")
-async def delete_transaction(transaction_id: str, user: dict = Depends(get_current_user)):
-    """Delete a single transaction"""
-    result = await db.transactions.delete_one({"id": transaction_id, "user_id": user["id"]})
-    if result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Transakcija nije pronađena")
-    return {"message": "Transakcija obrisana"}
+STATEMENT_PARSERS = []
 
-class DeleteTransactionsRequest(BaseModel):
-    transaction_ids: List[str]
+def register_statement_parser(cls):
+    STATEMENT_PARSERS.append(cls())
+    return cls
 
-@api_router.post("/transactions/delete-batch")
-async def delete_transactions_batch(request: DeleteTransactionsRequest, user: dict = Depends(get_current_user)):
-    """Delete multiple transactions"""
-    result = await db.transactions.delete_many({
-        "id": {"$in": request.transaction_ids},
-        "user_id": user["id"]
-    })
-    return {"message": f"Obrisano {result.deleted_count} transakcija", "deleted_count": result.deleted_count}
+def detect_statement_parser(filename: str, prefix: bytes) -> Optional[StatementParser]:
+    for parser in STATEMENT_PARSERS:
+        if parser.detect(filename, prefix):
+            return parser
+    return None
 
-@api_router.delete("/batches/{batch_id}")
-async def delete_batch(batch_id: str, user: dict = Depends(get_current_user)):
-    """Delete a batch and all its transactions"""
-    # Delete all transactions in batch
-    trans_result = await db.transactions.delete_many({"batch_id": batch_id, "user_id": user["id"]})
+@register_statement_parser
+class XlsxStatementParser(StatementParser):
+    """First worksheet of an Excel statement, read in openpyxl's read-only mode"""
     
-    # Delete batch record
-    batch_result = await db.batches.delete_one({"id": batch_id, "user_id": user["id"]})
+    name = "xlsx"
     
-    if batch_result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Batch nije pronađen")
+    def detect(self, filename: str, prefix: bytes) -> bool:
+        return filename.lower().endswith('.xlsx') and prefix.startswith(b'PK\x03\x04')
     
-    return {"message": f"Batch obrisan ({trans_result.deleted_count} transakcija)"}
-
-# ============== STATS ==============
+    @staticmethod
+    def _cell_text(value) -> str:
+        if value is None:
+            return ''
+        if isinstance(value, datetime):
+            return format_statement_date(value)
+        if isinstance(value, float):
+            return format_statement_amount(value)
+        return str(value)
+    
+    def rows(self, raw, option):
+        try:
+            import openpyxl
+        except ImportError:
+            raise HTTPException(status_code=400, detail="XLSX izvodi nisu podržani na ovom poslužitelju")
+        
+        workbook = openpyxl.load_workbook(raw, read_only=True, data_only=True)
+        try:
+            mapping = None
+            for values in workbook.worksheets[0].iter_rows(values_only=True):
+                row = [self._cell_text(v) for v in values]
+                if mapping is None:
+                    # Header is the first non-empty row
+                    if any(row):
+                        layout, mapping = resolve_statement_layout([c.strip() for c in row])
+                        logger.info(f"XLSX columns: {row}, layout {layout.name}")
+                    continue
+                yield mapping.extract(row)
+        finally:
+            workbook.close()
 
-@api_router.get("/stats")
-async def get_stats(user: dict = Depends(get_current_user)):
-    total_transactions = await db.transactions.count_documents({"user_id": user["id"]})
-    pending = await db.transactions.count_documents({"user_id": user["id"], "status": "pending"})
-    downloaded = await db.transactions.count_documents({"user_id": user["id"], "status": {"$in": ["downloaded", "found"]}})
-    manual = await db.transactions.count_documents({"user_id": user["id"], "status": "manual"})
-    
-    # Get total amount
-    pipeline = [
-        {"$match": {"user_id": user["id"]}},
-        {"$project": {
-            "amount": {
-                "$toDouble": {
-                    "$replaceAll": {
-                        "input": {"$replaceAll": {"input": "$iznos", "find": " EUR", "replacement": ""}},
-                        "find": ",",
-                        "replacement": "."
-                    }
-                }
-            }
-        }},
-        {"$group": {"_id": None, "total": {"$sum": "$amount"}}}
-    ]
+@register_statement_parser
+class Camt053StatementParser(StatementParser):
+    """ISO 20022 CAMT.053 bank-to-customer statement, parsed with iterparse.
     
-    try:
-        result = await db.transactions.aggregate(pipeline).to_list(1)
-        total_amount = abs(result[0]["total"]) if result else 0
-    except:
-        total_amount = 0
+    Each <Ntry> is converted and discarded as soon as it has been read, so
+    memory does not grow with the number of entries.
+    """
     
-    return {
-        "total_transactions": total_transactions,
-        "pending": pending,
-        "downloaded": downloaded,
-        "manual": manual,
-        "total_amount": round(total_amount, 2),
+    name = "camt053"
+    
+    def detect(self, filename: str, prefix: bytes) -> bool:
+        return b'camt.053' in prefix or b'BkToCstmrStmt' in prefix
+    
+    @staticmethod
+    def _local(tag: str) -> str:
+        return tag.rsplit('}', 1)[-1]
+    
+    def _find(self, elem, *path):
+        """Descendant by local names, ignoring the camt.053 namespace version"""
+        for name in path:
+            if elem is None:
+                return None
+            elem = next((child for child in elem if self._local(child.tag) == name), None)
+        return elem
+    
+    def _text(self, elem, *path) -> str:
+        found = self._find(elem, *path)
+        return (found.text or '').strip() if found is not None else ''
+    
+    def _entry(self, ntry) -> tuple:
+        debit = self._text(ntry, 'CdtDbtInd') == 'DBIT'
+        amt = self._find(ntry, 'Amt')
+        amount = Decimal((amt.text or '').strip() if amt is not None else '0')
+        currency = amt.get('Ccy') if amt is not None else None
+        datum = self._text(ntry, 'BookgDt', 'Dt') or self._text(ntry, 'BookgDt', 'DtTm')[:10] or self._text(ntry, 'ValDt', 'Dt')
+        if datum:
+            datum = format_statement_date(datetime.strptime(datum, "%Y-%m-%d"))
+        
+        tx = self._find(ntry, 'NtryDtls', 'TxDtls')
+        # The counterparty: who was paid for debits, who paid for credits
+        party = 'Cdtr' if debit else 'Dbtr'
+        primatelj = self._text(tx, 'RltdPties', party, 'Nm') or self._text(tx, 'RltdPties', party, 'Pty', 'Nm')
+        
+        remittance = self._find(tx, 'RmtInf')
+        lines = [
+            (child.text or '').strip() for child in (remittance if remittance is not None else ())
+            if self._local(child.tag) == 'Ustrd'
+        ]
+        opis = ' '.join(line for line in lines if line) or self._text(tx, 'AddtlTxInf') or self._text(ntry, 'AddtlNtryInf')
+        
+        iznos = format_statement_amount(-amount if debit else amount)
+        return datum, primatelj, opis, f"{iznos} {currency}" if currency else iznos
+    
+    def rows(self, raw, option):
+        stack = []
+        for event, elem in ElementTree.iterparse(raw, events=("start", "end")):
+            if event == "start":
+                stack.append(elem)
+                continue
+            stack.pop()
+            if self._local(elem.tag) == 'Ntry':
+                yield self._entry(elem)
+                if stack:
+                    stack[-1].remove(elem)
+                elem.clear()
+
+@register_statement_parser
+class CsvStatementParser(StatementParser):
+    """Delimited text export, the format most Croatian banks offer"""
+    
+    name = "csv"
+    
+    def detect(self, filename: str, prefix: bytes) -> bool:
+        return filename.lower().endswith('.csv')
+    
+    def attempts(self, prefix: bytes) -> list:
+        return CSV_ENCODINGS[detect_csv_encoding(prefix):]
+    
+    def rows(self, raw, encoding):
+        text = io.TextIOWrapper(raw, encoding=encoding, newline='')
+        try:
+            reader = csv.reader(text)
+            header = next(reader, None)
+            if header is None:
+                return
+            layout, mapping = resolve_statement_layout(header)
+            # Log available columns for debugging
+            logger.info(f"CSV columns: {header}, layout {layout.name}")
+            for row in reader:
+                if row:
+                    yield mapping.extract(row)
+        finally:
+            # Keep the upload's file open, starlette closes it
+            text.detach()
+
+# ============== COUNTERS ==============
+
+COUNTER_RECONCILE_INTERVAL = int(os.environ.get('COUNTER_RECONCILE_INTERVAL', '3600'))  # seconds, 0 disables
+DOWNLOADED_STATUSES = ("downloaded", "found")
+
+# Materialised transaction counts, kept in step with every insert, status
+# change and delete so the dashboard never has to recount:
+#   {"_id": "user:<user_id>", "user_id", "total", "amount_cents", "status": {<status>: n}}
+#   {"_id": "batch:<batch_id>", "user_id", "batch_id", "total", "amount_cents", "status": {...}}
+# reconcile_counters rebuilds them from the transactions and repairs drift.
+
+def counter_deltas(transactions: list) -> dict:
+    """Counter increments for a list of transaction documents, per counter _id"""
+    deltas = {}
+    for t in transactions:
+        for counter_id in (f"user:{t['user_id']}", f"batch:{t['batch_id']}"):
+            delta = deltas.setdefault(counter_id, {"user_id": t["user_id"], "inc": {}})
+            if counter_id.startswith("batch:"):
+                delta["batch_id"] = t["batch_id"]
+            inc = delta["inc"]
+            inc["total"] = inc.get("total", 0) + 1
+            inc["amount_cents"] = inc.get("amount_cents", 0) + (t.get("amount_cents") or 0)
+            status_key = f"status.{t.get('status')}"
+            inc[status_key] = inc.get(status_key, 0) + 1
+    return deltas
+
+async def apply_counter_deltas(deltas: dict, sign: int = 1):
+    if not deltas:
+        return
+    await db.counters.bulk_write([
+        UpdateOne(
+            {"_id": counter_id},
+            {
+                "$inc": {k: sign * v for k, v in delta["inc"].items()},
+                "$set": {k: v for k, v in delta.items() if k != "inc"}
+            },
+            upsert=True
+        )
+        for counter_id, delta in deltas.items()
+    ], ordered=False)
+
+async def record_status_changes(changes: list):
+    """Move transactions between status counters; changes are (before, new_status) pairs"""
+    incs = {}
+    for before, new_status in changes:
+        old_status = before.get("status")
+        if old_status == new_status:
+            continue
+        for counter_id in (f"user:{before['user_id']}", f"batch:{before['batch_id']}"):
+            inc = incs.setdefault(counter_id, {})
+            inc[f"status.{old_status}"] = inc.get(f"status.{old_status}", 0) - 1
+            inc[f"status.{new_status}"] = inc.get(f"status.{new_status}", 0) + 1
+    if not incs:
+        return
+    await db.counters.bulk_write([
+        UpdateOne({"_id": counter_id}, {"$inc": inc}, upsert=True)
+        for counter_id, inc in incs.items()
+    ], ordered=False)
+
+async def record_status_change(before: dict, new_status: str):
+    """Move one transaction between status counters"""
+    await record_status_changes([(before, new_status)])
+
+async def update_transaction_fields(query: dict, fields: dict, projection: dict = None) -> Optional[dict]:
+    """$set fields on one transaction and keep the status counters in step.
+    
+    Returns the transaction as it was before the update (the projected
+    fields plus user_id, batch_id and status), None if no transaction
+    matched.
+    """
+    before = await db.transactions.find_one_and_update(
+        query,
+        {"$set": fields},
+        projection=projection or {"_id": 0, "user_id": 1, "batch_id": 1, "status": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if before and "status" in fields:
+        await record_status_change(before, fields["status"])
+    return before
+
+class TransactionWriteBatch:
+    """Coalesces $set updates to one user's transactions into bulk writes.
+    
+    Updates are queued per transaction id (later fields win) and flush()
+    applies them with one read of the current documents, one unordered
+    bulk_write and one counters write, however many transactions there
+    are. Status updates are guarded by the status that was read, so the
+    counters of every update that lands can be moved from that status.
+    Updates that miss the guard (a concurrent change) or fail are redone
+    one at a time; each flush tags its writes with write_batch_id so the
+    ones that landed can be told apart from those that did not, and
+    removes the tag again before it returns.
+    """
+    
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.updates = {}
+    
+    def update(self, transaction_id: str, fields: dict):
+        self.updates.setdefault(transaction_id, {}).update(fields)
+    
+    async def flush(self) -> dict:
+        """Apply the queued updates; returns the updated transactions by id"""
+        updates, self.updates = self.updates, {}
+        if not updates:
+            return {}
+        befores = await db.transactions.find(
+            {"id": {"$in": list(updates)}, "user_id": self.user_id},
+            TRANSACTION_RESPONSE_PROJECTION
+        ).to_list(None)
+        if not befores:
+            return {}
+        
+        write_batch_id = str(uuid.uuid4())
+        operations = []
+        for before in befores:
+            fields = updates[before["id"]]
+            query = {"id": before["id"], "user_id": self.user_id}
+            if "status" in fields:
+                query["status"] = before.get("status")
+            operations.append(UpdateOne(query, {"$set": {**fields, "write_batch_id": write_batch_id}}))
+        try:
+            result = await db.transactions.bulk_write(operations, ordered=False)
+            failed, matched = set(), result.matched_count
+        except BulkWriteError as e:
+            failed = {error["index"] for error in e.details.get("writeErrors", [])}
+            matched = e.details.get("nMatched", 0)
+        
+        candidates = [before for index, before in enumerate(befores) if index not in failed]
+        if matched < len(candidates):
+            # Some guards missed; only the tagged documents took this flush's update
+            tagged = await db.transactions.find(
+                {"id": {"$in": [before["id"] for before in candidates]}, "write_batch_id": write_batch_id},
+                {"_id": 0, "id": 1}
+            ).to_list(None)
+            landed_ids = {doc["id"] for doc in tagged}
+            landed = [before for before in candidates if before["id"] in landed_ids]
+        else:
+            landed = candidates
+        if landed:
+            await db.transactions.update_many(
+                {"id": {"$in": [before["id"] for before in landed]}, "write_batch_id": write_batch_id},
+                {"$unset": {"write_batch_id": ""}}
+            )
+        
+        # The guard held for these, so the status read up front is the one they moved from
+        await record_status_changes([
+            (before, updates[before["id"]]["status"])
+            for before in landed if "status" in updates[before["id"]]
+        ])
+        updated = {before["id"]: {**before, **updates[before["id"]]} for before in landed}
+        
+        for before in befores:
+            if before["id"] in updated:
+                continue
+            redone = await update_transaction_fields(
+                {"id": before["id"], "user_id": self.user_id}, updates[before["id"]], TRANSACTION_RESPONSE_PROJECTION
+            )
+            if redone:
+                updated[before["id"]] = {**redone, **updates[before["id"]]}
+        return updated
+
+async def delete_transactions(query: dict) -> int:
+    """Delete the matching transactions and subtract them from the counters"""
+    docs = await db.transactions.find(
+        query, {"_id": 1, "user_id": 1, "batch_id": 1, "status": 1, "amount_cents": 1, "invoice_sha256": 1}
+    ).to_list(None)
+    if not docs:
+        return 0
+    result = await db.transactions.delete_many({"_id": {"$in": [d["_id"] for d in docs]}})
+    await apply_counter_deltas(counter_deltas(docs), -1)
+    await release_invoices(docs)
+    return result.deleted_count
+
+async def delete_batch_transactions(user_id: str, batch_id: str) -> int:
+    """Delete every transaction of a batch, moving the batch counter out of the user's"""
+    counter = await db.counters.find_one_and_delete({"_id": f"batch:{batch_id}"})
+    invoices = await db.transactions.find(
+        {"batch_id": batch_id, "user_id": user_id, "invoice_sha256": {"$ne": None}},
+        {"_id": 0, "invoice_sha256": 1}
+    ).to_list(None)
+    result = await db.transactions.delete_many({"batch_id": batch_id, "user_id": user_id})
+    await release_invoices(invoices)
+    if counter:
+        inc = {f"status.{k}": -v for k, v in counter.get("status", {}).items()}
+        inc["total"] = -counter.get("total", 0)
+        inc["amount_cents"] = -counter.get("amount_cents", 0)
+        await db.counters.update_one({"_id": f"user:{user_id}"}, {"$inc": inc}, upsert=True)
+    return result.deleted_count
+
+async def reconcile_counters(user_id: str = None) -> int:
+    """Rebuild counters from the transactions; returns how many had drifted.
+    
+    Increments that land between the aggregation and the write are lost
+    and picked up by the next run.
+    """
+    match = {"user_id": user_id} if user_id else {}
+    groups = await db.transactions.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "batch_id": "$batch_id", "status": "$status"},
+            "count": {"$sum": 1},
+            "amount_cents": {"$sum": "$amount_cents"}
+        }}
+    ]).to_list(None)
+    
+    expected = {}
+    if user_id:
+        # Users without transactions still get a (zero) counter
+        expected[f"user:{user_id}"] = {"_id": f"user:{user_id}", "user_id": user_id, "total": 0, "amount_cents": 0, "status": {}}
+    for g in groups:
+        key = g["_id"]
+        for counter_id in (f"user:{key['user_id']}", f"batch:{key.get('batch_id')}"):
+            counter = expected.setdefault(counter_id, {
+                "_id": counter_id, "user_id": key["user_id"], "total": 0, "amount_cents": 0, "status": {}
+            })
+            if counter_id.startswith("batch:"):
+                counter["batch_id"] = key.get("batch_id")
+            counter["total"] += g["count"]
+            counter["amount_cents"] += g["amount_cents"] or 0
+            counter["status"][key.get("status")] = counter["status"].get(key.get("status"), 0) + g["count"]
+    
+    def normalized(counter: dict) -> dict:
+        counter = dict(counter, status={k: v for k, v in counter.get("status", {}).items() if v})
+        counter.setdefault("total", 0)
+        counter.setdefault("amount_cents", 0)
+        return counter
+    
+    existing = {c["_id"]: normalized(c) for c in await db.counters.find(match).to_list(None)}
+    drifted = [c for counter_id, c in expected.items() if existing.get(counter_id) != normalized(c)]
+    if drifted:
+        await db.counters.bulk_write([
+            ReplaceOne({"_id": c["_id"]}, c, upsert=True) for c in drifted
+        ], ordered=False)
+    stale = [counter_id for counter_id in existing if counter_id not in expected]
+    if stale:
+        await db.counters.delete_many({"_id": {"$in": stale}})
+    return len(drifted) + len(stale)
+
+async def get_user_counters(user_id: str) -> dict:
+    counters = await db.counters.find_one({"_id": f"user:{user_id}"})
+    if counters is None:
+        await reconcile_counters(user_id)
+        counters = await db.counters.find_one({"_id": f"user:{user_id}"})
+    return counters
+
+async def counter_reconcile_worker():
+    """Periodically repair counters that drifted, e.g. after a crash between writes"""
+    while True:
+        await asyncio.sleep(COUNTER_RECONCILE_INTERVAL)
+        try:
+            drifted = await reconcile_counters()
+            if drifted:
+                logger.warning(f"Counter reconciliation repaired {drifted} counters")
+        except Exception as e:
+            logger.error(f"Counter reconciliation failed: {e}")
+
+# ============== CSV UPLOAD & TRANSACTIONS ==============
+
+CSV_INSERT_CHUNK_SIZE = int(os.environ.get('CSV_INSERT_CHUNK_SIZE', '1000'))
+
+def transaction_from_statement_row(fields: tuple, user_id: str, batch_id: str, vendor_matcher: "VendorMatcher") -> Optional[dict]:
+    """Build a transaction document from a parsed statement row, None for empty rows"""
+    datum, primatelj, opis, iznos = fields
+    
+    # Skip empty rows
+    if not primatelj and not opis:
+        return None
+    
+    # Try to match vendor
+    matched_vendor = vendor_matcher.match(primatelj, opis)
+    
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "batch_id": batch_id,
+        "datum_izvrsenja": datum,
+        "primatelj": primatelj,
+        "opis_transakcije": opis,
+        "iznos": iznos,
+        "status": "pending",
+        "invoice_filename": None,
+        "invoice_url": None,
+        "vendor_id": matched_vendor["id"] if matched_vendor else None,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        **typed_transaction_fields(datum, iznos)
+    }
+
+def _read_statement_chunk(rows, size: int, user_id: str, batch_id: str, vendor_matcher: "VendorMatcher"):
+    """Parse up to `size` rows; returns (transactions, rows_read)"""
+    transactions = []
+    rows_read = 0
+    for fields in rows:
+        rows_read += 1
+        transaction = transaction_from_statement_row(fields, user_id, batch_id, vendor_matcher)
+        if transaction:
+            transactions.append(transaction)
+        if rows_read >= size:
+            break
+    return transactions, rows_read
+
+async def ingest_statement_upload(file: UploadFile, parser: StatementParser, prefix: bytes, user: dict, batch_id: str) -> int:
+    """Stream the uploaded statement into the database in chunks.
+    
+    The upload is parsed incrementally from the spooled file, so memory use
+    does not grow with the statement size. Progress is stored on the batch
+    record after every chunk. If a later part of a CSV file turns out not
+    to decode with the encoding guessed from its prefix, the rows inserted
+    so far are removed and the next encoding is tried, which gives the same
+    result as decoding the whole file up front.
+    """
+    loop = asyncio.get_running_loop()
+    raw = file.file
+    
+    # Get user's vendors for matching
+    vendors = await db.vendors.find({"user_id": user["id"]}, {"_id": 0}).to_list(1000)
+    vendor_matcher = get_vendor_matcher(user["id"], vendors)
+    
+    for option in parser.attempts(prefix):
+        raw.seek(0)
+        rows = parser.rows(raw, option)
+        try:
+            inserted = 0
+            rows_read = 0
+            while True:
+                transactions, count = await loop.run_in_executor(
+                    None, _read_statement_chunk, rows, CSV_INSERT_CHUNK_SIZE, user["id"], batch_id, vendor_matcher
+                )
+                if transactions:
+                    await db.transactions.insert_many(transactions, ordered=False)
+                    await apply_counter_deltas(counter_deltas(transactions))
+                    inserted += len(transactions)
+                rows_read += count
+                if metrics:
+                    metrics.statement_rows_ingested.labels(parser.name).inc(count)
+                await db.batches.update_one(
+                    {"id": batch_id},
+                    {"$set": {"transaction_count": inserted, "processed_rows": rows_read}}
+                )
+                if count < CSV_INSERT_CHUNK_SIZE:
+                    return inserted
+        except UnicodeDecodeError:
+            logger.info(f"Statement upload {batch_id} is not {option}, retrying with the next encoding")
+            await delete_batch_transactions(user["id"], batch_id)
+        except (ElementTree.ParseError, zipfile.BadZipFile, KeyError, ValueError, ArithmeticError) as e:
+            logger.warning(f"Statement upload {batch_id} could not be parsed as {parser.name}: {e}")
+            raise HTTPException(status_code=400, detail="Nije moguće pročitati datoteku izvoda")
+        finally:
+            rows.close()
+    
+    raise HTTPException(status_code=400, detail="Nije moguće pročitati CSV datoteku")
+
+@api_router.post("/upload/csv")
+async def upload_csv(
+    file: UploadFile = File(...),
+    month: str = "12",
+    year: str = "2025",
+    user: dict = Depends(get_current_user)
+):
+    prefix = await file.read(CSV_ENCODING_PROBE_BYTES)
+    parser = detect_statement_parser(file.filename or '', prefix)
+    if not parser:
+        raise HTTPException(status_code=400, detail="Podržani su samo CSV, XLSX i CAMT.053 XML izvodi")
+    
+    batch_id = str(uuid.uuid4())
+    
+    # Create the batch record first so progress can be polled while rows are ingested
+    batch_doc = {
+        "id": batch_id,
+        "user_id": user["id"],
+        "filename": file.filename,
+        "month": month,
+        "year": year,
+        "transaction_count": 0,
+        "processed_rows": 0,
+        "downloaded_count": 0,
+        "status": "processing",
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+    await db.batches.insert_one(batch_doc)
+    
+    try:
+        transaction_count = await ingest_statement_upload(file, parser, prefix, user, batch_id)
+    except BaseException:
+        await delete_batch_transactions(user["id"], batch_id)
+        await db.batches.delete_one({"id": batch_id})
+        raise
+    
+    await db.batches.update_one({"id": batch_id}, {"$set": {"status": "completed"}})
+    
+    return {
+        "batch_id": batch_id,
+        "transaction_count": transaction_count,
+        "message": f"Učitano {transaction_count} transakcija"
+    }
+
+@api_router.get("/batches/{batch_id}/progress")
+async def get_batch_progress(batch_id: str, user: dict = Depends(get_current_user)):
+    """Ingest progress of a CSV upload"""
+    batch = await db.batches.find_one(
+        {"id": batch_id, "user_id": user["id"]},
+        {"_id": 0, "status": 1, "transaction_count": 1, "processed_rows": 1}
+    )
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch nije pronađen")
+    return {
+        "batch_id": batch_id,
+        "status": batch.get("status", "completed"),
+        "processed_rows": batch.get("processed_rows", batch["transaction_count"]),
+        "transaction_count": batch["transaction_count"]
+    }
+
+@api_router.get("/batches", response_model=List[BatchResponse])
+async def get_batches(user: dict = Depends(get_current_user)):
+    batches = await db.batches.find({"user_id": user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(100)
+    
+    if not batches:
+        return []
+    
+    # Downloaded counts come from the materialised batch counters
+    counter_ids = [f"batch:{b['id']}" for b in batches]
+    counters = await db.counters.find({"_id": {"$in": counter_ids}}).to_list(len(counter_ids))
+    if len(counters) < len(counter_ids) and not await db.counters.find_one({"_id": f"user:{user['id']}"}):
+        # Counters were never built for this user
+        await reconcile_counters(user["id"])
+        counters = await db.counters.find({"_id": {"$in": counter_ids}}).to_list(len(counter_ids))
+    counts_dict = {
+        c["batch_id"]: sum(c.get("status", {}).get(s, 0) for s in DOWNLOADED_STATUSES)
+        for c in counters
+    }
+    
+    # Update batches with counts
+    for b in batches:
+        if isinstance(b['created_at'], str):
+            b['created_at'] = datetime.fromisoformat(b['created_at'])
+        b['downloaded_count'] = counts_dict.get(b["id"], 0)
+    
+    return batches
+
+TRANSACTIONS_PAGE_SIZE = int(os.environ.get('TRANSACTIONS_PAGE_SIZE', '1000'))
+TRANSACTIONS_MAX_PAGE_SIZE = int(os.environ.get('TRANSACTIONS_MAX_PAGE_SIZE', '1000'))
+TRANSACTIONS_COUNT_LIMIT = int(os.environ.get('TRANSACTIONS_COUNT_LIMIT', '10000'))
+TRANSACTION_RESPONSE_PROJECTION = {"_id": 0, **{field: 1 for field in TransactionResponse.model_fields}, "transaction_date": 1}
+
+def encode_transaction_cursor(transaction: dict) -> str:
+    """Opaque keyset token for the (transaction_date, id) position after a transaction"""
+    date = transaction.get("transaction_date")
+    payload = json.dumps({"d": date.isoformat() if date else None, "i": transaction["id"]})
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_transaction_cursor(cursor: str) -> tuple:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        date = datetime.fromisoformat(payload["d"]) if payload["d"] else None
+        return date, str(payload["i"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Nevažeći kursor")
+
+def transactions_after(cursor: str) -> dict:
+    """Filter for everything after the cursor in (transaction_date desc, id desc) order.
+    
+    Transactions without a parsed date sort last, as in MongoDB.
+    """
+    date, transaction_id = decode_transaction_cursor(cursor)
+    if date is None:
+        return {"transaction_date": None, "id": {"$lt": transaction_id}}
+    return {"$or": [
+        {"transaction_date": {"$lt": date}},
+        {"transaction_date": date, "id": {"$lt": transaction_id}},
+        {"transaction_date": None}
+    ]}
+
+@api_router.get("/transactions", response_model=List[TransactionResponse])
+async def get_transactions(
+    response: Response,
+    batch_id: Optional[str] = None,
+    status: Optional[str] = None,
+    vendor_id: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    amount_min: Optional[float] = None,
+    amount_max: Optional[float] = None,
+    q: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    count: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """One page of transactions, newest first.
+    
+    Amount bounds are signed (payments are negative) and inclusive, as are
+    the dates. The X-Next-Cursor header carries the token for the next
+    page. count=exact adds an X-Total-Count header; count=estimate reads it
+    from the counters when only batch/status filters are used and otherwise
+    counts at most TRANSACTIONS_COUNT_LIMIT documents.
+    """
+    query = {"user_id": user["id"]}
+    if batch_id:
+        query["batch_id"] = batch_id
+    if status:
+        query["status"] = status
+    if vendor_id:
+        query["vendor_id"] = vendor_id
+    if date_from or date_to:
+        query["transaction_date"] = {}
+        if date_from:
+            query["transaction_date"]["$gte"] = datetime.combine(date_from, datetime.min.time(), timezone.utc)
+        if date_to:
+            query["transaction_date"]["$lt"] = datetime.combine(date_to + timedelta(days=1), datetime.min.time(), timezone.utc)
+    if amount_min is not None or amount_max is not None:
+        query["amount_cents"] = {}
+        if amount_min is not None:
+            query["amount_cents"]["$gte"] = round(amount_min * 100)
+        if amount_max is not None:
+            query["amount_cents"]["$lte"] = round(amount_max * 100)
+    if q and q.strip():
+        pattern = {"$regex": re.escape(q.strip()), "$options": "i"}
+        query["$or"] = [{"primatelj": pattern}, {"opis_transakcije": pattern}]
+    
+    if count in ("exact", "estimate"):
+        total = None
+        if count == "estimate" and set(query) <= {"user_id", "batch_id", "status"}:
+            # Filtering on user_id keeps another user's batch counter out
+            counter = await db.counters.find_one({
+                "_id": f"batch:{batch_id}" if batch_id else f"user:{user['id']}",
+                "user_id": user["id"]
+            })
+            if counter:
+                total = counter.get("status", {}).get(status, 0) if status else counter.get("total", 0)
+        if total is None:
+            count_options = {"limit": TRANSACTIONS_COUNT_LIMIT} if count == "estimate" else {}
+            total = await db.transactions.count_documents(query, **count_options)
+        response.headers["X-Total-Count"] = str(total)
+    
+    if cursor:
+        query = {"$and": [query, transactions_after(cursor)]}
+    
+    limit = max(1, min(limit or TRANSACTIONS_PAGE_SIZE, TRANSACTIONS_MAX_PAGE_SIZE))
+    transactions = await db.transactions.find(
+        query, TRANSACTION_RESPONSE_PROJECTION
+    ).sort([("transaction_date", -1), ("id", -1)]).limit(limit).to_list(limit)
+    
+    if len(transactions) == limit:
+        response.headers["X-Next-Cursor"] = encode_transaction_cursor(transactions[-1])
+    return transactions
+
+@api_router.put("/transactions/{transaction_id}", response_model=TransactionResponse)
+async def update_transaction(
+    transaction_id: str,
+    data: TransactionUpdate,
+    user: dict = Depends(get_current_user)
+):
+    update_data = {k: v for k, v in data.model_dump().items() if v is not None}
+    if not update_data:
+        raise HTTPException(status_code=400, detail="Nema podataka za ažuriranje")
+    
+    before = await update_transaction_fields(
+        {"id": transaction_id, "user_id": user["id"]}, update_data, TRANSACTION_RESPONSE_PROJECTION
+    )
+    if before is None:
+        raise HTTPException(status_code=404, detail="Transakcija nije pronađena")
+    
+    # $set only touches top-level fields, so the result is the old document plus the update
+    transaction = {**before, **update_data}
+    if isinstance(transaction['created_at'], str):
+        transaction['created_at'] = datetime.fromisoformat(transaction['created_at'])
+    return TransactionResponse(**transaction)
+
+@api_router.patch("/transactions")
+async def bulk_update_transactions(
+    data: TransactionBulkUpdate,
+    user: dict = Depends(get_current_user)
+):
+    """Update many transactions at once with a single bulk write"""
+    writes = TransactionWriteBatch(user["id"])
+    for item in data.updates:
+        update_data = {k: v for k, v in item.model_dump(exclude={"id"}).items() if v is not None}
+        if update_data:
+            writes.update(item.id, update_data)
+    if not writes.updates:
+        raise HTTPException(status_code=400, detail="Nema podataka za ažuriranje")
+    
+    requested = list(writes.updates)
+    updated = await writes.flush()
+    transactions = []
+    for transaction in updated.values():
+        if isinstance(transaction['created_at'], str):
+            transaction['created_at'] = datetime.fromisoformat(transaction['created_at'])
+        transactions.append(TransactionResponse(**transaction))
+    return {
+        "updated": transactions,
+        "not_found": [transaction_id for transaction_id in requested if transaction_id not in updated]
+    }
+
+@api_router.delete("/transactions/{transaction_id}")
+async def delete_transaction(transaction_id: str, user: dict = Depends(get_current_user)):
+    """Delete a single transaction"""
+    deleted_count = await delete_transactions({"id": transaction_id, "user_id": user["id"]})
+    if deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Transakcija nije pronađena")
+    return {"message": "Transakcija obrisana"}
+
+class DeleteTransactionsRequest(BaseModel):
+    transaction_ids: List[str]
+
+@api_router.post("/transactions/delete-batch")
+async def delete_transactions_batch(request: DeleteTransactionsRequest, user: dict = Depends(get_current_user)):
+    """Delete multiple transactions"""
+    deleted_count = await delete_transactions({
+        "id": {"$in": request.transaction_ids},
+        "user_id": user["id"]
+    })
+    return {"message": f"Obrisano {deleted_count} transakcija", "deleted_count": deleted_count}
+
+@api_router.delete("/batches/{batch_id}")
+async def delete_batch(batch_id: str, user: dict = Depends(get_current_user)):
+    """Delete a batch and all its transactions"""
+    # Delete all transactions in batch
+    deleted_count = await delete_batch_transactions(user["id"], batch_id)
+    
+    # Delete batch record
+    batch_result = await db.batches.delete_one({"id": batch_id, "user_id": user["id"]})
+    
+    if batch_result.deleted_count == 0:
+        raise HTTPException(status_code=404, detail="Batch nije pronađen")
+    
+    return {"message": f"Batch obrisan ({deleted_count} transakcija)"}
+
+# ============== MIGRATIONS ==============
+
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', '1000'))
+
+async def backfill_typed_transaction_fields():
+    """Parse date and amount strings of transactions stored before typed fields existed"""
+    updated = 0
+    while True:
+        docs = await db.transactions.find(
+            {"amount_cents": {"$exists": False}},
+            {"_id": 1, "datum_izvrsenja": 1, "iznos": 1}
+        ).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+        if not docs:
+            return updated
+        await db.transactions.bulk_write([
+            UpdateOne(
+                {"_id": d["_id"]},
+                {"$set": typed_transaction_fields(d.get("datum_izvrsenja", ""), d.get("iznos", ""))}
+            )
+            for d in docs
+        ], ordered=False)
+        updated += len(docs)
+
+def _stage_file(path: str) -> Optional[tuple]:
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as src:
+        return blob_store.stage(lambda out: shutil.copyfileobj(src, out, ZIP_CHUNK_SIZE) or True)
+
+async def import_legacy_invoices():
+    """Move invoices saved as flat <user>_<transaction>_<name> files into the blob store"""
+    loop = asyncio.get_running_loop()
+    imported = 0
+    cursor = db.transactions.find(
+        {"invoice_path": {"$ne": None}, "invoice_sha256": {"$exists": False}},
+        {"_id": 1, "invoice_path": 1, "invoice_filename": 1}
+    )
+    async for t in cursor:
+        legacy_path = t["invoice_path"]
+        staged = await loop.run_in_executor(None, _stage_file, legacy_path)
+        if staged is None:
+            # File is gone, keep the record as it was
+            await db.transactions.update_one({"_id": t["_id"]}, {"$set": {"invoice_sha256": None}})
+            continue
+        tmp_path, digest, size, head = staged
+        path = await blob_store.commit(tmp_path, digest, size)
+        await db.transactions.update_one(
+            {"_id": t["_id"]},
+            {"$set": {
+                "invoice_path": str(path),
+                "invoice_sha256": digest,
+                "invoice_size": size,
+                "invoice_content_type": sniff_content_type(head, t.get("invoice_filename"))
+            }}
+        )
+        await loop.run_in_executor(None, lambda: Path(legacy_path).unlink(missing_ok=True))
+        imported += 1
+    return imported
+
+MIGRATIONS = [
+    ("typed_transaction_fields", backfill_typed_transaction_fields),
+    ("transaction_counters", reconcile_counters),
+    ("legacy_invoice_blobs", import_legacy_invoices),
+]
+
+async def run_migrations():
+    """Apply data migrations not yet recorded in the migrations collection.
+    
+    Migrations are idempotent, so several API nodes starting at once only
+    repeat work.
+    """
+    for name, migration in MIGRATIONS:
+        if await db.migrations.find_one({"name": name}):
+            continue
+        try:
+            result = await migration()
+        except Exception as e:
+            logger.error(f"Migration {name} failed: {e}")
+            return
+        await db.migrations.update_one(
+            {"name": name},
+            {"$set": {"name": name, "result": result, "completed_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+        logger.info(f"Migration {name} completed: {result}")
+
+# ============== DATABASE INDEXES ==============
+
+MONGO_ENSURE_INDEXES = os.environ.get('MONGO_ENSURE_INDEXES', 'true').lower() == 'true'
+
+# Every collection's indexes, matched to the filters and sorts of the
+# endpoints that use them. Applied idempotently at startup.
+INDEX_MANIFEST = {
+    "users": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("email", ASCENDING)], unique=True, name="email_unique"),
+        # Version stamp polled by UserCache when change streams are unavailable
+        IndexModel([("profile_updated_at", ASCENDING)], sparse=True, name="profile_updated"),
+    ],
+    "vendors": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("user_id", ASCENDING)], name="user"),
+    ],
+    "transactions": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        # /transactions, optionally filtered by batch or status, newest first
+        # (transaction_date, id) is also the keyset of the pagination cursor
+        IndexModel([("user_id", ASCENDING), ("transaction_date", DESCENDING), ("id", DESCENDING)], name="user_date"),
+        IndexModel([("user_id", ASCENDING), ("batch_id", ASCENDING), ("transaction_date", DESCENDING), ("id", DESCENDING)], name="user_batch_date"),
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("transaction_date", DESCENDING), ("id", DESCENDING)], name="user_status_date"),
+    ],
+    "batches": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_created"),
+    ],
+    "counters": [
+        IndexModel([("user_id", ASCENDING)], name="user"),
+    ],
+    "blobs": [
+        IndexModel([("sha256", ASCENDING)], unique=True, name="sha256_unique"),
+    ],
+    "migrations": [
+        IndexModel([("name", ASCENDING)], unique=True, name="name_unique"),
+    ],
+    "search_jobs": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_created"),
+    ],
+    "search_job_items": [
+        IndexModel([("id", ASCENDING)], unique=True, name="id_unique"),
+        IndexModel([("job_id", ASCENDING), ("seq", ASCENDING)], name="job_seq"),
+        # Workers claim pending items and items whose lease expired
+        IndexModel([("status", ASCENDING), ("lease_expires_at", ASCENDING)], name="status_lease"),
+    ],
+    "mail_index": [
+        IndexModel([("user_id", ASCENDING), ("folder", ASCENDING), ("uid", DESCENDING)], unique=True, name="user_folder_uid"),
+    ],
+    "mail_index_state": [
+        IndexModel([("user_id", ASCENDING), ("folder", ASCENDING)], unique=True, name="user_folder"),
+    ],
+    "mail_cache": [
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0, name="expires_ttl"),
+        IndexModel([("user_id", ASCENDING)], name="user"),
+    ],
+}
+
+async def ensure_indexes():
+    """Create the manifest's indexes; existing ones are left untouched"""
+    for collection, indexes in INDEX_MANIFEST.items():
+        try:
+            await db[collection].create_indexes(indexes)
+        except OperationFailure as e:
+            # e.g. duplicate emails blocking the unique index, or an index
+            # with the same keys but other options created by hand
+            logger.error(f"Creating indexes on {collection} failed: {e}")
+
+def query_probes(user_id: str) -> list:
+    """The hot queries of the API, as (name, collection, filter, sort)"""
+    sample_id = "00000000-0000-0000-0000-000000000000"
+    return [
+        ("users.by_id", "users", {"id": user_id}, None),
+        ("users.by_email", "users", {"email": "probe@example.com"}, None),
+        ("vendors.by_user", "vendors", {"user_id": user_id}, None),
+        ("vendors.by_id", "vendors", {"id": sample_id}, None),
+        ("transactions.list", "transactions", {"user_id": user_id}, {"transaction_date": -1, "id": -1}),
+        ("transactions.by_batch", "transactions", {"user_id": user_id, "batch_id": sample_id}, {"transaction_date": -1, "id": -1}),
+        ("transactions.by_status", "transactions", {"user_id": user_id, "status": "pending"}, {"transaction_date": -1, "id": -1}),
+        ("transactions.by_ids", "transactions", {"id": {"$in": [sample_id]}, "user_id": user_id}, None),
+        ("batches.list", "batches", {"user_id": user_id}, {"created_at": -1}),
+        ("batches.by_id", "batches", {"id": sample_id, "user_id": user_id}, None),
+        ("counters.by_user", "counters", {"user_id": user_id}, None),
+        ("search_jobs.list", "search_jobs", {"user_id": user_id}, {"created_at": -1}),
+        ("search_job_items.by_job", "search_job_items", {"job_id": sample_id}, {"seq": 1}),
+        ("search_job_items.claim", "search_job_items", search_job_claim_filter(datetime.now(timezone.utc)), {"_id": 1}),
+        ("mail_index.search", "mail_index", {"user_id": user_id, "folder": "INBOX", "subject": {"$regex": "probe"}}, {"uid": -1}),
+        ("mail_index_state.by_user", "mail_index_state", {"user_id": user_id, "folder": "INBOX"}, None),
+    ]
+
+def _plan_stages(plan) -> list:
+    """All stage names in an explain plan tree"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+async def explain_query_probes(user_id: str) -> list:
+    """Winning plan of every hot query, flagging collection scans"""
+    report = []
+    for name, collection, query, sort in query_probes(user_id):
+        command = {"find": collection, "filter": query}
+        if sort:
+            command["sort"] = sort
+        explain = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        winning = explain.get("queryPlanner", {}).get("winningPlan", {})
+        stages = _plan_stages(winning)
+        report.append({
+            "query": name,
+            "collection": collection,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages
+        })
+    return report
+
+@api_router.get("/diagnostics/query-plans")
+async def get_query_plans(user: dict = Depends(get_admin_user)):
+    """Explain the API's hot queries and list those that scan a whole collection"""
+    report = await explain_query_probes(user["id"])
+    return {
+        "collscans": [r["query"] for r in report if r["collscan"]],
+        "queries": report
+    }
+
+# ============== STATS ==============
+
+@api_router.get("/stats")
+async def get_stats(user: dict = Depends(get_current_user)):
+    counters = await get_user_counters(user["id"])
+    status_counts = counters.get("status", {})
+    
+    return {
+        "total_transactions": counters.get("total", 0),
+        "pending": status_counts.get("pending", 0),
+        "downloaded": sum(status_counts.get(s, 0) for s in DOWNLOADED_STATUSES),
+        "manual": status_counts.get("manual", 0),
+        "total_amount": round(abs(counters.get("amount_cents", 0)) / 100, 2),
         "vendors_count": await db.vendors.count_documents({"user_id": user["id"]})
     }
 
 # ============== EXPORT ==============
 
-@api_router.get("/export/csv/{batch_id}")
-async def export_csv(batch_id: str, user: dict = Depends(get_current_user)):
-    transactions = await db.transactions.find(
-        {"batch_id": batch_id, "user_id": user["id"]},
-        {"_id": 0}
-    ).to_list(10000)
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '500'))
+EXPORT_FLUSH_BYTES = 64 * 1024
+
+EXPORT_STATUS_LABELS = {
+    "pending": "Čeka",
+    "found": "Pronađen",
+    "downloaded": "Preuzet",
+    "manual": "Ručno"
+}
+
+# Exportable columns: key -> (header, value getter)
+EXPORT_COLUMNS = {
+    "datum": ("Datum izvršenja", lambda t: t.get("datum_izvrsenja", "")),
+    "primatelj": ("Primatelj", lambda t: t.get("primatelj", "")),
+    "opis": ("Opis transakcije", lambda t: t.get("opis_transakcije", "")),
+    "iznos": ("Iznos", lambda t: t.get("iznos", "")),
+    "status": ("Status", lambda t: EXPORT_STATUS_LABELS.get(t.get("status", ""), "")),
+    "racun_preuzet": ("Račun preuzet", lambda t: "Da" if t.get("invoice_filename") else "Ne"),
+    "link": ("Link računa", lambda t: t.get("invoice_url", "")),
+}
+
+EXPORT_DELIMITERS = {",": ",", ";": ";", "comma": ",", "semicolon": ";", "tab": "\t", "\t": "\t"}
+
+async def stream_transactions_csv(query: dict, columns: list, delimiter: str, bom: bool):
+    """Yield the CSV export chunk by chunk while the cursor is read"""
+    getters = [EXPORT_COLUMNS[c][1] for c in columns]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter)
     
-    if not transactions:
-        raise HTTPException(status_code=404, detail="Nema transakcija za export")
+    def take() -> bytes:
+        data = buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+        return data
     
-    output = io.StringIO()
-    writer = csv.writer(output)
+    writer.writerow([EXPORT_COLUMNS[c][0] for c in columns])
+    # The header goes out at once so the download starts immediately
+    yield (codecs.BOM_UTF8 if bom else b"") + take()
     
-    # Header
-    writer.writerow([
-        "Datum izvršenja",
-        "Primatelj",
-        "Opis transakcije",
-        "Iznos",
-        "Status",
-        "Račun preuzet",
-        "Link računa"
-    ])
+    cursor = db.transactions.find(query, {"_id": 0}, batch_size=EXPORT_BATCH_SIZE)
+    try:
+        async for t in cursor:
+            writer.writerow([get(t) for get in getters])
+            if buffer.tell() >= EXPORT_FLUSH_BYTES:
+                yield take()
+    finally:
+        await cursor.close()
     
-    for t in transactions:
-        status_map = {
-            "pending": "Čeka",
-            "found": "Pronađen",
-            "downloaded": "Preuzet",
-            "manual": "Ručno"
-        }
-        writer.writerow([
-            t.get("datum_izvrsenja", ""),
-            t.get("primatelj", ""),
-            t.get("opis_transakcije", ""),
-            t.get("iznos", ""),
-            status_map.get(t.get("status", ""), ""),
-            "Da" if t.get("invoice_filename") else "Ne",
-            t.get("invoice_url", "")
-        ])
+    if buffer.tell():
+        yield take()
+
+@api_router.get("/export/csv/{batch_id}")
+async def export_csv(
+    batch_id: str,
+    columns: Optional[str] = None,
+    delimiter: str = ",",
+    bom: bool = False,
+    user: dict = Depends(get_current_user)
+):
+    """Stream a batch's transactions as CSV.
+    
+    `columns` is a comma-separated subset of EXPORT_COLUMNS keys (all by
+    default), `delimiter` one of , ; or tab, and `bom` prefixes a UTF-8
+    byte order mark so Excel detects the encoding.
+    """
+    selected = [c.strip() for c in columns.split(",") if c.strip()] if columns else list(EXPORT_COLUMNS)
+    unknown = [c for c in selected if c not in EXPORT_COLUMNS]
+    if unknown or not selected:
+        raise HTTPException(status_code=400, detail=f"Nepoznati stupci: {', '.join(unknown)}")
+    if delimiter not in EXPORT_DELIMITERS:
+        raise HTTPException(status_code=400, detail="Nepodržani razdjelnik")
+    
+    query = {"batch_id": batch_id, "user_id": user["id"]}
+    if not await db.transactions.find_one(query, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Nema transakcija za export")
+    
+    batch = await db.batches.find_one({"id": batch_id, "user_id": user["id"]}, {"_id": 0})
+    batch_name = f"{batch['month']}_{batch['year']}" if batch else batch_id[:8]
     
-    output.seek(0)
     return StreamingResponse(
-    zip_stream,
-    media_type="application/zip",
-    headers={
-        "Content-Disposition": f"attachment; filename=racuni_{batch_name}.zip"
-    },
-)
+        stream_transactions_csv(query, selected, EXPORT_DELIMITERS[delimiter], bom),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f"attachment; filename=transakcije_{batch_name}.csv"}
+    )
 
 
 # ============== ZOHO MAIL IMAP INTEGRATION ==============
@@ -646,11 +2099,451 @@ async def export_csv(batch_id: str, user: dict = Depends(get_current_user)):
 import imaplib
 import email
 from email.header import decode_header
-import base64
+import socket
+import unicodedata
+import binascii
+from urllib.parse import quote, unquote
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Directory for storing downloaded invoices
+INVOICES_DIR = ROOT_DIR / "invoices"
+INVOICES_DIR.mkdir(exist_ok=True)
+
+# ============== INVOICE STORAGE ==============
+
+CONTENT_SNIFF_BYTES = 1024
+CONTENT_SIGNATURES = [
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"<?xml", "application/xml"),
+]
+
+def sniff_content_type(head: bytes, filename: str = None) -> str:
+    """Media type from a file's first bytes, falling back to its extension"""
+    for signature, content_type in CONTENT_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    # Some generators put junk before the PDF header, readers accept it within 1 KiB
+    if b"%PDF-" in head[:CONTENT_SNIFF_BYTES]:
+        return "application/pdf"
+    return mimetypes.guess_type(filename or "")[0] or "application/octet-stream"
+
+class _HashingWriter:
+    """File wrapper that hashes everything written through it"""
+    
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+    
+    def write(self, data) -> int:
+        self.sha256.update(data)
+        if len(self.head) < CONTENT_SNIFF_BYTES:
+            self.head += bytes(data[:CONTENT_SNIFF_BYTES - len(self.head)])
+        self.size += len(data)
+        return self.f.write(data)
+
+class BlobStore:
+    """Content-addressed invoice files with reference counts in MongoDB.
+    
+    A blob lives at <root>/<sha[0:2]>/<sha[2:4]>/<sha>, so identical invoices
+    are stored once and no directory grows past a few hundred entries.
+    Content is first staged to <root>/tmp while it is hashed, then renamed
+    into place when a reference to it is committed. Reference changes and
+    file removal for a digest are serialised by a striped lock within a
+    process; across processes the blobs collection decides: only the
+    release that deletes the zero-refcount document removes the file, and
+    puts it back if a commit took a new reference meanwhile.
+    """
+    
+    LOCK_STRIPES = 64
+    
+    def __init__(self, root: Path):
+        self.root = root
+        self.tmp_dir = root / "tmp"
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._locks = [asyncio.Lock() for _ in range(self.LOCK_STRIPES)]
+    
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / digest
+    
+    def _lock(self, digest: str) -> asyncio.Lock:
+        return self._locks[int(digest[:4], 16) % self.LOCK_STRIPES]
+    
+    def stage(self, produce) -> Optional[tuple]:
+        """Run produce(out) into a temp file; returns (tmp_path, sha256, size, head).
+        
+        produce returns None when there is nothing to store, which is passed
+        on. Blocking, run it in a worker thread.
+        """
+        tmp_path = self.tmp_dir / f"{uuid.uuid4()}.part"
+        try:
+            with open(tmp_path, 'wb') as f:
+                out = _HashingWriter(f)
+                if produce(out) is None:
+                    return None
+                f.flush()
+                os.fsync(f.fileno())
+            staged = (tmp_path, out.sha256.hexdigest(), out.size, out.head)
+            tmp_path = None
+            return staged
+        finally:
+            if tmp_path is not None and tmp_path.exists():
+                tmp_path.unlink()
+    
+    def _place(self, tmp_path: Path, digest: str):
+        # Always replace: a concurrent release may be removing the old file
+        final = self.path(digest)
+        final.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, final)
+    
+    async def commit(self, tmp_path: Path, digest: str, size: int) -> Path:
+        """Take a reference to staged content and move it into place"""
+        loop = asyncio.get_running_loop()
+        async with self._lock(digest):
+            await db.blobs.update_one(
+                {"sha256": digest},
+                {
+                    "$inc": {"refcount": 1},
+                    "$setOnInsert": {"size": size, "created_at": datetime.now(timezone.utc).isoformat()}
+                },
+                upsert=True
+            )
+            await loop.run_in_executor(None, self._place, tmp_path, digest)
+        return self.path(digest)
+    
+    async def release(self, digest: str, count: int = 1):
+        """Drop references; the file is removed with the last one"""
+        loop = asyncio.get_running_loop()
+        async with self._lock(digest):
+            blob = await db.blobs.find_one_and_update(
+                {"sha256": digest},
+                {"$inc": {"refcount": -count}},
+                return_document=ReturnDocument.AFTER
+            )
+            if blob is None or blob["refcount"] > 0:
+                return
+            result = await db.blobs.delete_one({"sha256": digest, "refcount": {"$lte": 0}})
+            if not result.deleted_count:
+                return
+            
+            # Move the file aside first, so a commit that lands meanwhile
+            # either finds it gone and places its own copy, or is seen below
+            path = self.path(digest)
+            grave = self.tmp_dir / f"{uuid.uuid4()}.gone"
+            try:
+                await loop.run_in_executor(None, os.replace, path, grave)
+            except FileNotFoundError:
+                return
+            if await db.blobs.find_one({"sha256": digest}, {"_id": 1}):
+                await loop.run_in_executor(None, os.replace, grave, path)
+            else:
+                await loop.run_in_executor(None, grave.unlink)
+
+blob_store = BlobStore(INVOICES_DIR / "blobs")
+
+async def attach_invoice(query: dict, staged: tuple, filename: str) -> Optional[dict]:
+    """Point a transaction at a staged invoice and mark it downloaded.
+    
+    Returns the transaction as it was before, None if it does not exist (the
+    staged content is then discarded). A previously attached invoice is
+    released.
+    """
+    tmp_path, digest, size, head = staged
+    if not await db.transactions.find_one(query, {"_id": 1}):
+        tmp_path.unlink(missing_ok=True)
+        return None
+    path = await blob_store.commit(tmp_path, digest, size)
+    before = await db.transactions.find_one_and_update(
+        query,
+        {"$set": {
+            "status": "downloaded",
+            "invoice_filename": filename,
+            "invoice_path": str(path),
+            "invoice_sha256": digest,
+            "invoice_size": size,
+            "invoice_content_type": sniff_content_type(head, filename)
+        }},
+        projection={"_id": 0, "user_id": 1, "batch_id": 1, "status": 1, "invoice_sha256": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        # Deleted in the meantime
+        await blob_store.release(digest)
+        return None
+    await record_status_change(before, "downloaded")
+    if before.get("invoice_sha256"):
+        await blob_store.release(before["invoice_sha256"])
+    return before
+
+async def release_invoices(transactions: list):
+    """Release the invoices referenced by deleted transactions"""
+    counts = {}
+    for t in transactions:
+        if t.get("invoice_sha256"):
+            counts[t["invoice_sha256"]] = counts.get(t["invoice_sha256"], 0) + 1
+    for digest, count in counts.items():
+        await blob_store.release(digest, count)
+
+# ============== IMAP RESPONSE PARSING ==============
+
+_IMAP_LITERAL = re.compile(rb'\{(\d+)\}$')
+_IMAP_OPEN = object()
+_IMAP_CLOSE = object()
+
+def _imap_tokens(data: list) -> list:
+    """Tokenize imaplib response data.
+    
+    imaplib returns (line, literal) tuples for {n} literals and plain bytes
+    for the remaining line fragments; literals come out as bytes, quoted
+    strings and atoms as str, NIL as None. Atoms carrying a [section], such
+    as BODY[HEADER.FIELDS (FROM)], are kept whole.
+    """
+    tokens = []
+    for item in data:
+        if isinstance(item, tuple):
+            text, literal = item
+            text = _IMAP_LITERAL.sub(b'', text)
+        else:
+            text, literal = item or b'', None
+        
+        i, n = 0, len(text)
+        while i < n:
+            c = text[i]
+            if c in b' \r\n':
+                i += 1
+            elif c == ord('('):
+                tokens.append(_IMAP_OPEN)
+                i += 1
+            elif c == ord(')'):
+                tokens.append(_IMAP_CLOSE)
+                i += 1
+            elif c == ord('"'):
+                i += 1
+                value = bytearray()
+                while i < n and text[i] != ord('"'):
+                    if text[i] == ord('\\'):
+                        i += 1
+                    value.append(text[i])
+                    i += 1
+                i += 1
+                tokens.append(value.decode('utf-8', errors='replace'))
+            else:
+                start = i
+                depth = 0
+                while i < n:
+                    c = text[i]
+                    if c == ord('['):
+                        depth += 1
+                    elif c == ord(']'):
+                        depth -= 1
+                    elif depth == 0 and c in b' ()\r\n':
+                        break
+                    i += 1
+                atom = text[start:i].decode('utf-8', errors='replace')
+                tokens.append(None if atom.upper() == 'NIL' else atom)
+        
+        if literal is not None:
+            tokens.append(literal)
+    return tokens
+
+def parse_imap_response(data: list) -> list:
+    """Parse imaplib response data into nested Python lists"""
+    root = []
+    stack = [root]
+    for token in _imap_tokens(data):
+        if token is _IMAP_OPEN:
+            stack.append([])
+        elif token is _IMAP_CLOSE:
+            if len(stack) > 1:
+                closed = stack.pop()
+                stack[-1].append(closed)
+        else:
+            stack[-1].append(token)
+    return root
+
+def parse_fetch_response(data: list) -> list:
+    """Split a FETCH response into one {ITEM: value} dict per message"""
+    messages = []
+    parsed = parse_imap_response(data)
+    for i, value in enumerate(parsed):
+        if isinstance(value, list) and i > 0:
+            items = {}
+            for j in range(0, len(value) - 1, 2):
+                key = value[j]
+                if isinstance(key, str):
+                    items[key.upper()] = value[j + 1]
+            messages.append(items)
+    return messages
+
+def decode_mime_header(value) -> str:
+    """Decode an RFC 2047 encoded header value (subject, filename) to text"""
+    if not value:
+        return ""
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', errors='ignore')
+    decoded = ""
+    for part, encoding in decode_header(value):
+        if isinstance(part, bytes):
+            decoded += part.decode(encoding or 'utf-8', errors='ignore')
+        else:
+            decoded += part
+    return decoded
+
+def _bodystructure_params(params) -> dict:
+    """Turn a BODYSTRUCTURE parameter list into a dict, joining RFC 2231 continuations"""
+    result = {}
+    if not isinstance(params, list):
+        return result
+    for i in range(0, len(params) - 1, 2):
+        if isinstance(params[i], str):
+            value = params[i + 1]
+            result[params[i].lower()] = value.decode('utf-8', errors='ignore') if isinstance(value, bytes) else (value or "")
+    
+    for name in ("filename", "name"):
+        if f"{name}*" in result:
+            # RFC 2231 extended value: charset'language'percent-encoded-text
+            encoded = result[f"{name}*"]
+        elif f"{name}*0*" in result or f"{name}*0" in result:
+            # RFC 2231 continuations, possibly extended
+            pieces = []
+            n = 0
+            while f"{name}*{n}*" in result or f"{name}*{n}" in result:
+                pieces.append(result.get(f"{name}*{n}*", result.get(f"{name}*{n}")))
+                n += 1
+            encoded = "".join(pieces)
+            if f"{name}*0*" not in result:
+                result[name] = encoded
+                continue
+        else:
+            continue
+        charset, _, rest = encoded.partition("'")
+        _, _, text = rest.partition("'")
+        result[name] = unquote(text, encoding=charset or 'utf-8', errors='replace') if rest else unquote(encoded)
+    return result
+
+def parse_bodystructure(structure, prefix: str = "") -> list:
+    """Flatten a parsed BODYSTRUCTURE into leaf part descriptors.
+    
+    Each descriptor has the IMAP part number (usable in BODY[<part>]), MIME
+    type, transfer encoding, size in octets as transferred and the decoded
+    filename, if the part has one. Attached messages (message/rfc822) are
+    reported as a single part and not descended into.
+    """
+    if not isinstance(structure, list) or not structure:
+        return []
+    
+    if isinstance(structure[0], list):
+        # Multipart: child bodies first, then the subtype and extension data
+        parts = []
+        n = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            n += 1
+            parts.extend(parse_bodystructure(child, f"{prefix}.{n}" if prefix else str(n)))
+        return parts
+    
+    def field(index):
+        return structure[index] if len(structure) > index else None
+    
+    maintype = (field(0) or "").lower()
+    subtype = (field(1) or "").lower()
+    content_params = _bodystructure_params(field(2))
+    try:
+        size = int(field(6) or 0)
+    except (TypeError, ValueError):
+        size = 0
+    
+    # Position of the disposition in the extension data depends on the body type
+    if maintype == "text":
+        disposition_index = 9
+    elif maintype == "message" and subtype == "rfc822":
+        disposition_index = 11
+    else:
+        disposition_index = 8
+    disposition = field(disposition_index)
+    disposition_type = ""
+    disposition_params = {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = (disposition[0] or "").lower() if isinstance(disposition[0], str) else ""
+        disposition_params = _bodystructure_params(disposition[1] if len(disposition) > 1 else None)
+    
+    filename = disposition_params.get("filename") or content_params.get("name") or ""
+    return [{
+        "part": prefix or "1",
+        "content_type": f"{maintype}/{subtype}",
+        "encoding": (field(5) or "7bit").lower() if isinstance(field(5), str) else "7bit",
+        "size": size,
+        "disposition": disposition_type,
+        "filename": decode_mime_header(filename)
+    }]
+
+def attachments_from_bodystructure(structure) -> list:
+    """Attachment listing (the shape get_email_attachments returns) from a parsed BODYSTRUCTURE"""
+    attachments = []
+    for part in parse_bodystructure(structure):
+        if not part["filename"]:
+            continue
+        attachments.append({
+            "filename": part["filename"],
+            "content_type": part["content_type"],
+            "is_pdf": part["content_type"] == 'application/pdf' or part["filename"].lower().endswith('.pdf'),
+            "part": part["part"],
+            "size": part["size"],
+            "encoding": part["encoding"]
+        })
+    return attachments
 
-# Directory for storing downloaded invoices
-INVOICES_DIR = ROOT_DIR / "invoices"
-INVOICES_DIR.mkdir(exist_ok=True)
+class TransferDecoder:
+    """Incrementally decodes a Content-Transfer-Encoding over arbitrary chunks.
+    
+    Base64 input is decoded in whole 4-character groups and quoted-printable
+    input line by line; whatever is left over waits for the next chunk.
+    """
+    
+    def __init__(self, encoding: str):
+        self.encoding = (encoding or "7bit").lower()
+        self._pending = b""
+    
+    def decode(self, chunk: bytes) -> bytes:
+        if self.encoding == "base64":
+            data = self._pending + re.sub(rb'[^A-Za-z0-9+/=]', b'', chunk)
+            usable = len(data) - len(data) % 4
+            self._pending = data[usable:]
+            return binascii.a2b_base64(data[:usable]) if usable else b""
+        if self.encoding == "quoted-printable":
+            data = self._pending + chunk
+            end = data.rfind(b"\n") + 1
+            self._pending = data[end:]
+            return binascii.a2b_qp(data[:end]) if end else b""
+        return chunk
+    
+    def flush(self) -> bytes:
+        data, self._pending = self._pending, b""
+        if not data:
+            return b""
+        if self.encoding == "base64":
+            return binascii.a2b_base64(data + b"=" * (-len(data) % 4))
+        if self.encoding == "quoted-printable":
+            return binascii.a2b_qp(data)
+        return data
+
+def parse_internaldate(value) -> Optional[datetime]:
+    """Parse an IMAP INTERNALDATE ("17-Jul-1996 02:44:25 -0700")"""
+    if not isinstance(value, str):
+        return None
+    try:
+        return datetime.strptime(value.strip(), "%d-%b-%Y %H:%M:%S %z")
+    except ValueError:
+        return None
 
 class ZohoMailClient:
     """Zoho Mail IMAP Client for fetching emails and attachments"""
@@ -663,11 +2556,13 @@ class ZohoMailClient:
         "au": "imap.zoho.com.au"
     }
     IMAP_PORT = 993
+    IMAP_TIMEOUT = int(os.environ.get('IMAP_SOCKET_TIMEOUT', '30'))  # seconds per socket read
     
     def __init__(self, email_address: str, app_password: str, region: str = None):
         self.email_address = email_address
         self.app_password = app_password
         self.connection = None
+        self.selected_folder = None
         # Auto-detect region from email domain or use provided
         if region:
             self.region = region
@@ -684,9 +2579,14 @@ class ZohoMailClient:
             try:
                 server = self.IMAP_SERVERS[region]
                 logger.info(f"Trying IMAP server: {server}")
-                self.connection = imaplib.IMAP4_SSL(server, self.IMAP_PORT)
+                self.connection = imaplib.IMAP4_SSL(server, self.IMAP_PORT, timeout=self.IMAP_TIMEOUT)
+                if metrics:
+                    metrics.instrument_imap(self.connection)
                 self.connection.login(self.email_address, self.app_password)
                 logger.info(f"Successfully connected to {server}")
+                # Remember the working region so reconnects go straight to it
+                self.region = region
+                self.selected_folder = None
                 return True
             except imaplib.IMAP4.error as e:
                 logger.error(f"IMAP login failed on {server}: {e}")
@@ -712,16 +2612,30 @@ class ZohoMailClient:
                 self.connection.logout()
             except:
                 pass
+        self.connection = None
+        self.selected_folder = None
+    
+    def is_alive(self) -> bool:
+        """Health check an open session with NOOP"""
+        if not self.connection:
+            return False
+        try:
+            status, _ = self.connection.noop()
+            return status == 'OK'
+        except (imaplib.IMAP4.error, OSError):
+            return False
     
-    def search_emails(self, search_term: str, date_from: str = None, date_to: str = None, folder: str = "INBOX", ignore_date: bool = False):
-        """Search for emails containing the search term"""
+    def select_folder(self, folder: str = "INBOX"):
+        """SELECT a folder, skipping the round-trip if it is already selected"""
         if not self.connection:
             self.connect()
-        
-        self.connection.select(folder)
-        
-        # Sanitize search term - remove special characters that break IMAP
-        import unicodedata
+        if self.selected_folder != folder:
+            self.connection.select(folder)
+            self.selected_folder = folder
+    
+    @staticmethod
+    def sanitize_search_term(search_term: str) -> str:
+        """Sanitize search term - remove special characters that break IMAP"""
         safe_search = ''.join(
             c for c in search_term 
             if unicodedata.category(c) not in ('Mn', 'Mc', 'Me') and ord(c) < 128
@@ -735,198 +2649,1049 @@ class ZohoMailClient:
                 if safe_word and len(safe_word) > 2:
                     safe_search = safe_word
                     break
+        return safe_search
+    
+    SEARCH_RESULT_LIMIT = 20  # newest matches kept per term
+    SEARCH_CANDIDATE_LIMIT = 100  # newest matches of a combined search whose headers are fetched
+    
+    @staticmethod
+    def build_search_query(terms: list, date_from: str = None, date_to: str = None) -> str:
+        """One SEARCH matching any of the terms in SUBJECT or FROM.
         
-        if not safe_search:
-            logger.warning(f"Could not create safe search term from: {search_term}")
-            return []
+        ["HEP", "A1"] becomes
+        OR (OR SUBJECT "HEP" FROM "HEP") (OR SUBJECT "A1" FROM "A1"), followed
+        by SINCE/BEFORE when a date window is given.
+        """
+        def quote(term):
+            return '"' + term.replace('\\', '\\\\').replace('"', '\\"') + '"'
         
-        logger.info(f"Searching for: '{safe_search}' (original: '{search_term}')")
+        clauses = [f'OR SUBJECT {quote(t)} FROM {quote(t)}' for t in terms]
+        query = clauses[-1]
+        for clause in reversed(clauses[:-1]):
+            query = f'OR ({clause}) ({query})'
+        if date_from:
+            query += f' SINCE {date_from}'
+        if date_to:
+            query += f' BEFORE {date_to}'
+        return query
+    
+    def search_emails_multi(self, search_terms: list, date_from: str = None, date_to: str = None, folder: str = "INBOX", ignore_date: bool = False) -> list:
+        """Search several terms at once; returns one result list per term, in order.
         
-        # Try multiple search strategies
-        all_results = []
-        seen_ids = set()
+        All terms go into a single OR-combined UID SEARCH and the headers
+        (plus BODYSTRUCTURE, so results carry their attachment listing) of
+        the newest SEARCH_CANDIDATE_LIMIT candidates come back in a single
+        UID FETCH. Each term then keeps its newest SEARCH_RESULT_LIMIT
+        matches. When the combined search finds more candidates than that,
+        each term is searched on its own and capped separately, so a busy
+        term cannot hide another's older matches. Terms with nothing inside
+        the date window are retried together without it, so a search
+        usually costs 2-4 round-trips however many terms it has.
         
-        # Strategy 1: Search in SUBJECT
-        try:
-            search_str = f'SUBJECT "{safe_search}"'
-            if not ignore_date and date_from:
-                search_str += f' SINCE {date_from}'
-            if not ignore_date and date_to:
-                search_str += f' BEFORE {date_to}'
-            
-            status, messages = self.connection.search(None, search_str)
-            if status == 'OK' and messages[0]:
-                for eid in messages[0].split()[-10:]:
-                    if eid not in seen_ids:
-                        seen_ids.add(eid)
-                        all_results.append(eid)
-        except Exception as e:
-            logger.error(f"Subject search error: {e}")
+        Returned email_id values are UIDs, so they stay valid for later
+        attachment listing and download even if the mailbox changes.
+        """
+        self.select_folder(folder)
         
-        # Strategy 2: Search in FROM
-        try:
-            search_str = f'FROM "{safe_search}"'
-            if not ignore_date and date_from:
-                search_str += f' SINCE {date_from}'
-            if not ignore_date and date_to:
-                search_str += f' BEFORE {date_to}'
+        safe_terms = []
+        for term in search_terms:
+            safe_search = self.sanitize_search_term(term)
+            if safe_search:
+                logger.info(f"Searching for: '{safe_search}' (original: '{term}')")
+            else:
+                logger.warning(f"Could not create safe search term from: {term}")
+            safe_terms.append(safe_search)
+        
+        matches = [[] for _ in search_terms]
+        records = {}
+        
+        def uid_search(terms: list, with_date: bool) -> list:
+            query = self.build_search_query(
+                terms,
+                date_from if with_date else None,
+                date_to if with_date else None
+            )
+            status, messages = self.connection.uid('SEARCH', query)
+            if status != 'OK' or not messages or not messages[0]:
+                return []
+            return [int(u) for u in messages[0].split()]
+        
+        def run(indices: list, with_date: bool):
+            terms = list(dict.fromkeys(safe_terms[i] for i in indices))
+            uids = uid_search(terms, with_date)
+            if len(uids) > self.SEARCH_CANDIDATE_LIMIT and len(terms) > 1:
+                # One busy term would crowd the others out of the newest
+                # candidates, so search each term on its own instead
+                candidates = {
+                    term: uid_search([term], with_date)[-self.SEARCH_CANDIDATE_LIMIT:]
+                    for term in terms
+                }
+            else:
+                candidates = dict.fromkeys(terms, uids[-self.SEARCH_CANDIDATE_LIMIT:])
+            wanted = sorted(set().union(*candidates.values()) - records.keys())
+            for record in self.fetch_index_records(wanted, folder):
+                records[record["uid"]] = record
             
-            status, messages = self.connection.search(None, search_str)
-            if status == 'OK' and messages[0]:
-                for eid in messages[0].split()[-10:]:
-                    if eid not in seen_ids:
-                        seen_ids.add(eid)
-                        all_results.append(eid)
-        except Exception as e:
-            logger.error(f"From search error: {e}")
+            # Attribute candidates to the terms they match, as SUBJECT/FROM would
+            for i in indices:
+                needle = safe_terms[i].casefold()
+                matched = [
+                    u for u in candidates[safe_terms[i]]
+                    if u in records and (
+                        needle in records[u]["subject"].casefold()
+                        or needle in records[u]["from_search"]
+                    )
+                ]
+                matches[i] = matched[-self.SEARCH_RESULT_LIMIT:]
         
-        # Strategy 3: If no results with date, try without date filter
-        if not all_results and (date_from or date_to):
+        def timed_run(indices: list, with_date: bool):
+            started = time.perf_counter()
             try:
-                # Try subject without date
-                status, messages = self.connection.search(None, f'SUBJECT "{safe_search}"')
-                if status == 'OK' and messages[0]:
-                    for eid in messages[0].split()[-10:]:
-                        if eid not in seen_ids:
-                            seen_ids.add(eid)
-                            all_results.append(eid)
-                
-                # Try from without date
-                status, messages = self.connection.search(None, f'FROM "{safe_search}"')
-                if status == 'OK' and messages[0]:
-                    for eid in messages[0].split()[-10:]:
-                        if eid not in seen_ids:
-                            seen_ids.add(eid)
-                            all_results.append(eid)
-            except Exception as e:
-                logger.error(f"No-date search error: {e}")
+                run(indices, with_date)
+            finally:
+                metrics.mail_search_strategy_duration.labels(
+                    "date_window" if with_date else ("no_date_window" if dated else "undated")
+                ).observe(time.perf_counter() - started)
         
-        # Limit results
-        email_ids = all_results[-20:]
-        logger.info(f"Found {len(email_ids)} emails for '{safe_search}'")
+        active = [i for i, t in enumerate(safe_terms) if t]
+        dated = not ignore_date and bool(date_from or date_to)
+        search = timed_run if metrics else run
+        try:
+            if active:
+                search(active, dated)
+            # If no results with date, try without date filter
+            retry = [i for i in active if not matches[i]]
+            if dated and retry:
+                search(retry, False)
+        except Exception as e:
+            # Not "no matches": callers decide whether to retry or report it
+            logger.error(f"Search error: {e}")
+            raise
         
         results = []
-        for email_id in email_ids:
-            try:
-                status, msg_data = self.connection.fetch(email_id, '(RFC822.HEADER)')
-                if status != 'OK':
-                    continue
-                
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        
-                        # Decode subject
-                        subject = ""
-                        if msg["Subject"]:
-                            decoded = decode_header(msg["Subject"])
-                            for part, encoding in decoded:
-                                if isinstance(part, bytes):
-                                    subject += part.decode(encoding or 'utf-8', errors='ignore')
-                                else:
-                                    subject += part
-                        
-                        # Get from address
-                        from_addr = msg.get("From", "")
-                        
-                        # Get date
-                        date_str = msg.get("Date", "")
-                        
-                        # Add to results (no additional filtering - IMAP already filtered)
-                        results.append({
-                            "email_id": email_id.decode() if isinstance(email_id, bytes) else str(email_id),
-                            "subject": subject,
-                            "from": from_addr,
-                            "date": date_str
-                        })
-            except Exception as e:
-                logger.error(f"Error parsing email {email_id}: {e}")
-                continue
-        
+        for i, uids in enumerate(matches):
+            if safe_terms[i]:
+                logger.info(f"Found {len(uids)} emails for '{safe_terms[i]}'")
+            results.append([
+                {
+                    "email_id": str(uid),
+                    "subject": records[uid]["subject"],
+                    "from": records[uid]["from"],
+                    "date": records[uid]["date"],
+                    "attachments": records[uid]["attachments"],
+                    "has_pdf": records[uid]["has_pdf"]
+                }
+                for uid in uids
+            ])
         return results
     
     def get_email_attachments(self, email_id: str, folder: str = "INBOX"):
-        """Get list of attachments from an email"""
-        if not self.connection:
-            self.connect()
+        """Get list of attachments from an email.
         
-        self.connection.select(folder)
+        Only the BODYSTRUCTURE is fetched, so listing costs a few hundred
+        bytes however large the attachments are. Each entry carries the
+        IMAP part number, MIME type and size of the part.
+        """
+        self.select_folder(folder)
         
         try:
-            status, msg_data = self.connection.fetch(email_id.encode(), '(RFC822)')
+            status, msg_data = self.connection.uid('FETCH', email_id, '(UID BODYSTRUCTURE)')
             if status != 'OK':
                 return []
             
-            attachments = []
-            for response_part in msg_data:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_bytes(response_part[1])
-                    
-                    for part in msg.walk():
-                        if part.get_content_maintype() == 'multipart':
-                            continue
-                        
-                        filename = part.get_filename()
-                        if filename:
-                            # Decode filename if needed
-                            decoded = decode_header(filename)
-                            decoded_filename = ""
-                            for part_text, encoding in decoded:
-                                if isinstance(part_text, bytes):
-                                    decoded_filename += part_text.decode(encoding or 'utf-8', errors='ignore')
-                                else:
-                                    decoded_filename += part_text
-                            
-                            content_type = part.get_content_type()
-                            attachments.append({
-                                "filename": decoded_filename,
-                                "content_type": content_type,
-                                "is_pdf": content_type == 'application/pdf' or decoded_filename.lower().endswith('.pdf')
-                            })
-            
-            return attachments
+            for item in parse_fetch_response(msg_data):
+                if 'BODYSTRUCTURE' in item:
+                    return attachments_from_bodystructure(item['BODYSTRUCTURE'])
+            return []
         except Exception as e:
             logger.error(f"Error getting attachments: {e}")
             return []
     
-    def download_attachment(self, email_id: str, attachment_filename: str, folder: str = "INBOX") -> Optional[bytes]:
-        """Download a specific attachment from an email"""
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # octets per partial BODY fetch
+    
+    def find_attachment_part(self, email_id: str, attachment_filename: str = None, part: str = None, folder: str = "INBOX") -> Optional[dict]:
+        """Locate an attachment by IMAP part number or by filename"""
+        for attachment in self.get_email_attachments(email_id, folder):
+            if part and attachment["part"] == part:
+                return attachment
+            if not part and attachment["filename"] == attachment_filename:
+                return attachment
+        return None
+    
+    def stream_attachment(self, email_id: str, attachment: dict, out, folder: str = "INBOX") -> int:
+        """Write one decoded attachment part to a binary file object.
+        
+        The part is fetched with BODY.PEEK[<part>]<offset.length> in
+        DOWNLOAD_CHUNK_SIZE pieces and decoded as it arrives, so neither the
+        message nor the whole attachment is held in memory. Returns the
+        number of decoded bytes written.
+        """
+        self.select_folder(folder)
+        decoder = TransferDecoder(attachment.get("encoding"))
+        written = 0
+        offset = 0
+        while True:
+            status, data = self.connection.uid(
+                'FETCH', email_id,
+                f'(BODY.PEEK[{attachment["part"]}]<{offset}.{self.DOWNLOAD_CHUNK_SIZE}>)'
+            )
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"FETCH BODY[{attachment['part']}] failed")
+            chunk = b""
+            for item in parse_fetch_response(data):
+                value = next((v for k, v in item.items() if k.startswith('BODY[')), None)
+                if value is not None:
+                    chunk = value if isinstance(value, bytes) else value.encode()
+            if not chunk:
+                break
+            decoded = decoder.decode(chunk)
+            out.write(decoded)
+            written += len(decoded)
+            offset += len(chunk)
+            if len(chunk) < self.DOWNLOAD_CHUNK_SIZE:
+                break
+        decoded = decoder.flush()
+        out.write(decoded)
+        return written + len(decoded)
+    
+    def download_attachment_to_store(self, email_id: str, attachment_filename: str, store: "BlobStore", folder: str = "INBOX", part: str = None) -> Optional[tuple]:
+        """Stream an attachment into the blob store's staging area.
+        
+        Returns the staged (tmp_path, sha256, size, head) for attach_invoice,
+        or None if the attachment was not found.
+        """
+        attachment = self.find_attachment_part(email_id, attachment_filename, part, folder)
+        if not attachment:
+            return None
+        return store.stage(lambda out: self.stream_attachment(email_id, attachment, out, folder))
+    
+    INDEX_FETCH_ITEMS = '(UID INTERNALDATE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)] BODYSTRUCTURE)'
+    
+    def get_mailbox_status(self, folder: str = "INBOX") -> dict:
+        """UIDVALIDITY, UIDNEXT and message count of a folder, plus HIGHESTMODSEQ under CONDSTORE"""
         if not self.connection:
             self.connect()
+        items = "MESSAGES UIDNEXT UIDVALIDITY"
+        if 'CONDSTORE' in self.connection.capabilities:
+            items += " HIGHESTMODSEQ"
+        status, data = self.connection.status(folder, f"({items})")
+        if status != 'OK' or not data or not data[0]:
+            raise imaplib.IMAP4.error(f"STATUS {folder} failed")
+        values = {
+            key.decode().upper(): int(value)
+            for key, value in re.findall(rb'([A-Za-z]+) (\d+)', data[0])
+        }
+        return {
+            "messages": values.get("MESSAGES", 0),
+            "uidnext": values.get("UIDNEXT", 1),
+            "uidvalidity": values.get("UIDVALIDITY"),
+            "highestmodseq": values.get("HIGHESTMODSEQ")
+        }
+    
+    def list_uids(self, folder: str = "INBOX", min_uid: int = 1) -> list:
+        """All UIDs in the folder from min_uid upwards, ascending"""
+        self.select_folder(folder)
+        status, data = self.connection.uid('SEARCH', f'UID {min_uid}:*')
+        if status != 'OK' or not data or not data[0]:
+            return []
+        # "n:*" always matches the highest UID, even when it is below n
+        return [uid for uid in map(int, data[0].split()) if uid >= min_uid]
+    
+    def fetch_index_records(self, uids: list, folder: str = "INBOX") -> list:
+        """Headers, INTERNALDATE and attachment metadata for the given UIDs in one UID FETCH"""
+        if not uids:
+            return []
+        self.select_folder(folder)
+        status, data = self.connection.uid('FETCH', ','.join(map(str, uids)), self.INDEX_FETCH_ITEMS)
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH {folder} failed")
+        
+        records = []
+        for item in parse_fetch_response(data):
+            if not item.get('UID'):
+                continue
+            header_bytes = next((v for k, v in item.items() if k.startswith('BODY[HEADER')), b'')
+            headers = email.message_from_bytes(header_bytes if isinstance(header_bytes, bytes) else b'')
+            attachments = attachments_from_bodystructure(item.get('BODYSTRUCTURE'))
+            sender = str(headers.get("From", ""))
+            records.append({
+                "uid": int(item['UID']),
+                "subject": decode_mime_header(str(headers.get("Subject", ""))),
+                "from": sender,
+                "from_search": decode_mime_header(sender).casefold(),
+                "date": str(headers.get("Date", "")),
+                "internal_date": parse_internaldate(item.get('INTERNALDATE')),
+                "attachments": attachments,
+                "has_pdf": any(a["is_pdf"] for a in attachments)
+            })
+        return records
+
+
+# ============== IMAP SESSION POOL ==============
+
+IMAP_POOL_MAX_PER_USER = int(os.environ.get('IMAP_POOL_MAX_PER_USER', '3'))
+IMAP_POOL_IDLE_TIMEOUT = int(os.environ.get('IMAP_POOL_IDLE_TIMEOUT', '300'))  # seconds
+IMAP_POOL_HEALTH_CHECK_AFTER = int(os.environ.get('IMAP_POOL_HEALTH_CHECK_AFTER', '30'))  # seconds idle before NOOP
+IMAP_POOL_ACQUIRE_TIMEOUT = int(os.environ.get('IMAP_POOL_ACQUIRE_TIMEOUT', '30'))  # seconds
+
+class ImapSessionPool:
+    """Per-user pool of logged-in ZohoMailClient sessions.
+    
+    Sessions are handed out exclusively (imaplib connections are not
+    thread-safe), returned to the pool after use and logged out once they
+    have been idle longer than idle_timeout. A session that has been idle
+    for more than health_check_after seconds is checked with NOOP before it
+    is reused and reconnected if the server has dropped it.
+    """
+    
+    def __init__(
+        self,
+        max_per_user: int = IMAP_POOL_MAX_PER_USER,
+        idle_timeout: int = IMAP_POOL_IDLE_TIMEOUT,
+        health_check_after: int = IMAP_POOL_HEALTH_CHECK_AFTER,
+        acquire_timeout: int = IMAP_POOL_ACQUIRE_TIMEOUT
+    ):
+        self.max_per_user = max_per_user
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.acquire_timeout = acquire_timeout
+        self._cond = threading.Condition()
+        self._idle = {}  # user_id -> list of (client, last_used), most recent last
+        self._in_use = {}  # user_id -> number of checked out sessions
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "reconnects": 0,
+            "evictions": 0
+        }
+    
+    def _evict_expired_locked(self, now: float) -> list:
+        """Pop idle sessions past idle_timeout; caller logs them out outside the lock"""
+        expired = []
+        for user_id in list(self._idle):
+            fresh = []
+            for client, last_used in self._idle[user_id]:
+                if now - last_used > self.idle_timeout:
+                    expired.append(client)
+                else:
+                    fresh.append((client, last_used))
+            if fresh:
+                self._idle[user_id] = fresh
+            else:
+                del self._idle[user_id]
+        self._stats["evictions"] += len(expired)
+        return expired
+    
+    def acquire(self, user: dict) -> ZohoMailClient:
+        """Check out a logged-in session for the user, creating one if needed"""
+        user_id = user["id"]
+        deadline = time.monotonic() + self.acquire_timeout
+        pooled = None
+        with self._cond:
+            expired = self._evict_expired_locked(time.monotonic())
+            while True:
+                idle = self._idle.get(user_id)
+                if idle:
+                    pooled = idle.pop()
+                    if not idle:
+                        del self._idle[user_id]
+                    break
+                if self._in_use.get(user_id, 0) < self.max_per_user:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise HTTPException(
+                        status_code=503,
+                        detail="Previše istovremenih veza prema Zoho Mailu, pokušajte ponovno"
+                    )
+                self._cond.wait(remaining)
+            self._in_use[user_id] = self._in_use.get(user_id, 0) + 1
         
-        self.connection.select(folder)
+        for stale in expired:
+            stale.disconnect()
         
         try:
-            status, msg_data = self.connection.fetch(email_id.encode(), '(RFC822)')
-            if status != 'OK':
-                return None
-            
-            for response_part in msg_data:
-                if isinstance(response_part, tuple):
-                    msg = email.message_from_bytes(response_part[1])
-                    
-                    for part in msg.walk():
-                        if part.get_content_maintype() == 'multipart':
-                            continue
-                        
-                        filename = part.get_filename()
-                        if filename:
-                            decoded = decode_header(filename)
-                            decoded_filename = ""
-                            for part_text, enc in decoded:
-                                if isinstance(part_text, bytes):
-                                    decoded_filename += part_text.decode(enc or 'utf-8', errors='ignore')
-                                else:
-                                    decoded_filename += part_text
-                            
-                            if decoded_filename == attachment_filename:
-                                return part.get_payload(decode=True)
+            if pooled:
+                client, last_used = pooled
+                if (client.email_address, client.app_password) == (user["zoho_email"], user["zoho_app_password"]):
+                    if time.monotonic() - last_used > self.health_check_after and not client.is_alive():
+                        logger.info(f"Reconnecting stale IMAP session for user {user_id}")
+                        client.disconnect()
+                        client.connect()
+                        with self._cond:
+                            self._stats["reconnects"] += 1
+                    with self._cond:
+                        self._stats["hits"] += 1
+                    return client
+                # Credentials changed since the session was opened
+                client.disconnect()
             
-            return None
+            client = ZohoMailClient(user["zoho_email"], user["zoho_app_password"])
+            client.connect()
+            with self._cond:
+                self._stats["misses"] += 1
+            return client
+        except BaseException:
+            self._release_slot(user_id)
+            raise
+    
+    def _release_slot(self, user_id: str):
+        with self._cond:
+            self._in_use[user_id] -= 1
+            if not self._in_use[user_id]:
+                del self._in_use[user_id]
+            self._cond.notify_all()
+    
+    def release(self, user_id: str, client: ZohoMailClient, discard: bool = False):
+        """Return a session to the pool, or log it out if it is no longer usable"""
+        if discard or not client.connection:
+            client.disconnect()
+        else:
+            with self._cond:
+                self._idle.setdefault(user_id, []).append((client, time.monotonic()))
+        self._release_slot(user_id)
+    
+    @contextmanager
+    def session(self, user: dict):
+        """Context manager wrapping acquire/release"""
+        client = self.acquire(user)
+        discard = False
+        try:
+            yield client
+        except (imaplib.IMAP4.abort, OSError):
+            discard = True
+            raise
+        finally:
+            self.release(user["id"], client, discard)
+    
+    def close_user(self, user_id: str):
+        """Log out all idle sessions of a user, e.g. after a credentials change"""
+        with self._cond:
+            idle = self._idle.pop(user_id, [])
+        for client, _ in idle:
+            client.disconnect()
+    
+    def close_all(self):
+        with self._cond:
+            idle = [client for sessions in self._idle.values() for client, _ in sessions]
+            self._idle.clear()
+        for client in idle:
+            client.disconnect()
+    
+    def reap_idle(self) -> int:
+        """Log out every session idle past idle_timeout; returns how many"""
+        with self._cond:
+            expired = self._evict_expired_locked(time.monotonic())
+        for client in expired:
+            client.disconnect()
+        return len(expired)
+    
+    def get_stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats)
+            stats["idle_sessions"] = sum(len(v) for v in self._idle.values())
+            stats["active_sessions"] = sum(self._in_use.values())
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+mail_pool = ImapSessionPool()
+
+async def mail_pool_reaper():
+    """Log out idle sessions even for users who send no further requests"""
+    while True:
+        await asyncio.sleep(max(IMAP_POOL_IDLE_TIMEOUT / 2, 1))
+        try:
+            reaped = await asyncio.get_running_loop().run_in_executor(mail_executor, mail_pool.reap_idle)
+            if reaped:
+                logger.info(f"Closed {reaped} idle IMAP sessions")
         except Exception as e:
-            logger.error(f"Error downloading attachment: {e}")
+            logger.error(f"IMAP session reaper failed: {e}")
+
+# ============== MAIL CACHE ==============
+
+MAIL_CACHE_ENABLED = os.environ.get('MAIL_CACHE_ENABLED', 'true').lower() == 'true'
+MAIL_CACHE_SIZE = int(os.environ.get('MAIL_CACHE_SIZE', '5000'))  # entries
+MAIL_CACHE_TTL = int(os.environ.get('MAIL_CACHE_TTL', '900'))  # seconds
+MAIL_CACHE_MONGO = os.environ.get('MAIL_CACHE_MONGO', 'false').lower() == 'true'
+MAIL_CACHE_STATUS_INTERVAL = int(os.environ.get('MAIL_CACHE_STATUS_INTERVAL', '30'))  # seconds between new-mail checks
+
+class MailCache:
+    """Cache for search results and attachment listings.
+    
+    Keys are tuples: ("search", user_id, folder, uidvalidity, term, date_from,
+    date_to, ignore_date) and ("attachments", user_id, folder, uidvalidity,
+    uid). Search entries remember the UIDNEXT they were computed under and
+    are treated as misses once new mail has arrived; attachment listings
+    never change for a given (UIDVALIDITY, UID). An in-process TTL/LRU
+    layer sits in front of an optional MongoDB layer (MAIL_CACHE_MONGO)
+    shared by all workers.
+    """
+    
+    def __init__(self, maxsize: int = MAIL_CACHE_SIZE, ttl: int = MAIL_CACHE_TTL, use_mongo: bool = MAIL_CACHE_MONGO):
+        self.memory = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.use_mongo = use_mongo
+        # Last known STATUS per (user_id, folder), refreshed every MAIL_CACHE_STATUS_INTERVAL
+        self.generations = TTLCache(maxsize, MAIL_CACHE_STATUS_INTERVAL)
+        self.mongo_hits = 0
+    
+    @staticmethod
+    def _mongo_id(key: tuple) -> str:
+        return "|".join(str(part) for part in key)
+    
+    async def get(self, key: tuple, uidnext: int = None):
+        entry = self.memory.get(key)
+        if entry is None and self.use_mongo:
+            doc = await db.mail_cache.find_one({
+                "_id": self._mongo_id(key),
+                "expires_at": {"$gt": datetime.now(timezone.utc)}
+            })
+            if doc:
+                self.mongo_hits += 1
+                entry = {"value": doc["value"], "uidnext": doc.get("uidnext")}
+                self.memory.set(key, entry)
+        if entry is None or (uidnext is not None and entry["uidnext"] != uidnext):
             return None
+        # Callers annotate results in place, hand out a private copy
+        return copy.deepcopy(entry["value"])
+    
+    async def set(self, key: tuple, value, uidnext: int = None):
+        entry = {"value": copy.deepcopy(value), "uidnext": uidnext}
+        self.memory.set(key, entry)
+        if self.use_mongo:
+            # Expired entries are removed by the TTL index in INDEX_MANIFEST
+            await db.mail_cache.update_one(
+                {"_id": self._mongo_id(key)},
+                {"$set": {
+                    "user_id": key[1],
+                    "value": entry["value"],
+                    "uidnext": uidnext,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+                }},
+                upsert=True
+            )
+    
+    async def invalidate_user(self, user_id: str):
+        """Forget everything cached for a user, e.g. after the mailbox changed"""
+        self.memory.delete_where(lambda key: key[1] == user_id)
+        self.generations.delete_where(lambda key: key[0] == user_id)
+        if self.use_mongo:
+            await db.mail_cache.delete_many({"user_id": user_id})
+    
+    def stats(self) -> dict:
+        stats = self.memory.stats()
+        stats["enabled"] = MAIL_CACHE_ENABLED
+        stats["mongo"] = self.use_mongo
+        stats["mongo_hits"] = self.mongo_hits
+        return stats
+
+mail_cache = MailCache()
+
+# ============== ASYNC MAIL LAYER ==============
+
+MAIL_EXECUTOR_WORKERS = int(os.environ.get('MAIL_EXECUTOR_WORKERS', '8'))
+MAIL_OPERATION_TIMEOUT = int(os.environ.get('MAIL_OPERATION_TIMEOUT', '60'))  # seconds
+MAIL_DOWNLOAD_TIMEOUT = int(os.environ.get('MAIL_DOWNLOAD_TIMEOUT', '300'))  # seconds for one attachment download
+
+# All blocking imaplib work runs here so the event loop stays responsive
+mail_executor = ThreadPoolExecutor(max_workers=MAIL_EXECUTOR_WORKERS, thread_name_prefix="imap")
+
+class MailSessionSlots:
+    """Per-user limit on checked-out sessions, waited for on the event loop.
+    
+    An AsyncMailSession takes a slot before it asks mail_pool for a
+    session, so the pool always has one free and executor threads never
+    sit in its wait; a user with many concurrent searches queues here
+    instead of tying up the threads everyone's mail I/O runs on.
+    """
+    
+    def __init__(self, per_user: int = IMAP_POOL_MAX_PER_USER, timeout: int = IMAP_POOL_ACQUIRE_TIMEOUT):
+        self.per_user = per_user
+        self.timeout = timeout
+        self._semaphores = {}
+        self._holders = {}  # user_id -> slots held or waited for
+    
+    async def acquire(self, user_id: str):
+        semaphore = self._semaphores.setdefault(user_id, asyncio.Semaphore(self.per_user))
+        self._holders[user_id] = self._holders.get(user_id, 0) + 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self._forget(user_id)
+            raise HTTPException(
+                status_code=503,
+                detail="Previše istovremenih veza prema Zoho Mailu, pokušajte ponovno"
+            )
+        except BaseException:
+            self._forget(user_id)
+            raise
+    
+    def release(self, user_id: str):
+        self._semaphores[user_id].release()
+        self._forget(user_id)
+    
+    def _forget(self, user_id: str):
+        self._holders[user_id] -= 1
+        if not self._holders[user_id]:
+            del self._holders[user_id]
+            del self._semaphores[user_id]
+
+mail_session_slots = MailSessionSlots()
+
+class AsyncMailSession:
+    """Async facade over a pooled ZohoMailClient.
+    
+    Every call runs in mail_executor and is bounded by a timeout. A call that
+    times out (or whose request is cancelled) keeps the session checked out
+    until its thread finishes, so a connection is never shared between threads.
+    The user's slot in mail_session_slots is held for as long as the session.
+    """
+    
+    def __init__(self, user: dict, timeout: int = MAIL_OPERATION_TIMEOUT):
+        self.user = user
+        self.timeout = timeout
+        self.client = None
+        self._busy = None
+        self._lock = asyncio.Lock()  # one command at a time per connection
+    
+    async def _run(self, fn, *args, timeout: int = None, **kwargs):
+        async with self._lock:
+            if self._busy is not None and not self._busy.done():
+                # A previous call timed out and its thread still owns the connection
+                raise HTTPException(status_code=504, detail="Zoho Mail nije odgovorio na vrijeme")
+            loop = asyncio.get_running_loop()
+            self._busy = loop.run_in_executor(mail_executor, lambda: fn(*args, **kwargs))
+            try:
+                result = await asyncio.wait_for(asyncio.shield(self._busy), timeout or self.timeout)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=504, detail="Zoho Mail nije odgovorio na vrijeme")
+            self._busy = None
+            return result
+    
+    async def __aenter__(self):
+        await mail_session_slots.acquire(self.user["id"])
+        try:
+            self.client = await self._run(mail_pool.acquire, self.user)
+        except BaseException:
+            if self._busy is not None and not self._busy.done():
+                # Timed out or cancelled; the session goes back once the thread is done
+                self._busy.add_done_callback(self._release_when_done)
+            else:
+                mail_session_slots.release(self.user["id"])
+            raise
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._busy is not None and not self._busy.done():
+            self._busy.add_done_callback(self._release_when_done)
+        elif self.client is not None:
+            discard = exc_type is not None and issubclass(exc_type, (imaplib.IMAP4.abort, OSError))
+            self._release(self.client, discard)
+        return False
+    
+    def _release_when_done(self, future):
+        if future.cancelled() or future.exception() is not None:
+            if self.client is not None:
+                self._release(self.client, True)
+            else:
+                # The acquire failed and gave its pool slot back itself
+                mail_session_slots.release(self.user["id"])
+        elif self.client is None:
+            # The abandoned call was the acquire itself
+            self._release(future.result(), False)
+        else:
+            self._release(self.client, False)
+    
+    def _release(self, client: ZohoMailClient, discard: bool):
+        user_id = self.user["id"]
+        if discard:
+            # Logging out is network I/O, keep it off the event loop
+            released = asyncio.get_running_loop().run_in_executor(mail_executor, mail_pool.release, user_id, client, True)
+            released.add_done_callback(lambda _: mail_session_slots.release(user_id))
+        else:
+            mail_pool.release(user_id, client)
+            mail_session_slots.release(user_id)
+    
+    async def _mailbox_generation(self, folder: str) -> dict:
+        """UIDVALIDITY/UIDNEXT of a folder, from a recent STATUS if there is one"""
+        key = (self.user["id"], folder)
+        generation = mail_cache.generations.get(key)
+        if generation is None:
+            generation = await self._run(self.client.get_mailbox_status, folder)
+            mail_cache.generations.set(key, generation)
+        return generation
+    
+    async def search_emails(self, search_term: str, date_from: str = None, date_to: str = None, folder: str = "INBOX", ignore_date: bool = False, timeout: int = None):
+        results = await self.search_emails_multi([search_term], date_from, date_to, folder, ignore_date, timeout)
+        return results[0]
+    
+    async def search_emails_multi(self, search_terms: list, date_from: str = None, date_to: str = None, folder: str = "INBOX", ignore_date: bool = False, timeout: int = None) -> list:
+        if not MAIL_CACHE_ENABLED:
+            return await self._run(
+                self.client.search_emails_multi, search_terms, date_from, date_to, folder, ignore_date,
+                timeout=timeout
+            )
+        
+        generation = await self._mailbox_generation(folder)
+        keys = [
+            (
+                "search", self.user["id"], folder, generation["uidvalidity"],
+                ZohoMailClient.sanitize_search_term(term).lower(), date_from, date_to, ignore_date
+            )
+            for term in search_terms
+        ]
+        results = [await mail_cache.get(key, generation["uidnext"]) for key in keys]
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            fetched = await self._run(
+                self.client.search_emails_multi, [search_terms[i] for i in missing], date_from, date_to, folder, ignore_date,
+                timeout=timeout
+            )
+            for i, term_results in zip(missing, fetched):
+                results[i] = term_results
+                await mail_cache.set(keys[i], term_results, generation["uidnext"])
+                for e in term_results:
+                    await mail_cache.set(
+                        ("attachments", self.user["id"], folder, generation["uidvalidity"], e["email_id"]),
+                        e["attachments"]
+                    )
+        return results
+    
+    async def get_email_attachments(self, email_id: str, folder: str = "INBOX", timeout: int = None):
+        if not MAIL_CACHE_ENABLED:
+            return await self._run(self.client.get_email_attachments, email_id, folder, timeout=timeout)
+        
+        generation = await self._mailbox_generation(folder)
+        key = ("attachments", self.user["id"], folder, generation["uidvalidity"], str(email_id))
+        attachments = await mail_cache.get(key)
+        if attachments is None:
+            attachments = await self._run(self.client.get_email_attachments, email_id, folder, timeout=timeout)
+            await mail_cache.set(key, attachments)
+        return attachments
+    
+    async def download_attachment_to_store(self, email_id: str, attachment_filename: str, store: "BlobStore", folder: str = "INBOX", part: str = None, timeout: int = None) -> Optional[tuple]:
+        return await self._run(
+            self.client.download_attachment_to_store, email_id, attachment_filename, store, folder, part,
+            timeout=timeout or MAIL_DOWNLOAD_TIMEOUT
+        )
+    
+    async def is_alive(self, timeout: int = None) -> bool:
+        return await self._run(self.client.is_alive, timeout=timeout)
+    
+    async def get_mailbox_status(self, folder: str = "INBOX", timeout: int = None) -> dict:
+        return await self._run(self.client.get_mailbox_status, folder, timeout=timeout)
+    
+    async def list_uids(self, folder: str = "INBOX", min_uid: int = 1, timeout: int = None) -> list:
+        return await self._run(self.client.list_uids, folder, min_uid, timeout=timeout)
+    
+    async def fetch_index_records(self, uids: list, folder: str = "INBOX", timeout: int = None) -> list:
+        return await self._run(self.client.fetch_index_records, uids, folder, timeout=timeout)
+
+MAIL_SEARCH_CONCURRENCY = int(os.environ.get('MAIL_SEARCH_CONCURRENCY', '3'))  # sessions per batch search
+
+class MailSessionGroup:
+    """Fans mailbox calls out over several pooled sessions of one user.
+    
+    Offers the search calls of AsyncMailSession. Each call borrows an
+    idle session, opening a new one while fewer than `size` are open (never
+    more than the pool's per-user limit), so concurrent callers run in
+    parallel without sharing a connection.
+    """
+    
+    def __init__(self, user: dict, size: int = MAIL_SEARCH_CONCURRENCY, timeout: int = MAIL_OPERATION_TIMEOUT):
+        self.user = user
+        self.size = max(1, min(size, mail_pool.max_per_user))
+        self.timeout = timeout
+        self._idle = []
+        self._open = 0
+        self._cond = asyncio.Condition()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for session in idle:
+            await session.__aexit__(None, None, None)
+        return False
+    
+    async def _borrow(self) -> AsyncMailSession:
+        async with self._cond:
+            while not self._idle and self._open >= self.size:
+                await self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+        session = AsyncMailSession(self.user, self.timeout)
+        try:
+            return await session.__aenter__()
+        except BaseException:
+            async with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+    
+    async def _call(self, method: str, *args, **kwargs):
+        session = await self._borrow()
+        try:
+            result = await getattr(session, method)(*args, **kwargs)
+        except BaseException as e:
+            # The connection state is unknown after a failure, do not reuse it
+            await session.__aexit__(type(e), e, None)
+            async with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        async with self._cond:
+            self._idle.append(session)
+            self._cond.notify()
+        return result
+    
+    async def search_emails_multi(self, *args, **kwargs):
+        return await self._call("search_emails_multi", *args, **kwargs)
+    
+    async def get_email_attachments(self, *args, **kwargs):
+        return await self._call("get_email_attachments", *args, **kwargs)
+
+
+# ============== MAILBOX INDEX ==============
+
+MAIL_INDEX_ENABLED = os.environ.get('MAIL_INDEX_ENABLED', 'true').lower() == 'true'
+MAIL_INDEX_MAX_AGE = int(os.environ.get('MAIL_INDEX_MAX_AGE', '60'))  # seconds before re-checking the server
+MAIL_INDEX_FETCH_CHUNK = int(os.environ.get('MAIL_INDEX_FETCH_CHUNK', '200'))  # UIDs per FETCH
+MAIL_INDEX_VERSION = 2  # bump when index records change shape; older indexes are rebuilt
+
+# A lock lives only while a sync holds or waits for it, so idle users cost nothing
+_mail_index_locks = weakref.WeakValueDictionary()
+_mail_index_tasks = {}  # (user_id, folder) -> running background sync
+
+async def index_mail_records(mail: AsyncMailSession, key: dict, uids: list, uidvalidity: int):
+    """Fetch and store index records for the given UIDs, chunk by chunk.
+    
+    Yields after every stored chunk with the last UID of that chunk, so the
+    caller can record progress. A failed FETCH raises before anything of
+    its chunk is marked as indexed.
+    """
+    for i in range(0, len(uids), MAIL_INDEX_FETCH_CHUNK):
+        chunk = uids[i:i + MAIL_INDEX_FETCH_CHUNK]
+        records = await mail.fetch_index_records(chunk, key["folder"])
+        if records:
+            await db.mail_index.bulk_write([
+                UpdateOne(
+                    {**key, "uid": r["uid"]},
+                    {"$set": {**r, "uidvalidity": uidvalidity}},
+                    upsert=True
+                )
+                for r in records
+            ], ordered=False)
+        yield chunk[-1]
 
+async def sync_mail_index(mail: AsyncMailSession, user: dict, folder: str = "INBOX", incremental_only: bool = False) -> Optional[dict]:
+    """Bring the local index of a folder up to date and return its state.
+    
+    A changed UIDVALIDITY, mailbox address or MAIL_INDEX_VERSION drops the
+    index and starts over (or, with incremental_only, returns None without
+    touching it); otherwise only UIDs from the stored UIDNEXT upwards are
+    fetched. When UIDNEXT, the message count and (under CONDSTORE)
+    HIGHESTMODSEQ are unchanged, the sync costs a single STATUS command.
+    Progress is stored after every chunk, so an interrupted sync resumes
+    where it stopped.
+    """
+    key = {"user_id": user["id"], "folder": folder}
+    lock = _mail_index_locks.get((user["id"], folder))
+    if lock is None:
+        lock = _mail_index_locks[(user["id"], folder)] = asyncio.Lock()
+    async with lock:
+        state = await db.mail_index_state.find_one(key, {"_id": 0})
+        server = await mail.get_mailbox_status(folder)
+        mail_cache.generations.set((user["id"], folder), server)
+        
+        if (
+            not state
+            or state.get("uidvalidity") != server["uidvalidity"]
+            or state.get("zoho_email") != user["zoho_email"]
+            or state.get("version") != MAIL_INDEX_VERSION
+        ):
+            if incremental_only:
+                return None
+            await db.mail_index.delete_many(key)
+            state = {
+                **key,
+                "zoho_email": user["zoho_email"],
+                "uidvalidity": server["uidvalidity"],
+                "version": MAIL_INDEX_VERSION,
+                "uidnext": 1,
+                "messages": None,
+                "highestmodseq": None,
+                "synced_at": None
+            }
+        elif (
+            state.get("uidnext") == server["uidnext"]
+            and state.get("messages") == server["messages"]
+            and state.get("highestmodseq") == server["highestmodseq"]
+        ):
+            state["synced_at"] = datetime.now(timezone.utc).isoformat()
+            await db.mail_index_state.update_one(key, {"$set": {"synced_at": state["synced_at"]}})
+            return state
+        
+        new_uids = await mail.list_uids(folder, state["uidnext"])
+        async for last_uid in index_mail_records(mail, key, new_uids, server["uidvalidity"]):
+            state["uidnext"] = last_uid + 1
+            await db.mail_index_state.update_one(key, {"$set": state}, upsert=True)
+        
+        # Reconcile when the counts disagree: drop expunged messages and
+        # backfill any the index is missing
+        indexed = await db.mail_index.count_documents(key)
+        if indexed != server["messages"]:
+            server_uids = set(await mail.list_uids(folder))
+            indexed_uids = set(await db.mail_index.distinct("uid", key))
+            gone = list(indexed_uids - server_uids)
+            if gone:
+                await db.mail_index.delete_many({**key, "uid": {"$in": gone}})
+            missing = sorted(server_uids - indexed_uids)
+            async for _ in index_mail_records(mail, key, missing, server["uidvalidity"]):
+                pass
+        
+        state.update({
+            "uidnext": max(state["uidnext"], server["uidnext"]),
+            "messages": server["messages"],
+            "highestmodseq": server["highestmodseq"],
+            "synced_at": datetime.now(timezone.utc).isoformat()
+        })
+        await db.mail_index_state.update_one(key, {"$set": state}, upsert=True)
+        return state
+
+class MailIndexSearcher:
+    """Answers mailbox searches from the local index instead of the IMAP server.
+    
+    Offers the search interface of AsyncMailSession with the same semantics
+    (SUBJECT or FROM contains the term, newest 20 matches, retried without
+    the date window when nothing matches), so search_transaction_invoices
+    gives the same answers without network round-trips. Results already
+    carry their attachment listing.
+    """
+    
+    def __init__(self, user: dict):
+        self.user = user
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+    
+    async def _matching(self, folder: str, term: str, date_from: str = None, date_to: str = None) -> list:
+        # from_search holds the decoded, case-folded From header
+        query = {
+            "user_id": self.user["id"],
+            "folder": folder,
+            "$or": [
+                {"subject": {"$regex": re.escape(term), "$options": "i"}},
+                {"from_search": {"$regex": re.escape(term.casefold())}}
+            ]
+        }
+        date_range = {}
+        if date_from:
+            date_range["$gte"] = datetime.strptime(date_from, "%d-%b-%Y").replace(tzinfo=timezone.utc)
+        if date_to:
+            date_range["$lt"] = datetime.strptime(date_to, "%d-%b-%Y").replace(tzinfo=timezone.utc)
+        if date_range:
+            query["internal_date"] = date_range
+        limit = ZohoMailClient.SEARCH_RESULT_LIMIT
+        docs = await db.mail_index.find(query, {"_id": 0}).sort("uid", -1).limit(limit).to_list(limit)
+        return list(reversed(docs))
+    
+    async def search_emails(self, search_term: str, date_from: str = None, date_to: str = None, folder: str = "INBOX", ignore_date: bool = False, timeout: int = None):
+        safe_search = ZohoMailClient.sanitize_search_term(search_term)
+        if not safe_search:
+            return []
+        if ignore_date:
+            date_from = date_to = None
+        
+        docs = await self._matching(folder, safe_search, date_from, date_to)
+        if not docs and (date_from or date_to):
+            docs = await self._matching(folder, safe_search)
+        return [
+            {
+                "email_id": str(d["uid"]),
+                "subject": d["subject"],
+                "from": d["from"],
+                "date": d["date"],
+                "attachments": d["attachments"],
+                "has_pdf": d["has_pdf"]
+            }
+            for d in docs
+        ]
+    
+    async def search_emails_multi(self, search_terms: list, date_from: str = None, date_to: str = None, folder: str = "INBOX", ignore_date: bool = False, timeout: int = None) -> list:
+        return [
+            await self.search_emails(term, date_from, date_to, folder, ignore_date)
+            for term in search_terms
+        ]
+    
+    async def get_email_attachments(self, email_id: str, folder: str = "INBOX", timeout: int = None):
+        doc = await db.mail_index.find_one(
+            {"user_id": self.user["id"], "folder": folder, "uid": int(email_id)},
+            {"_id": 0, "attachments": 1}
+        )
+        return doc["attachments"] if doc else []
+
+async def get_mail_index_searcher(user: dict, folder: str = "INBOX") -> Optional[MailIndexSearcher]:
+    """Searcher over a fresh local index, catching it up first if needed.
+    
+    Returns None (callers then search over IMAP) when the index is disabled,
+    cannot be brought up to date or has not finished its first full sync;
+    a full sync only ever runs in the background.
+    """
+    if not MAIL_INDEX_ENABLED:
+        return None
+    
+    state = await db.mail_index_state.find_one({"user_id": user["id"], "folder": folder}, {"_id": 0})
+    if (
+        not state
+        or not state.get("synced_at")
+        or state.get("zoho_email") != user["zoho_email"]
+        or state.get("version") != MAIL_INDEX_VERSION
+    ):
+        schedule_mail_index_sync(user, folder)
+        return None
+    if datetime.now(timezone.utc) - datetime.fromisoformat(state["synced_at"]) < timedelta(seconds=MAIL_INDEX_MAX_AGE):
+        return MailIndexSearcher(user)
+    
+    try:
+        async with AsyncMailSession(user) as mail:
+            state = await sync_mail_index(mail, user, folder, incremental_only=True)
+    except Exception as e:
+        logger.error(f"Mail index sync failed for user {user['id']}, searching over IMAP: {e}")
+        return None
+    if state is None:
+        schedule_mail_index_sync(user, folder)
+        return None
+    return MailIndexSearcher(user)
+
+def schedule_mail_index_sync(user: dict, folder: str = "INBOX"):
+    """Start syncing the index in the background, e.g. right after Zoho is configured.
+    
+    Does nothing while a background sync of the same folder is running.
+    """
+    key = (user["id"], folder)
+    running = _mail_index_tasks.get(key)
+    if running and not running.done():
+        return
+    
+    async def run():
+        try:
+            async with AsyncMailSession(user) as mail:
+                await sync_mail_index(mail, user, folder)
+        except Exception as e:
+            logger.error(f"Background mail index sync failed for user {user['id']}: {e}")
+    
+    task = asyncio.create_task(run())
+    _mail_index_tasks[key] = task
+    task.add_done_callback(lambda t: _mail_index_tasks.pop(key, None) if _mail_index_tasks.get(key) is t else None)
 
 class EmailSearchRequest(BaseModel):
     vendor_name: str
@@ -934,9 +3699,10 @@ class EmailSearchRequest(BaseModel):
     date_to: Optional[str] = None
 
 class DownloadAttachmentRequest(BaseModel):
-    email_id: str
+    email_id: str  # UID, as returned by /email/search
     filename: str
     transaction_id: str
+    part: Optional[str] = None  # IMAP part number from the attachment listing
 
 @api_router.post("/email/search")
 async def search_email(
@@ -951,22 +3717,21 @@ async def search_email(
         )
     
     try:
-        mail_client = ZohoMailClient(user["zoho_email"], user["zoho_app_password"])
-        mail_client.connect()
-        
-        results = mail_client.search_emails(
-            search_term=request.vendor_name,
-            date_from=request.date_from,
-            date_to=request.date_to
-        )
-        
-        # Get attachments info for each email
-        for result in results:
-            attachments = mail_client.get_email_attachments(result["email_id"])
-            result["attachments"] = attachments
-            result["has_pdf"] = any(a.get("is_pdf") for a in attachments)
-        
-        mail_client.disconnect()
+        searcher = await get_mail_index_searcher(user)
+        async with (searcher or AsyncMailSession(user)) as mail_client:
+            results = await mail_client.search_emails(
+                search_term=request.vendor_name,
+                date_from=request.date_from,
+                date_to=request.date_to
+            )
+            
+            # Get attachments info for each email (index results already carry it)
+            for result in results:
+                if "attachments" in result:
+                    continue
+                attachments = await mail_client.get_email_attachments(result["email_id"])
+                result["attachments"] = attachments
+                result["has_pdf"] = any(a.get("is_pdf") for a in attachments)
         
         return {
             "success": True,
@@ -992,47 +3757,239 @@ async def download_email_attachment(
         )
     
     try:
-        mail_client = ZohoMailClient(user["zoho_email"], user["zoho_app_password"])
-        mail_client.connect()
+        safe_filename = re.sub(r'[^\w\-_\.]', '_', request.filename)
         
-        # Download attachment
-        attachment_data = mail_client.download_attachment(request.email_id, request.filename)
-        mail_client.disconnect()
+        # Stream the attachment part into the blob store, hashing it on the way
+        async with AsyncMailSession(user) as mail_client:
+            staged = await mail_client.download_attachment_to_store(
+                request.email_id, request.filename, blob_store, part=request.part
+            )
         
-        if not attachment_data:
+        if staged is None:
             raise HTTPException(status_code=404, detail="Privitak nije pronađen")
         
-        # Save to file
-        safe_filename = re.sub(r'[^\w\-_\.]', '_', request.filename)
-        file_path = INVOICES_DIR / f"{user['id']}_{request.transaction_id}_{safe_filename}"
+        # Update transaction
+        if await attach_invoice({"id": request.transaction_id, "user_id": user["id"]}, staged, safe_filename) is None:
+            raise HTTPException(status_code=404, detail="Transakcija nije pronađena")
+        
+        return {
+            "success": True,
+            "filename": safe_filename,
+            "message": "Račun uspješno preuzet"
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Download attachment error: {e}")
+        raise HTTPException(status_code=500, detail=f"Greška pri preuzimanju: {str(e)}")
+
+@api_router.get("/email/test-connection")
+async def test_email_connection(user: dict = Depends(get_current_user)):
+    """Test Zoho Mail connection"""
+    if not user.get("zoho_email") or not user.get("zoho_app_password"):
+        raise HTTPException(
+            status_code=400,
+            detail="Zoho email nije konfiguriran."
+        )
+    
+    try:
+        async with AsyncMailSession(user) as mail_client:
+            if not await mail_client.is_alive():
+                raise HTTPException(status_code=502, detail="Zoho Mail veza nije aktivna")
+        return {"success": True, "message": "Uspješno povezano na Zoho Mail!"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Greška pri povezivanju: {str(e)}")
+
+@api_router.get("/email/pool-stats")
+async def get_email_pool_stats(user: dict = Depends(get_admin_user)):
+    """IMAP session pool hit/miss counters"""
+    return mail_pool.get_stats()
+
+async def search_transaction_invoices(mail_client, trans: dict, user: dict, writes: TransactionWriteBatch = None, raise_errors: bool = False) -> dict:
+    """Search the mailbox for one transaction's invoice, score the matches and update its status.
+    
+    mail_client is an AsyncMailSession, a MailSessionGroup or a
+    MailIndexSearcher. All search terms go out as one combined search;
+    attachment listings still missing are fetched concurrently and merged
+    in order, so the result does not depend on which call finishes first.
+    With `writes` the status update is queued there instead of written.
+    A failed search comes back as an error result, or is raised with
+    raise_errors so the caller can retry it.
+    """
+    date_range_days = user.get("date_range_days", 0)
+    search_all_fields = user.get("search_all_fields", True)
+    
+    try:
+        # Parse date for search range
+        date_str = trans.get("datum_izvrsenja", "")
+        date_from = None
+        date_to = None
+        
+        trans_date_parsed = transaction_date(trans)
+        if trans_date_parsed:
+            # Apply date range setting
+            date_from = (trans_date_parsed - timedelta(days=date_range_days)).strftime("%d-%b-%Y")
+            date_to = (trans_date_parsed + timedelta(days=date_range_days + 1)).strftime("%d-%b-%Y")
+        
+        # Build search terms from all relevant fields
+        search_terms = []
+        vendor_name = trans.get("primatelj", "").strip()
+        
+        if vendor_name:
+            search_terms.append(vendor_name)
+        
+        if search_all_fields:
+            # Add other fields to search
+            opis = trans.get("opis_transakcije", "").strip()
+            if opis and len(opis) > 3:
+                # Extract meaningful words from description
+                words = [w for w in opis.split() if len(w) > 3 and not w.replace('.', '').replace(',', '').isdigit()]
+                search_terms.extend(words[:3])  # Max 3 words from description
+        
+        if not search_terms:
+            return {
+                "transaction_id": trans["id"],
+                "vendor": vendor_name,
+                "date": date_str,
+                "found": False,
+                "emails": [],
+                "error": "Nema podataka za pretragu"
+            }
+        
+        # Search for emails using all search terms
+        all_emails = []
+        seen_email_ids = set()
+        
+        term_results = await mail_client.search_emails_multi(
+            search_terms[:5],  # Max 5 search terms
+            date_from=date_from,
+            date_to=date_to
+        )
+        for emails in term_results:
+            for e in emails:
+                if e["email_id"] not in seen_email_ids:
+                    seen_email_ids.add(e["email_id"])
+                    all_emails.append(e)
+        
+        # Get attachments for emails with PDF (limit to first 5 for performance)
+        missing = [e for e in all_emails[:5] if "attachments" not in e]
+        attachment_lists = await asyncio.gather(*(
+            mail_client.get_email_attachments(email_result["email_id"])
+            for email_result in missing
+        ))
+        for email_result, attachments in zip(missing, attachment_lists):
+            email_result["attachments"] = attachments
+            email_result["has_pdf"] = any(a.get("is_pdf") for a in attachments)
+        
+        # Filter to only emails with PDFs
+        emails_with_pdf = [e for e in all_emails[:5] if e.get("has_pdf")]
+        
+        # Calculate confidence score for each email
+        for email_result in emails_with_pdf:
+            confidence = 50  # Base confidence
+            
+            # Check vendor name match in subject or from
+            email_subject = email_result.get("subject", "").lower()
+            email_from = email_result.get("from", "").lower()
+            vendor_lower = vendor_name.lower()
+            
+            if vendor_lower in email_subject:
+                confidence += 25
+            if vendor_lower in email_from:
+                confidence += 15
+            
+            # Check date proximity
+            email_date_str = email_result.get("date", "")
+            if email_date_str and trans_date_parsed:
+                try:
+                    from email.utils import parsedate_to_datetime
+                    email_date = parsedate_to_datetime(email_date_str)
+                    days_diff = abs((email_date.date() - trans_date_parsed.date()).days)
+                    
+                    if days_diff == 0:
+                        confidence += 10
+                    elif days_diff <= 1:
+                        confidence += 5
+                    elif days_diff > 5:
+                        confidence -= 10
+                except:
+                    pass
+            
+            # Cap confidence at 95
+            email_result["confidence"] = min(95, max(10, confidence))
+        
+        # Sort by confidence (highest first)
+        emails_with_pdf.sort(key=lambda x: x.get("confidence", 0), reverse=True)
+        
+        # Get best match
+        best_match = emails_with_pdf[0] if emails_with_pdf else None
+        best_confidence = best_match.get("confidence", 0) if best_match else 0
         
-        with open(file_path, 'wb') as f:
-            f.write(attachment_data)
+        # Auto-update transaction status if found
+        if best_match and best_confidence >= 50:
+            fields = {
+                "status": "found",
+                "search_confidence": best_confidence,
+                "best_email_subject": best_match.get("subject", "")[:100]
+            }
+        else:
+            # Mark as not found
+            fields = {
+                "status": "manual",
+                "search_confidence": 0
+            }
+        if writes is not None:
+            writes.update(trans["id"], fields)
+        else:
+            await update_transaction_fields({"id": trans["id"], "user_id": user["id"]}, fields)
         
-        # Update transaction
-        await db.transactions.update_one(
-            {"id": request.transaction_id, "user_id": user["id"]},
-            {"$set": {
-                "status": "downloaded",
-                "invoice_filename": safe_filename,
-                "invoice_path": str(file_path)
-            }}
-        )
+        return {
+            "transaction_id": trans["id"],
+            "vendor": vendor_name,
+            "date": date_str,
+            "search_terms": search_terms[:5],
+            "found": len(emails_with_pdf) > 0,
+            "confidence": best_confidence,
+            "emails": emails_with_pdf[:3],  # Limit to 3 results per transaction
+            "total_found": len(emails_with_pdf)
+        }
         
+    except Exception as trans_error:
+        logger.error(f"Error searching for transaction {trans.get('id')}: {trans_error}")
+        if raise_errors:
+            raise
         return {
-            "success": True,
-            "filename": safe_filename,
-            "message": "Račun uspješno preuzet"
+            "transaction_id": trans["id"],
+            "vendor": trans.get("primatelj", ""),
+            "date": trans.get("datum_izvrsenja", ""),
+            "found": False,
+            "emails": [],
+            "error": "Greška pri pretrazi"
         }
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Download attachment error: {e}")
-        raise HTTPException(status_code=500, detail=f"Greška pri preuzimanju: {str(e)}")
 
-@api_router.get("/email/test-connection")
-async def test_email_connection(user: dict = Depends(get_current_user)):
-    """Test Zoho Mail connection"""
+
+@api_router.get("/email/index/status")
+async def get_mail_index_status(user: dict = Depends(get_current_user)):
+    """Sync state and size of the local mailbox index"""
+    state = await db.mail_index_state.find_one({"user_id": user["id"], "folder": "INBOX"}, {"_id": 0})
+    return {
+        "enabled": MAIL_INDEX_ENABLED,
+        "synced_at": state.get("synced_at") if state else None,
+        "uidvalidity": state.get("uidvalidity") if state else None,
+        "uidnext": state.get("uidnext") if state else None,
+        "syncing": (user["id"], "INBOX") in _mail_index_tasks,
+        "indexed_messages": await db.mail_index.count_documents({"user_id": user["id"], "folder": "INBOX"})
+    }
+
+@api_router.post("/email/index/sync")
+async def sync_email_index(user: dict = Depends(get_current_user)):
+    """Bring the local mailbox index up to date now.
+    
+    A full (re)build is started in the background instead; the response
+    then has in_progress set and GET /email/index/status shows when it is done.
+    """
     if not user.get("zoho_email") or not user.get("zoho_app_password"):
         raise HTTPException(
             status_code=400,
@@ -1040,224 +3997,79 @@ async def test_email_connection(user: dict = Depends(get_current_user)):
         )
     
     try:
-        mail_client = ZohoMailClient(user["zoho_email"], user["zoho_app_password"])
-        mail_client.connect()
-        mail_client.disconnect()
-        return {"success": True, "message": "Uspješno povezano na Zoho Mail!"}
+        async with AsyncMailSession(user) as mail:
+            state = await sync_mail_index(mail, user, incremental_only=True)
+        if state is None:
+            schedule_mail_index_sync(user)
+        return {
+            "success": True,
+            "in_progress": state is None,
+            "synced_at": state["synced_at"] if state else None,
+            "indexed_messages": await db.mail_index.count_documents({"user_id": user["id"], "folder": "INBOX"})
+        }
     except HTTPException:
         raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Greška pri povezivanju: {str(e)}")
+        logger.error(f"Mail index sync error: {e}")
+        raise HTTPException(status_code=500, detail=f"Greška pri sinkronizaciji: {str(e)}")
+
+@api_router.get("/email/cache-stats")
+async def get_email_cache_stats(user: dict = Depends(get_admin_user)):
+    """Hit rate of the search result / attachment listing cache"""
+    return mail_cache.stats()
 
 class BatchSearchRequest(BaseModel):
     transaction_ids: List[str]
 
-@api_router.post("/email/batch-search")
-async def batch_search_emails(
-    request: BatchSearchRequest,
-    user: dict = Depends(get_current_user)
-):
-    """Search emails for multiple transactions at once"""
+async def load_batch_search_transactions(request: BatchSearchRequest, user: dict, max_batch_size: int) -> list:
+    """The user's transactions for a batch search, in request order"""
     if not user.get("zoho_email") or not user.get("zoho_app_password"):
         raise HTTPException(
             status_code=400,
             detail="Zoho email nije konfiguriran. Molimo konfigurirajte u postavkama."
         )
     
-    # Get user's search settings
-    date_range_days = user.get("date_range_days", 0)
-    search_all_fields = user.get("search_all_fields", True)
-    
-    # Limit batch size to prevent timeout
-    MAX_BATCH_SIZE = 15
-    transaction_ids = request.transaction_ids[:MAX_BATCH_SIZE]
+    transaction_ids = request.transaction_ids[:max_batch_size]
     
-    if len(request.transaction_ids) > MAX_BATCH_SIZE:
-        logger.warning(f"Batch search limited from {len(request.transaction_ids)} to {MAX_BATCH_SIZE}")
+    if len(request.transaction_ids) > max_batch_size:
+        logger.warning(f"Batch search limited from {len(request.transaction_ids)} to {max_batch_size}")
     
     # Get transactions
     transactions = await db.transactions.find(
         {"id": {"$in": transaction_ids}, "user_id": user["id"]},
         {"_id": 0}
-    ).to_list(MAX_BATCH_SIZE)
+    ).to_list(max_batch_size)
     
     if not transactions:
         raise HTTPException(status_code=404, detail="Transakcije nisu pronađene")
     
+    # Answer in request order regardless of how $in returned the documents
+    position = {tid: idx for idx, tid in enumerate(transaction_ids)}
+    transactions.sort(key=lambda t: position[t["id"]])
+    return transactions
+
+@api_router.post("/email/batch-search")
+async def batch_search_emails(
+    request: BatchSearchRequest,
+    user: dict = Depends(get_current_user)
+):
+    """Search emails for multiple transactions at once"""
+    # Limit batch size to prevent timeout
+    MAX_BATCH_SIZE = 15
+    transactions = await load_batch_search_transactions(request, user, MAX_BATCH_SIZE)
+    
+    writes = TransactionWriteBatch(user["id"])
     try:
-        mail_client = ZohoMailClient(user["zoho_email"], user["zoho_app_password"])
-        mail_client.connect()
-        
-        results = []
-        for idx, trans in enumerate(transactions):
-            try:
-                # Parse date for search range
-                date_str = trans.get("datum_izvrsenja", "")
-                date_from = None
-                date_to = None
-                
-                if date_str:
-                    try:
-                        from datetime import datetime, timedelta
-                        # Handle various date formats
-                        for fmt in ["%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%d-%m-%Y", "%m/%d/%Y"]:
-                            try:
-                                trans_date = datetime.strptime(date_str.strip(), fmt)
-                                # Apply date range setting
-                                date_from = (trans_date - timedelta(days=date_range_days)).strftime("%d-%b-%Y")
-                                date_to = (trans_date + timedelta(days=date_range_days + 1)).strftime("%d-%b-%Y")
-                                break
-                            except:
-                                continue
-                    except:
-                        pass
-                
-                # Build search terms from all relevant fields
-                search_terms = []
-                vendor_name = trans.get("primatelj", "").strip()
-                
-                if vendor_name:
-                    search_terms.append(vendor_name)
-                
-                if search_all_fields:
-                    # Add other fields to search
-                    opis = trans.get("opis_transakcije", "").strip()
-                    if opis and len(opis) > 3:
-                        # Extract meaningful words from description
-                        words = [w for w in opis.split() if len(w) > 3 and not w.replace('.', '').replace(',', '').isdigit()]
-                        search_terms.extend(words[:3])  # Max 3 words from description
-                
-                if not search_terms:
-                    results.append({
-                        "transaction_id": trans["id"],
-                        "vendor": vendor_name,
-                        "date": date_str,
-                        "found": False,
-                        "emails": [],
-                        "error": "Nema podataka za pretragu"
-                    })
-                    continue
-                
-                # Search for emails using all search terms
-                all_emails = []
-                seen_email_ids = set()
-                
-                for term in search_terms[:5]:  # Max 5 search terms
-                    emails = mail_client.search_emails(
-                        search_term=term,
-                        date_from=date_from,
-                        date_to=date_to
-                    )
-                    for e in emails:
-                        if e["email_id"] not in seen_email_ids:
-                            seen_email_ids.add(e["email_id"])
-                            all_emails.append(e)
-                
-                # Get attachments for emails with PDF (limit to first 5 for performance)
-                for email_result in all_emails[:5]:
-                    attachments = mail_client.get_email_attachments(email_result["email_id"])
-                    email_result["attachments"] = attachments
-                    email_result["has_pdf"] = any(a.get("is_pdf") for a in attachments)
-                
-                # Filter to only emails with PDFs
-                emails_with_pdf = [e for e in all_emails[:5] if e.get("has_pdf")]
-                
-                # Calculate confidence score for each email
-                trans_date_parsed = None
-                if date_str:
-                    for fmt in ["%Y-%m-%d", "%d.%m.%Y", "%d/%m/%Y", "%d-%m-%Y", "%m/%d/%Y"]:
-                        try:
-                            trans_date_parsed = datetime.strptime(date_str.strip(), fmt)
-                            break
-                        except:
-                            continue
-                
-                for email_result in emails_with_pdf:
-                    confidence = 50  # Base confidence
-                    
-                    # Check vendor name match in subject or from
-                    email_subject = email_result.get("subject", "").lower()
-                    email_from = email_result.get("from", "").lower()
-                    vendor_lower = vendor_name.lower()
-                    
-                    if vendor_lower in email_subject:
-                        confidence += 25
-                    if vendor_lower in email_from:
-                        confidence += 15
-                    
-                    # Check date proximity
-                    email_date_str = email_result.get("date", "")
-                    if email_date_str and trans_date_parsed:
-                        try:
-                            from email.utils import parsedate_to_datetime
-                            email_date = parsedate_to_datetime(email_date_str)
-                            days_diff = abs((email_date.date() - trans_date_parsed.date()).days)
-                            
-                            if days_diff == 0:
-                                confidence += 10
-                            elif days_diff <= 1:
-                                confidence += 5
-                            elif days_diff > 5:
-                                confidence -= 10
-                        except:
-                            pass
-                    
-                    # Cap confidence at 95
-                    email_result["confidence"] = min(95, max(10, confidence))
-                
-                # Sort by confidence (highest first)
-                emails_with_pdf.sort(key=lambda x: x.get("confidence", 0), reverse=True)
-                
-                # Get best match
-                best_match = emails_with_pdf[0] if emails_with_pdf else None
-                best_confidence = best_match.get("confidence", 0) if best_match else 0
-                
-                # Auto-update transaction status if found
-                if best_match and best_confidence >= 50:
-                    await db.transactions.update_one(
-                        {"id": trans["id"], "user_id": user["id"]},
-                        {"$set": {
-                            "status": "found",
-                            "search_confidence": best_confidence,
-                            "best_email_subject": best_match.get("subject", "")[:100]
-                        }}
-                    )
-                else:
-                    # Mark as not found
-                    await db.transactions.update_one(
-                        {"id": trans["id"], "user_id": user["id"]},
-                        {"$set": {
-                            "status": "manual",
-                            "search_confidence": 0
-                        }}
-                    )
-                
-                results.append({
-                    "transaction_id": trans["id"],
-                    "vendor": vendor_name,
-                    "date": date_str,
-                    "search_terms": search_terms[:5],
-                    "found": len(emails_with_pdf) > 0,
-                    "confidence": best_confidence,
-                    "emails": emails_with_pdf[:3],  # Limit to 3 results per transaction
-                    "total_found": len(emails_with_pdf)
-                })
-                
-            except Exception as trans_error:
-                logger.error(f"Error searching for transaction {trans.get('id')}: {trans_error}")
-                results.append({
-                    "transaction_id": trans["id"],
-                    "vendor": trans.get("primatelj", ""),
-                    "date": trans.get("datum_izvrsenja", ""),
-                    "found": False,
-                    "emails": [],
-                    "error": "Greška pri pretrazi"
-                })
-        
-        mail_client.disconnect()
+        searcher = await get_mail_index_searcher(user)
+        async with (searcher or MailSessionGroup(user)) as mail_client:
+            results = await asyncio.gather(*(
+                search_transaction_invoices(mail_client, trans, user, writes)
+                for trans in transactions
+            ))
+        await writes.flush()
         
         found_count = sum(1 for r in results if r.get("found"))
-        skipped = len(request.transaction_ids) - len(transaction_ids)
+        skipped = max(len(request.transaction_ids) - MAX_BATCH_SIZE, 0)
         
         return {
             "success": True,
@@ -1273,82 +4085,769 @@ async def batch_search_emails(
         logger.error(f"Batch search error: {e}")
         raise HTTPException(status_code=500, detail=f"Greška pri pretraživanju: {str(e)}")
 
-@api_router.get("/invoices/{transaction_id}/download")
-async def download_invoice(transaction_id: str, user: dict = Depends(get_current_user)):
-    """Download saved invoice file"""
+# ============== STREAMED BATCH SEARCH ==============
+
+BATCH_SEARCH_STREAM_MAX_SIZE = int(os.environ.get('BATCH_SEARCH_STREAM_MAX_SIZE', '100'))
+BATCH_SEARCH_HEARTBEAT_INTERVAL = int(os.environ.get('BATCH_SEARCH_HEARTBEAT_INTERVAL', '15'))  # seconds
+
+# Searches behind open streams, referenced until they finish
+search_streams = set()
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+async def run_streamed_batch_search(transactions: list, user: dict, queue: asyncio.Queue):
+    """Search the transactions concurrently, putting ("result", result) on the
+    queue as each is scored, then ("done", None) or ("error", detail)"""
+    writes = TransactionWriteBatch(user["id"])
+    try:
+        searcher = await get_mail_index_searcher(user)
+        async with (searcher or MailSessionGroup(user)) as mail_client:
+            tasks = [
+                asyncio.create_task(search_transaction_invoices(mail_client, trans, user, writes))
+                for trans in transactions
+            ]
+            try:
+                pending = set(tasks)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    # Save before reporting, so whatever the client has seen is stored
+                    await writes.flush()
+                    for task in done:
+                        await queue.put(("result", task.result()))
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        await queue.put(("done", None))
+    except asyncio.CancelledError:
+        raise
+    except HTTPException as e:
+        await queue.put(("error", e.detail))
+    except Exception as e:
+        logger.error(f"Streamed batch search error: {e}")
+        await queue.put(("error", f"Greška pri pretraživanju: {str(e)}"))
+
+@api_router.post("/email/batch-search/stream")
+async def stream_batch_search_emails(
+    request: BatchSearchRequest,
+    user: dict = Depends(get_current_user)
+):
+    """Batch search that streams each transaction's result as Server-Sent Events.
+    
+    Events: `start` ({total, skipped}), one `result` per transaction in
+    completion order (same shape as the batch-search results), then `done`
+    ({total_transactions, found_count}) or `error` ({detail}). Comment lines
+    are sent as heartbeats while nothing else is. Closing the connection
+    cancels the searches still running.
+    """
+    transactions = await load_batch_search_transactions(request, user, BATCH_SEARCH_STREAM_MAX_SIZE)
+    skipped = max(len(request.transaction_ids) - BATCH_SEARCH_STREAM_MAX_SIZE, 0)
+    
+    async def events():
+        queue = asyncio.Queue()
+        search = asyncio.create_task(run_streamed_batch_search(transactions, user, queue))
+        search_streams.add(search)
+        search.add_done_callback(search_streams.discard)
+        next_event = None
+        try:
+            yield sse_event("start", {"total": len(transactions), "skipped": skipped})
+            found_count = 0
+            while True:
+                if next_event is None:
+                    next_event = asyncio.ensure_future(queue.get())
+                done, _ = await asyncio.wait({next_event}, timeout=BATCH_SEARCH_HEARTBEAT_INTERVAL)
+                if not done:
+                    # Keeps proxies from timing out the idle connection
+                    yield ": heartbeat\n\n"
+                    continue
+                kind, payload = next_event.result()
+                next_event = None
+                if kind == "result":
+                    found_count += 1 if payload.get("found") else 0
+                    yield sse_event("result", payload)
+                elif kind == "error":
+                    yield sse_event("error", {"detail": payload})
+                    break
+                else:
+                    yield sse_event("done", {"total_transactions": len(transactions), "found_count": found_count})
+                    break
+        finally:
+            # Runs on client disconnect too; the search task cleans up after itself
+            if next_event is not None:
+                next_event.cancel()
+            search.cancel()
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ============== BACKGROUND SEARCH JOBS ==============
+
+SEARCH_JOB_WORKERS = int(os.environ.get('SEARCH_JOB_WORKERS', '2'))  # per process, 0 = no workers in this process
+SEARCH_JOB_LEASE_SECONDS = int(os.environ.get('SEARCH_JOB_LEASE_SECONDS', '300'))
+SEARCH_JOB_MAX_ATTEMPTS = int(os.environ.get('SEARCH_JOB_MAX_ATTEMPTS', '3'))
+SEARCH_JOB_POLL_INTERVAL = float(os.environ.get('SEARCH_JOB_POLL_INTERVAL', '2'))  # seconds
+SEARCH_JOB_RETRY_DELAY = float(os.environ.get('SEARCH_JOB_RETRY_DELAY', '30'))  # seconds, doubled per failed attempt
+
+class SearchJobResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    user_id: str
+    status: str  # queued, running, completed, cancelled
+    total: int
+    processed: int
+    found_count: int
+    failed_count: int
+    created_at: datetime
+    updated_at: datetime
+    finished_at: Optional[datetime] = None
+
+def search_job_response(job: dict) -> SearchJobResponse:
+    for field in ("created_at", "updated_at", "finished_at"):
+        if isinstance(job.get(field), str):
+            job[field] = datetime.fromisoformat(job[field])
+    return SearchJobResponse(**job)
+
+def search_job_claim_filter(now: datetime) -> dict:
+    """Items a worker may claim: pending ones past their retry backoff, and
+    running ones whose lease expired with attempts left"""
+    return {"$or": [
+        {"status": "pending", "not_before": {"$not": {"$gt": now}}},
+        {"status": "running", "lease_expires_at": {"$lt": now}, "attempts": {"$lt": SEARCH_JOB_MAX_ATTEMPTS}}
+    ]}
+
+async def claim_search_job_item(worker_id: str) -> Optional[dict]:
+    """Lease the oldest claimable item"""
+    now = datetime.now(timezone.utc)
+    return await db.search_job_items.find_one_and_update(
+        search_job_claim_filter(now),
+        {
+            "$set": {
+                "status": "running",
+                "lease_owner": worker_id,
+                "lease_expires_at": now + timedelta(seconds=SEARCH_JOB_LEASE_SECONDS)
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("_id", 1)],
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def renew_search_job_lease(item: dict, worker_id: str):
+    """Extend the item's lease while it is processed, so a long mailbox
+    search is not handed to a second worker"""
+    while True:
+        await asyncio.sleep(SEARCH_JOB_LEASE_SECONDS / 3)
+        renewed = await db.search_job_items.update_one(
+            {"id": item["id"], "status": "running", "lease_owner": worker_id},
+            {"$set": {"lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=SEARCH_JOB_LEASE_SECONDS)}}
+        )
+        if renewed.matched_count == 0:
+            logger.warning(f"Search job item {item['id']} lease lost by {worker_id}")
+            return
+
+async def complete_search_job_item(item: dict, worker_id: str, result: dict):
+    """Store an item's result and advance its job's progress counters"""
+    stored = await db.search_job_items.update_one(
+        {"id": item["id"], "status": "running", "lease_owner": worker_id},
+        {"$set": {
+            "status": "done",
+            "result": result,
+            "lease_owner": None,
+            "lease_expires_at": None
+        }}
+    )
+    if stored.modified_count == 0:
+        # Lease expired and another worker took the item over
+        return
+    await advance_search_job(item["job_id"], result)
+
+async def fail_exhausted_search_job_items() -> int:
+    """Give up on items whose lease expired on their last attempt.
+    
+    A worker that dies on an item (crash, OOM) never records a result; once
+    that has happened SEARCH_JOB_MAX_ATTEMPTS times the item is marked
+    failed instead of being claimed again, so its job can complete.
+    """
+    failed = 0
+    while True:
+        item = await db.search_job_items.find_one_and_update(
+            {
+                "status": "running",
+                "lease_expires_at": {"$lt": datetime.now(timezone.utc)},
+                "attempts": {"$gte": SEARCH_JOB_MAX_ATTEMPTS}
+            },
+            {"$set": {
+                "status": "failed",
+                "last_error": "Obrada prekinuta",
+                "lease_owner": None,
+                "lease_expires_at": None
+            }},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if not item:
+            return failed
+        result = {
+            "transaction_id": item["transaction_id"],
+            "found": False,
+            "emails": [],
+            "error": f"Pretraga nije uspjela nakon {item['attempts']} pokušaja"
+        }
+        await db.search_job_items.update_one({"id": item["id"]}, {"$set": {"result": result}})
+        await advance_search_job(item["job_id"], result)
+        failed += 1
+
+async def advance_search_job(job_id: str, result: dict):
+    """Count a finished item towards its job, completing the job after the last one"""
+    now = datetime.now(timezone.utc).isoformat()
+    job = await db.search_jobs.find_one_and_update(
+        {"id": job_id},
+        {
+            "$inc": {
+                "processed": 1,
+                "found_count": 1 if result.get("found") else 0,
+                "failed_count": 1 if result.get("error") else 0
+            },
+            "$set": {"updated_at": now}
+        },
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if job and job["processed"] >= job["total"]:
+        await db.search_jobs.update_one(
+            {"id": job["id"], "status": {"$in": ["queued", "running"]}},
+            {"$set": {"status": "completed", "finished_at": now}}
+        )
+
+async def process_search_job_item(item: dict, worker_id: str):
+    job = await db.search_jobs.find_one({"id": item["job_id"]}, {"_id": 0})
+    if not job or job["status"] == "cancelled":
+        await db.search_job_items.update_one(
+            {"id": item["id"], "lease_owner": worker_id},
+            {"$set": {"status": "cancelled", "lease_owner": None, "lease_expires_at": None}}
+        )
+        return
+    
+    if job["status"] == "queued":
+        await db.search_jobs.update_one(
+            {"id": job["id"], "status": "queued"},
+            {"$set": {"status": "running", "updated_at": datetime.now(timezone.utc).isoformat()}}
+        )
+    
+    user = await db.users.find_one({"id": job["user_id"]}, {"_id": 0})
+    trans = await db.transactions.find_one(
+        {"id": item["transaction_id"], "user_id": job["user_id"]},
+        {"_id": 0}
+    )
+    error_result = {
+        "transaction_id": item["transaction_id"],
+        "vendor": trans.get("primatelj", "") if trans else "",
+        "date": trans.get("datum_izvrsenja", "") if trans else "",
+        "found": False,
+        "emails": []
+    }
+    
+    if not trans:
+        result = {**error_result, "error": "Transakcija nije pronađena"}
+    elif not user or not user.get("zoho_email") or not user.get("zoho_app_password"):
+        result = {**error_result, "error": "Zoho email nije konfiguriran."}
+    else:
+        heartbeat = asyncio.create_task(renew_search_job_lease(item, worker_id))
+        try:
+            searcher = await get_mail_index_searcher(user)
+            async with (searcher or AsyncMailSession(user)) as mail_client:
+                result = await search_transaction_invoices(mail_client, trans, user, raise_errors=True)
+        except Exception as e:
+            # Login failure, IMAP error, timeout or dropped connection: retry
+            # after a backoff that doubles with every attempt
+            detail = e.detail if isinstance(e, HTTPException) else f"Greška pri pretraživanju: {str(e)}"
+            if item["attempts"] < SEARCH_JOB_MAX_ATTEMPTS:
+                delay = SEARCH_JOB_RETRY_DELAY * 2 ** (item["attempts"] - 1)
+                await db.search_job_items.update_one(
+                    {"id": item["id"], "lease_owner": worker_id},
+                    {"$set": {
+                        "status": "pending",
+                        "last_error": detail,
+                        "not_before": datetime.now(timezone.utc) + timedelta(seconds=delay),
+                        "lease_owner": None,
+                        "lease_expires_at": None
+                    }}
+                )
+                return
+            result = {**error_result, "error": detail}
+        finally:
+            heartbeat.cancel()
+    
+    await complete_search_job_item(item, worker_id, result)
+
+async def search_job_worker(worker_id: str):
+    """Claim and process search job items until cancelled"""
+    logger.info(f"Search job worker {worker_id} started")
+    next_sweep = 0.0
+    while True:
+        try:
+            if time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + SEARCH_JOB_POLL_INTERVAL
+                failed = await fail_exhausted_search_job_items()
+                if failed:
+                    logger.warning(f"Search job worker {worker_id} gave up on {failed} items")
+            item = await claim_search_job_item(worker_id)
+            if not item:
+                await asyncio.sleep(SEARCH_JOB_POLL_INTERVAL)
+                continue
+            await process_search_job_item(item, worker_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Search job worker {worker_id} error: {e}")
+            await asyncio.sleep(SEARCH_JOB_POLL_INTERVAL)
+
+def start_search_job_workers(count: int) -> list:
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    return [asyncio.create_task(search_job_worker(f"{prefix}-{n}")) for n in range(count)]
+
+@api_router.post("/email/jobs", response_model=SearchJobResponse)
+async def submit_search_job(
+    request: BatchSearchRequest,
+    user: dict = Depends(get_current_user)
+):
+    """Queue an email search for any number of transactions"""
+    if not user.get("zoho_email") or not user.get("zoho_app_password"):
+        raise HTTPException(
+            status_code=400,
+            detail="Zoho email nije konfiguriran. Molimo konfigurirajte u postavkama."
+        )
+    
+    requested_ids = list(dict.fromkeys(request.transaction_ids))
+    existing = await db.transactions.find(
+        {"id": {"$in": requested_ids}, "user_id": user["id"]},
+        {"_id": 0, "id": 1}
+    ).to_list(None)
+    existing_ids = {t["id"] for t in existing}
+    transaction_ids = [tid for tid in requested_ids if tid in existing_ids]
+    
+    if not transaction_ids:
+        raise HTTPException(status_code=404, detail="Transakcije nisu pronađene")
+    
+    job_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc).isoformat()
+    job_doc = {
+        "id": job_id,
+        "user_id": user["id"],
+        "status": "queued",
+        "total": len(transaction_ids),
+        "processed": 0,
+        "found_count": 0,
+        "failed_count": 0,
+        "created_at": now,
+        "updated_at": now,
+        "finished_at": None
+    }
+    await db.search_jobs.insert_one(job_doc)
+    await db.search_job_items.insert_many([
+        {
+            "id": str(uuid.uuid4()),
+            "job_id": job_id,
+            "user_id": user["id"],
+            "transaction_id": tid,
+            "seq": seq,
+            "status": "pending",
+            "attempts": 0,
+            "lease_owner": None,
+            "lease_expires_at": None,
+            "result": None
+        }
+        for seq, tid in enumerate(transaction_ids)
+    ], ordered=False)
+    
+    return search_job_response(job_doc)
+
+@api_router.get("/email/jobs", response_model=List[SearchJobResponse])
+async def get_search_jobs(user: dict = Depends(get_current_user)):
+    jobs = await db.search_jobs.find({"user_id": user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(50)
+    return [search_job_response(j) for j in jobs]
+
+@api_router.get("/email/jobs/{job_id}", response_model=SearchJobResponse)
+async def get_search_job(job_id: str, user: dict = Depends(get_current_user)):
+    job = await db.search_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Posao nije pronađen")
+    return search_job_response(job)
+
+@api_router.get("/email/jobs/{job_id}/results")
+async def get_search_job_results(
+    job_id: str,
+    skip: int = 0,
+    limit: int = 100,
+    user: dict = Depends(get_current_user)
+):
+    """Per-transaction results of a job, in submission order"""
+    job = await db.search_jobs.find_one({"id": job_id, "user_id": user["id"]}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Posao nije pronađen")
+    
+    limit = max(1, min(limit, 500))
+    items = await db.search_job_items.find(
+        {"job_id": job_id},
+        {"_id": 0, "transaction_id": 1, "status": 1, "attempts": 1, "last_error": 1, "result": 1}
+    ).sort("seq", 1).skip(max(skip, 0)).limit(limit).to_list(limit)
+    
+    return {
+        "job": search_job_response(job),
+        "skip": skip,
+        "limit": limit,
+        "results": items
+    }
+
+@api_router.post("/email/jobs/{job_id}/cancel", response_model=SearchJobResponse)
+async def cancel_search_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Stop handing out the job's remaining items; items already in flight finish normally"""
+    now = datetime.now(timezone.utc).isoformat()
+    job = await db.search_jobs.find_one_and_update(
+        {"id": job_id, "user_id": user["id"], "status": {"$in": ["queued", "running"]}},
+        {"$set": {"status": "cancelled", "updated_at": now, "finished_at": now}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not job:
+        raise HTTPException(status_code=404, detail="Aktivan posao nije pronađen")
+    
+    await db.search_job_items.update_many(
+        {"job_id": job_id, "status": "pending"},
+        {"$set": {"status": "cancelled"}}
+    )
+    return search_job_response(job)
+
+@api_router.post("/email/jobs/{job_id}/resume", response_model=SearchJobResponse)
+async def resume_search_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Requeue the unfinished items of a cancelled job"""
+    job = await db.search_jobs.find_one_and_update(
+        {"id": job_id, "user_id": user["id"], "status": "cancelled"},
+        {"$set": {
+            "status": "queued",
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "finished_at": None
+        }},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not job:
+        raise HTTPException(status_code=404, detail="Otkazani posao nije pronađen")
+    
+    await db.search_job_items.update_many(
+        {"job_id": job_id, "status": "cancelled"},
+        {"$set": {"status": "pending", "attempts": 0}}
+    )
+    if job["processed"] >= job["total"]:
+        await db.search_jobs.update_one(
+            {"id": job_id, "status": "queued"},
+            {"$set": {"status": "completed", "finished_at": job["updated_at"]}}
+        )
+        job = await db.search_jobs.find_one({"id": job_id}, {"_id": 0})
+    return search_job_response(job)
+
+INVOICE_CACHE_MAX_AGE = int(os.environ.get('INVOICE_CACHE_MAX_AGE', '0'))  # seconds, 0 = always revalidate
+INVOICE_CHUNK_SIZE = 256 * 1024
+
+class InvoiceFileResponse(Response):
+    """Sends `length` bytes of a file from `start`.
+    
+    Uses the ASGI zero-copy send extension (os.sendfile in the server) or
+    path send when the server offers them, and threaded chunked reads
+    otherwise.
+    """
+    
+    def __init__(self, path: str, start: int, length: int, size: int, status_code: int, headers: dict, media_type: str):
+        self.path = path
+        self.start = start
+        self.length = length
+        self.size = size
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+    
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        extensions = scope.get("extensions") or {}
+        if scope["method"].upper() == "HEAD" or not self.length:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        if "http.response.pathsend" in extensions and "http.response.zerocopysend" not in extensions \
+                and self.start == 0 and self.length == self.size:
+            await send({"type": "http.response.pathsend", "path": str(self.path)})
+            return
+        
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, open, self.path, 'rb')
+        try:
+            if "http.response.zerocopysend" in extensions:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": self.start,
+                    "count": self.length,
+                    "more_body": False
+                })
+                return
+            await loop.run_in_executor(None, f.seek, self.start)
+            remaining = self.length
+            while remaining > 0:
+                chunk = await loop.run_in_executor(None, f.read, min(INVOICE_CHUNK_SIZE, remaining))
+                remaining = remaining - len(chunk) if chunk else 0
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        finally:
+            f.close()
+
+def parse_byte_range(header: str, size: int) -> Optional[tuple]:
+    """(start, end) of a single `bytes=` range; None when the header is to be
+    ignored (malformed or multiple ranges), ValueError when unsatisfiable"""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or not (first.isdigit() or last.isdigit()):
+        return None
+    if not first.isdigit():
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("unsatisfiable range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last.isdigit() else size - 1
+    if last.isdigit() and end < start:
+        return None
+    if start >= size:
+        raise ValueError("unsatisfiable range")
+    return start, min(end, size - 1)
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """If-None-Match comparison (weak, as RFC 9110 requires for it)"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+def _read_head(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read(CONTENT_SNIFF_BYTES)
+
+@api_router.api_route("/invoices/{transaction_id}/download", methods=["GET", "HEAD"])
+async def download_invoice(
+    transaction_id: str,
+    request: Request,
+    inline: bool = False,
+    user: dict = Depends(get_current_user)
+):
+    """Download saved invoice file.
+    
+    Supports single byte ranges for in-browser PDF viewers and conditional
+    requests: the ETag is the content hash (or mtime and size for invoices
+    stored before hashing), so repeated previews get 304s.
+    """
     transaction = await db.transactions.find_one(
         {"id": transaction_id, "user_id": user["id"]},
-        {"_id": 0}
+        {"_id": 0, "invoice_path": 1, "invoice_filename": 1, "invoice_sha256": 1, "invoice_content_type": 1}
     )
     
     if not transaction:
         raise HTTPException(status_code=404, detail="Transakcija nije pronađena")
     
     invoice_path = transaction.get("invoice_path")
-    if not invoice_path or not os.path.exists(invoice_path):
+    loop = asyncio.get_running_loop()
+    try:
+        stat_result = await loop.run_in_executor(None, os.stat, invoice_path) if invoice_path else None
+    except FileNotFoundError:
+        stat_result = None
+    if stat_result is None:
         raise HTTPException(status_code=404, detail="Račun nije pronađen")
     
-    filename = transaction.get("invoice_filename", "racun.pdf")
+    filename = transaction.get("invoice_filename") or "racun.pdf"
+    digest = transaction.get("invoice_sha256")
+    etag = f'"{digest}"' if digest else f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": f"private, max-age={INVOICE_CACHE_MAX_AGE}" if INVOICE_CACHE_MAX_AGE else "private, no-cache",
+        "Accept-Ranges": "bytes"
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
     
-    def file_iterator():
-        with open(invoice_path, 'rb') as f:
-            yield from f
+    content_type = transaction.get("invoice_content_type")
+    if not content_type:
+        head = await loop.run_in_executor(None, _read_head, invoice_path)
+        content_type = sniff_content_type(head, filename)
+        await db.transactions.update_one({"id": transaction_id}, {"$set": {"invoice_content_type": content_type}})
     
-    return StreamingResponse(
-        file_iterator(),
-        media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    quoted = quote(filename)
+    disposition = "inline" if inline else "attachment"
+    headers["Content-Disposition"] = (
+        f'{disposition}; filename="{filename}"' if quoted == filename
+        else f"{disposition}; filename*=utf-8''{quoted}"
     )
+    
+    size = stat_result.st_size
+    start, length, status_code = 0, size, 200
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(length)
+    
+    return InvoiceFileResponse(invoice_path, start, length, size, status_code, headers, content_type)
 
 # ============== ZIP DOWNLOAD ==============
 
+ZIP_CHUNK_SIZE = 1024 * 1024
+# Already compressed formats are stored as-is instead of being deflated again
+ZIP_STORED_EXTENSIONS = {".pdf", ".jpg", ".jpeg", ".png", ".gif", ".zip", ".gz"}
+
+class _ZipDrain:
+    """Write-only sink for zipfile; whatever the archive writes is taken out
+    and sent by the response generator.
+    
+    Having no seek/tell, it makes ZipFile write data descriptors after each
+    entry instead of going back to patch the local headers.
+    """
+    
+    def __init__(self):
+        self.chunks = []
+        self.written = 0
+    
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.written += len(data)
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def zip_entry_name(transaction: dict, used_names: set) -> str:
+    """Archive name for a transaction's invoice, unique within the archive"""
+    vendor_name = re.sub(r'[^\w\-_]', '_', transaction.get("primatelj", "unknown")[:30])
+    date_str = transaction.get("datum_izvrsenja", "").replace("-", "")
+    original_filename = transaction.get("invoice_filename") or "racun.pdf"
+    ext = os.path.splitext(original_filename)[1] or ".pdf"
+    
+    base = f"{date_str}_{vendor_name}"
+    name = f"{base}{ext}"
+    counter = 2
+    while name.lower() in used_names:
+        name = f"{base}_{counter}{ext}"
+        counter += 1
+    return name
+
+def _open_zip_entry(archive: zipfile.ZipFile, path: str, name: str):
+    """(source file, archive entry) for an invoice, None if the file is gone"""
+    if not path or not os.path.isfile(path):
+        return None
+    zinfo = zipfile.ZipInfo.from_file(path, name)
+    ext = os.path.splitext(name)[1].lower()
+    zinfo.compress_type = zipfile.ZIP_STORED if ext in ZIP_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+    src = open(path, 'rb')
+    try:
+        # zinfo.file_size comes from the file, so entries over 4 GiB get ZIP64 headers
+        return src, archive.open(zinfo, 'w')
+    except BaseException:
+        src.close()
+        raise
+
+def _copy_zip_chunk(src, dst) -> bool:
+    chunk = src.read(ZIP_CHUNK_SIZE)
+    if chunk:
+        dst.write(chunk)
+    return len(chunk) == ZIP_CHUNK_SIZE
+
+def _close_zip_entry(src, dst):
+    try:
+        dst.close()
+    finally:
+        src.close()
+
+async def stream_invoices_zip(query: dict):
+    """Yield a ZIP of the matching transactions' invoices as it is written.
+    
+    File reads and compression run in worker threads one chunk at a time,
+    and every chunk is sent before the next is read, so memory use does not
+    depend on the number or size of the invoices.
+    """
+    loop = asyncio.get_running_loop()
+    drain = _ZipDrain()
+    archive = zipfile.ZipFile(drain, 'w', allowZip64=True)
+    used_names = set()
+    
+    cursor = db.transactions.find(
+        query,
+        {"_id": 0, "invoice_path": 1, "invoice_filename": 1, "primatelj": 1, "datum_izvrsenja": 1}
+    )
+    try:
+        async for t in cursor:
+            name = zip_entry_name(t, used_names)
+            entry = await loop.run_in_executor(None, _open_zip_entry, archive, t.get("invoice_path"), name)
+            if entry is None:
+                continue
+            used_names.add(name.lower())
+            
+            src, dst = entry
+            try:
+                more = True
+                while more:
+                    more = await loop.run_in_executor(None, _copy_zip_chunk, src, dst)
+                    data = drain.take()
+                    if data:
+                        yield data
+            finally:
+                await loop.run_in_executor(None, _close_zip_entry, src, dst)
+            yield drain.take()
+        
+        # Central directory (with ZIP64 records when needed)
+        archive.close()
+        yield drain.take()
+    finally:
+        await cursor.close()
+        if metrics:
+            metrics.zip_export_bytes.inc(drain.written)
+
 @api_router.get("/export/zip/{batch_id}")
 async def export_zip(batch_id: str, user: dict = Depends(get_current_user)):
     """Download all invoices from a batch as ZIP"""
-    transactions = await db.transactions.find(
-        {
-            "batch_id": batch_id, 
-            "user_id": user["id"],
-            "invoice_path": {"$exists": True, "$ne": None}
-        },
-        {"_id": 0}
-    ).to_list(10000)
-    
-    if not transactions:
+    query = {
+        "batch_id": batch_id,
+        "user_id": user["id"],
+        "invoice_path": {"$exists": True, "$ne": None}
+    }
+    if not await db.transactions.find_one(query, {"_id": 1}):
         raise HTTPException(status_code=404, detail="Nema preuzetih računa za download")
     
-    # Create ZIP in memory
-    zip_buffer = io.BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for t in transactions:
-            invoice_path = t.get("invoice_path")
-            if invoice_path and os.path.exists(invoice_path):
-                # Create a nice filename
-                vendor_name = re.sub(r'[^\w\-_]', '_', t.get("primatelj", "unknown")[:30])
-                date_str = t.get("datum_izvrsenja", "").replace("-", "")
-                original_filename = t.get("invoice_filename", "racun.pdf")
-                ext = os.path.splitext(original_filename)[1] or ".pdf"
-                
-                archive_filename = f"{date_str}_{vendor_name}{ext}"
-                
-                with open(invoice_path, 'rb') as f:
-                    zip_file.writestr(archive_filename, f.read())
-    
-    zip_buffer.seek(0)
-    
     # Get batch info for filename
     batch = await db.batches.find_one({"id": batch_id, "user_id": user["id"]}, {"_id": 0})
     batch_name = f"{batch['month']}_{batch['year']}" if batch else batch_id[:8]
     
     return StreamingResponse(
-        zip_buffer,
+        stream_invoices_zip(query),
         media_type="application/zip",
         headers={"Content-Disposition": f"attachment; filename=racuni_{batch_name}.zip"}
-# Mount API router at /api prefix (main usage)
-app.include_router(api_router, prefix="/api")
-
-
     )
 
 # ============== ROOT ==============
@@ -1361,18 +4860,71 @@ async def root():
 async def health():
     return {"status": "healthy"}
 
+@api_router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus scrape endpoint, 404 unless METRICS_ENABLED"""
+    if not metrics:
+        raise HTTPException(status_code=404, detail="Metrike nisu uključene")
+    body, content_type = metrics.exposition()
+    return Response(content=body, media_type=content_type)
+
+# Mount API router at /api prefix (main usage)
+app.include_router(api_router, prefix="/api")
+
 # Include router at root for backward compatibility (optional)
 # This makes endpoints also available without /api prefix, e.g. /auth/register
 app.include_router(api_router)
 
+if metrics:
+    app.add_middleware(RequestMetricsMiddleware, routes=api_router.routes)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    # Paging and invoice download headers the frontend reads from another origin
+    expose_headers=[
+        "X-Next-Cursor", "X-Total-Count",
+        "Content-Disposition", "ETag", "Accept-Ranges", "Content-Range"
+    ],
 )
 
+background_tasks = []
+
+async def prepare_database():
+    if MONGO_ENSURE_INDEXES:
+        await ensure_indexes()
+    await run_migrations()
+
+@app.on_event("startup")
+async def start_background_workers():
+    background_tasks.append(asyncio.create_task(prepare_database()))
+    background_tasks.extend(start_search_job_workers(SEARCH_JOB_WORKERS))
+    background_tasks.append(asyncio.create_task(mail_pool_reaper()))
+    if COUNTER_RECONCILE_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(counter_reconcile_worker()))
+    if USER_CACHE_ENABLED:
+        background_tasks.append(asyncio.create_task(user_cache.sync_worker()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
     client.close()
+    mail_pool.close_all()
+    mail_executor.shutdown(wait=False)
+    password_hasher.shutdown()
+
+async def run_search_job_workers(count: int):
+    await asyncio.gather(mail_pool_reaper(), *start_search_job_workers(count))
+
+if __name__ == "__main__":
+    # Dedicated job worker node: `python server.py`
+    # (run the API nodes with SEARCH_JOB_WORKERS=0 to keep mailbox work off them)
+    try:
+        asyncio.run(run_search_job_workers(max(SEARCH_JOB_WORKERS, 1)))
+    finally:
+        mail_pool.close_all()
+        mail_executor.shutdown(wait=False)
@@ -0,0 +1,88 @@
+import hashlib
+import os
+import sys
+from pathlib import Path
+
+import mongomock.collection
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from pymongo import ReturnDocument
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "finzen_test")
+os.environ.setdefault("JWT_SECRET", "finzen-test-secret-key-of-at-least-32-bytes")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+_find_one_and_update = mongomock.collection.Collection.find_one_and_update
+
+
+def _find_one_and_update_after(self, filter, update, projection=None, sort=None, upsert=False,
+                               return_document=ReturnDocument.BEFORE, **kwargs):
+    """mongomock loses the document for ReturnDocument.AFTER when a sort is
+    given; look it up again by _id like the server would return it"""
+    if return_document != ReturnDocument.AFTER:
+        return _find_one_and_update(self, filter, update, projection, sort, upsert, return_document, **kwargs)
+    before = _find_one_and_update(self, filter, update, {"_id": 1}, sort, upsert, ReturnDocument.BEFORE, **kwargs)
+    if before is None:
+        if upsert:
+            return _find_one_and_update(self, filter, update, projection, sort, False, ReturnDocument.AFTER, **kwargs)
+        return None
+    return self.find_one({"_id": before["_id"]}, projection)
+
+
+mongomock.collection.Collection.find_one_and_update = _find_one_and_update_after
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """In-memory MongoDB in place of the server's database"""
+    database = AsyncMongoMockClient()["finzen_test"]
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+@pytest.fixture
+def user():
+    return {"id": "u1", "email": "ana@example.com", "name": "Ana"}
+
+
+@pytest.fixture
+def client(db, user):
+    """API client authenticated as the user fixture"""
+    from fastapi.testclient import TestClient
+
+    server.app.dependency_overrides[server.get_current_user] = lambda: user
+    yield TestClient(server.app)
+    server.app.dependency_overrides.clear()
+
+
+@pytest.fixture
+def invoice_file(db, tmp_path):
+    """Factory storing an invoice file and a downloaded transaction pointing at it"""
+    async def create(transaction_id: str, content: bytes, **fields):
+        path = tmp_path / f"{transaction_id}.pdf"
+        path.write_bytes(content)
+        await db.transactions.insert_one({
+            "id": transaction_id,
+            "user_id": "u1",
+            "batch_id": "b1",
+            "status": "downloaded",
+            "datum_izvrsenja": "01-12-2025",
+            "primatelj": "HEP d.d.",
+            "invoice_path": str(path),
+            "invoice_filename": "racun.pdf",
+            "invoice_sha256": hashlib.sha256(content).hexdigest(),
+            "invoice_content_type": "application/pdf",
+            **fields
+        })
+        return path
+
+    return create
@@ -0,0 +1,35 @@
+import pytest
+
+import server
+
+ADMIN_ENDPOINTS = [
+    "/api/diagnostics/query-plans",
+    "/api/email/pool-stats",
+    "/api/email/cache-stats",
+    "/api/auth/cache-stats",
+]
+
+
+@pytest.fixture
+def no_explain(monkeypatch):
+    """mongomock has no explain command"""
+    async def explain_query_probes(user_id):
+        return []
+
+    monkeypatch.setattr(server, "explain_query_probes", explain_query_probes)
+
+
+@pytest.mark.parametrize("path", ADMIN_ENDPOINTS)
+def test_operational_endpoints_are_refused_to_ordinary_users(client, path):
+    response = client.get(path)
+
+    assert response.status_code == 403
+
+
+@pytest.mark.parametrize("path", ADMIN_ENDPOINTS)
+def test_operational_endpoints_are_served_to_admins(client, user, monkeypatch, no_explain, path):
+    monkeypatch.setattr(server, "ADMIN_EMAILS", {user["email"]})
+
+    response = client.get(path)
+
+    assert response.status_code == 200
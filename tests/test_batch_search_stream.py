@@ -0,0 +1,104 @@
+import asyncio
+import json
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+USER = {"id": "u1", "email": "ana@example.com", "name": "Ana",
+        "zoho_email": "ana@example.com", "zoho_app_password": "secret"}
+
+
+class StallingSearcher:
+    """Answers the first search at once; later ones hang until cancelled"""
+
+    def __init__(self):
+        self.searches = 0
+        self.cancelled = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def search_emails_multi(self, terms, date_from=None, date_to=None):
+        self.searches += 1
+        if self.searches > 1:
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+        invoice = {
+            "email_id": "7", "subject": "HEP račun", "from": "HEP <racuni@hep.hr>", "date": "",
+            "attachments": [{"filename": "racun.pdf", "is_pdf": True}], "has_pdf": True,
+        }
+        return [[invoice]] + [[] for _ in terms[1:]]
+
+
+@pytest.fixture
+def searcher(db, monkeypatch):
+    searcher = StallingSearcher()
+
+    async def get_mail_index_searcher(user):
+        return searcher
+
+    monkeypatch.setattr(server, "get_mail_index_searcher", get_mail_index_searcher)
+    server.app.dependency_overrides[server.get_current_user] = lambda: USER
+    yield searcher
+    server.app.dependency_overrides.clear()
+
+
+async def stream_until_first_result(transaction_ids):
+    """Run the stream endpoint over ASGI, disconnecting once a result event
+    has been sent; returns the body sent before the disconnect"""
+    body = json.dumps({"transaction_ids": transaction_ids}).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/api/email/batch-search/stream", "raw_path": b"/api/email/batch-search/stream",
+        "root_path": "", "query_string": b"", "client": ("127.0.0.1", 5000), "server": ("testserver", 80),
+        "headers": [(b"host", b"testserver"), (b"content-type", b"application/json")],
+    }
+    sent = []
+    first_result = asyncio.Event()
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await first_result.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            sent.append(message.get("body", b""))
+            if b"event: result" in b"".join(sent):
+                first_result.set()
+
+    await asyncio.wait_for(server.app(scope, receive, send), 5)
+    return b"".join(sent).decode()
+
+
+async def test_disconnect_cancels_the_searches_still_running(db, searcher):
+    await db.transactions.insert_many([
+        {"id": f"t{i}", "user_id": "u1", "batch_id": "b1", "status": "pending",
+         "datum_izvrsenja": "01.12.2025", "primatelj": "HEP d.d.", "opis_transakcije": "Račun", "iznos": "-10,00"}
+        for i in range(3)
+    ])
+
+    sent = await stream_until_first_result(["t0", "t1", "t2"])
+
+    assert sent.startswith("event: start")
+    assert "event: done" not in sent
+    for _ in range(100):
+        if not server.search_streams:
+            break
+        await asyncio.sleep(0.01)
+    assert not server.search_streams
+    assert searcher.searches == 3
+    assert searcher.cancelled == 2
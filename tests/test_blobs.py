@@ -0,0 +1,92 @@
+import mongomock_motor
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def blob_root(tmp_path):
+    return tmp_path / "blobs"
+
+
+@pytest.fixture
+def store(db, blob_root, monkeypatch):
+    store = server.BlobStore(blob_root)
+    monkeypatch.setattr(server, "blob_store", store)
+    return store
+
+
+def stage(store, content: bytes):
+    return store.stage(lambda out: out.write(content) or True)
+
+
+def hook_blobs_delete_one(monkeypatch, before=None, after=None):
+    """Run callbacks around delete_one on the blobs collection, standing in
+    for another process acting in between"""
+    original = mongomock_motor.AsyncMongoMockCollection.delete_one
+
+    async def delete_one(self, *args, **kwargs):
+        if self.name == "blobs" and before:
+            await before()
+        result = await original(self, *args, **kwargs)
+        if self.name == "blobs" and after:
+            await after()
+        return result
+
+    monkeypatch.setattr(mongomock_motor.AsyncMongoMockCollection, "delete_one", delete_one)
+
+
+async def refcount(db, digest):
+    blob = await db.blobs.find_one({"sha256": digest})
+    return blob["refcount"] if blob else None
+
+
+async def test_identical_content_is_stored_once_and_removed_with_last_reference(db, store):
+    tmp_a, digest, size, _ = stage(store, b"%PDF-1.4 invoice")
+    tmp_b, digest_b, _, _ = stage(store, b"%PDF-1.4 invoice")
+    assert digest_b == digest
+
+    path = await store.commit(tmp_a, digest, size)
+    await store.commit(tmp_b, digest, size)
+    assert path.read_bytes() == b"%PDF-1.4 invoice"
+    assert await refcount(db, digest) == 2
+    assert not list(store.tmp_dir.iterdir())
+
+    await store.release(digest)
+    assert path.exists()
+    await store.release(digest)
+    assert not path.exists()
+    assert await refcount(db, digest) is None
+
+
+async def test_release_keeps_file_when_another_process_took_a_reference(db, store, monkeypatch):
+    tmp, digest, size, _ = stage(store, b"shared")
+    path = await store.commit(tmp, digest, size)
+
+    async def take_reference():
+        await db.blobs.update_one({"sha256": digest}, {"$inc": {"refcount": 1}})
+
+    hook_blobs_delete_one(monkeypatch, before=take_reference)
+    await store.release(digest)
+
+    assert path.exists()
+    assert await refcount(db, digest) == 1
+
+
+async def test_commit_racing_a_release_in_another_process_keeps_its_file(db, store, blob_root, monkeypatch):
+    other = server.BlobStore(blob_root)
+    tmp, digest, size, _ = stage(store, b"raced")
+    path = await store.commit(tmp, digest, size)
+
+    async def commit_elsewhere():
+        staged_tmp, _, _, _ = stage(other, b"raced")
+        await other.commit(staged_tmp, digest, size)
+
+    hook_blobs_delete_one(monkeypatch, after=commit_elsewhere)
+    await store.release(digest)
+
+    assert path.read_bytes() == b"raced"
+    assert await refcount(db, digest) == 1
+    assert not list(store.tmp_dir.iterdir())
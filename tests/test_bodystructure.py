@@ -0,0 +1,89 @@
+import pytest
+
+import server
+
+
+def attachments(data):
+    """Attachment listing from raw imaplib FETCH response data"""
+    message = server.parse_fetch_response(data)[0]
+    return server.attachments_from_bodystructure(message["BODYSTRUCTURE"])
+
+
+def parts(data):
+    message = server.parse_fetch_response(data)[0]
+    return server.parse_bodystructure(message["BODYSTRUCTURE"])
+
+
+NESTED = [
+    b'1 (UID 42 BODYSTRUCTURE ('
+    b'(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL NIL)'
+    b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 480 10 NIL NIL NIL NIL)'
+    b' "ALTERNATIVE" ("BOUNDARY" "b2") NIL NIL NIL)'
+    b'("APPLICATION" "PDF" ("NAME" "racun.pdf") NIL NIL "BASE64" 20480 NIL'
+    b' ("ATTACHMENT" ("FILENAME" "racun.pdf")) NIL NIL)'
+    b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 900'
+    b' (NIL "Fwd: racun" NIL NIL NIL NIL NIL NIL NIL NIL)'
+    b' ("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)'
+    b' 20 NIL ("ATTACHMENT" ("FILENAME" "proslijedeno.eml")) NIL NIL)'
+    b' "MIXED" ("BOUNDARY" "b1") NIL NIL NIL))'
+]
+
+
+def test_nested_multipart_parts_are_numbered_like_imap():
+    assert [(p["part"], p["content_type"], p["encoding"], p["size"]) for p in parts(NESTED)] == [
+        ("1.1", "text/plain", "quoted-printable", 120),
+        ("1.2", "text/html", "quoted-printable", 480),
+        ("2", "application/pdf", "base64", 20480),
+        ("3", "message/rfc822", "7bit", 900),
+    ]
+    assert [(a["filename"], a["part"], a["is_pdf"]) for a in attachments(NESTED)] == [
+        ("racun.pdf", "2", True),
+        ("proslijedeno.eml", "3", False),
+    ]
+
+
+def test_single_part_message_is_part_one():
+    data = [b'1 (UID 5 BODYSTRUCTURE ("APPLICATION" "PDF" ("NAME" "a.pdf") NIL NIL "BASE64" 300 NIL NIL NIL NIL))']
+
+    assert [(a["part"], a["filename"]) for a in attachments(data)] == [("1", "a.pdf")]
+
+
+@pytest.mark.parametrize("params, filename", [
+    (b'("FILENAME*" "utf-8\'\'Ra%C4%8Dun%20br.%2012.pdf")', "Račun br. 12.pdf"),
+    (b'("FILENAME*0*" "utf-8\'\'Ra%C4%8Dun_" "FILENAME*1*" "prosinac%202025.pdf")', "Račun_prosinac 2025.pdf"),
+    (b'("FILENAME*0" "racun_za_" "FILENAME*1" "prosinac.pdf")', "racun_za_prosinac.pdf"),
+    (b'("FILENAME" "=?utf-8?B?UmHEjXVuLnBkZg==?=")', "Račun.pdf"),
+    (b'("FILENAME" "a \\"b\\" (c).pdf")', 'a "b" (c).pdf'),
+])
+def test_disposition_filenames_are_decoded(params, filename):
+    data = [
+        b'1 (UID 7 BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 10 1 NIL NIL NIL NIL)'
+        b'("APPLICATION" "OCTET-STREAM" NIL NIL NIL "BASE64" 1000 NIL ("ATTACHMENT" ' + params + b') NIL NIL)'
+        b' "MIXED" ("BOUNDARY" "b1") NIL NIL NIL))'
+    ]
+
+    assert [a["filename"] for a in attachments(data)] == [filename]
+    assert attachments(data)[0]["is_pdf"]
+
+
+def test_literal_strings_are_read_from_the_literal():
+    data = [
+        (b'1 (UID 9 BODYSTRUCTURE ("APPLICATION" "PDF" NIL NIL NIL "BASE64" 300 NIL ("ATTACHMENT" ("FILENAME" {14}',
+         'Račun (1).pdf'.encode()),
+        b')) NIL NIL))',
+    ]
+
+    assert [(a["filename"], a["size"]) for a in attachments(data)] == [("Račun (1).pdf", 300)]
+
+
+def test_header_fetch_literal_and_bodystructure_share_a_response():
+    data = [
+        (b'1 (UID 11 BODY[HEADER.FIELDS (FROM SUBJECT)] {32}', b'From: a@b.hr\r\nSubject: Racun\r\n\r\n'),
+        b' BODYSTRUCTURE ("APPLICATION" "PDF" ("NAME" "r.pdf") NIL NIL "BASE64" 10 NIL NIL NIL NIL))',
+    ]
+
+    message = server.parse_fetch_response(data)[0]
+
+    assert message["UID"] == "11"
+    assert message["BODY[HEADER.FIELDS (FROM SUBJECT)]"].startswith(b"From: a@b.hr")
+    assert server.attachments_from_bodystructure(message["BODYSTRUCTURE"])[0]["filename"] == "r.pdf"
@@ -0,0 +1,125 @@
+import pytest
+from mongomock_motor import AsyncMongoMockCollection
+from pymongo.errors import BulkWriteError
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def insert_transactions(db, count, batch_id="b1", status="pending"):
+    await db.transactions.insert_many([
+        {
+            "id": f"t{i}",
+            "user_id": "u1",
+            "batch_id": batch_id,
+            "status": status,
+            "amount_cents": -100 * (i + 1),
+            "datum_izvrsenja": "01.12.2025",
+            "primatelj": f"Vendor {i}",
+            "opis_transakcije": "Racun",
+            "iznos": "-1,00",
+            "created_at": "2025-12-01T00:00:00+00:00",
+        }
+        for i in range(count)
+    ])
+    await server.reconcile_counters("u1")
+
+
+def patch_transactions_bulk_write(monkeypatch, replacement):
+    """Route db.transactions.bulk_write through replacement(bulk_write, operations, **kwargs)"""
+    original = AsyncMongoMockCollection.bulk_write
+
+    async def bulk_write(self, operations, **kwargs):
+        if self.name != "transactions":
+            return await original(self, operations, **kwargs)
+        return await replacement(lambda ops, **kw: original(self, ops, **kw), operations, **kwargs)
+
+    # Collection objects are created per attribute access, so patch the class
+    monkeypatch.setattr(AsyncMongoMockCollection, "bulk_write", bulk_write)
+
+
+async def assert_counters_exact(db):
+    """Counters match a recount from the transactions"""
+    assert await server.reconcile_counters("u1") == 0
+
+
+async def assert_no_write_tags(db):
+    assert await db.transactions.count_documents({"write_batch_id": {"$exists": True}}) == 0
+
+
+async def test_counters_follow_inserts_updates_and_deletes(db):
+    await insert_transactions(db, 4)
+    await server.update_transaction_fields({"id": "t0", "user_id": "u1"}, {"status": "downloaded"})
+    await server.delete_transactions({"id": "t1", "user_id": "u1"})
+
+    counters = await server.get_user_counters("u1")
+    assert counters["total"] == 3
+    assert counters["amount_cents"] == -100 - 300 - 400
+    assert counters["status"] == {"pending": 2, "downloaded": 1}
+    await assert_counters_exact(db)
+
+
+async def test_write_batch_flushes_all_updates(db):
+    await insert_transactions(db, 3)
+    writes = server.TransactionWriteBatch("u1")
+    writes.update("t0", {"status": "found"})
+    writes.update("t1", {"status": "manual"})
+    writes.update("t1", {"search_confidence": 0})
+    writes.update("missing", {"status": "found"})
+
+    updated = await writes.flush()
+
+    assert {tid: t["status"] for tid, t in updated.items()} == {"t0": "found", "t1": "manual"}
+    assert (await db.transactions.find_one({"id": "t1"}))["search_confidence"] == 0
+    await assert_counters_exact(db)
+    await assert_no_write_tags(db)
+
+
+async def test_write_batch_partial_bulk_failure_keeps_counters_exact(db, monkeypatch):
+    await insert_transactions(db, 4)
+    async def partly_failing_bulk_write(bulk_write, operations, **kwargs):
+        # The first two land, the rest fail with write errors
+        result = await bulk_write(operations[:2], **kwargs)
+        raise BulkWriteError({
+            "writeErrors": [
+                {"index": index, "code": 91, "errmsg": "shutdown in progress"}
+                for index in range(2, len(operations))
+            ],
+            "nMatched": result.matched_count,
+            "nModified": result.modified_count,
+        })
+
+    patch_transactions_bulk_write(monkeypatch, partly_failing_bulk_write)
+    writes = server.TransactionWriteBatch("u1")
+    for i in range(4):
+        writes.update(f"t{i}", {"status": "downloaded"})
+
+    updated = await writes.flush()
+
+    assert sorted(updated) == ["t0", "t1", "t2", "t3"]
+    counters = await server.get_user_counters("u1")
+    assert counters["status"] == {"pending": 0, "downloaded": 4}
+    await assert_counters_exact(db)
+    await assert_no_write_tags(db)
+
+
+async def test_write_batch_concurrent_status_change_keeps_counters_exact(db, monkeypatch):
+    await insert_transactions(db, 3)
+    async def racing_bulk_write(bulk_write, operations, **kwargs):
+        # Another request moves t0 between the read and the write
+        await server.update_transaction_fields({"id": "t0", "user_id": "u1"}, {"status": "manual"})
+        return await bulk_write(operations, **kwargs)
+
+    patch_transactions_bulk_write(monkeypatch, racing_bulk_write)
+    writes = server.TransactionWriteBatch("u1")
+    for i in range(3):
+        writes.update(f"t{i}", {"status": "found"})
+
+    updated = await writes.flush()
+
+    assert {tid: t["status"] for tid, t in updated.items()} == {"t0": "found", "t1": "found", "t2": "found"}
+    counters = await server.get_user_counters("u1")
+    assert counters["status"] == {"pending": 0, "manual": 0, "found": 3}
+    await assert_counters_exact(db)
+    await assert_no_write_tags(db)
@@ -0,0 +1,81 @@
+import mongomock_motor
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+HEADER = "Datum izvrsenja,Primatelj,Opis transakcije,Ukupan iznos\r\n"
+
+
+def statement_row(i, recipient="Vendor"):
+    return f"01.12.2025,{recipient} {i},Racun {i},\"-{i},00\"\r\n"
+
+
+def record_insert_chunks(monkeypatch):
+    """Sizes of the insert_many calls on the transactions collection"""
+    chunks = []
+    original = mongomock_motor.AsyncMongoMockCollection.insert_many
+
+    async def insert_many(self, documents, *args, **kwargs):
+        if self.name == "transactions":
+            chunks.append(len(documents))
+        return await original(self, documents, *args, **kwargs)
+
+    monkeypatch.setattr(mongomock_motor.AsyncMongoMockCollection, "insert_many", insert_many)
+    return chunks
+
+
+async def assert_batch_counted(db, batch_id, total, amount_cents):
+    counter = await db.counters.find_one({"_id": f"batch:{batch_id}"})
+    assert counter["total"] == total
+    assert counter["amount_cents"] == amount_cents
+    assert counter["status"] == {"pending": total}
+    assert await server.reconcile_counters("u1") == 0
+
+
+async def test_statement_is_inserted_in_chunks(db, client, monkeypatch):
+    monkeypatch.setattr(server, "CSV_INSERT_CHUNK_SIZE", 3)
+    chunks = record_insert_chunks(monkeypatch)
+    content = HEADER + "".join(statement_row(i) for i in range(1, 8)) + "01.12.2025,,,\r\n"
+
+    response = client.post("/api/upload/csv", files={"file": ("izvod.csv", content.encode(), "text/csv")})
+
+    assert response.status_code == 200
+    batch_id = response.json()["batch_id"]
+    assert response.json()["transaction_count"] == 7
+    assert chunks == [3, 3, 1]
+    stored = await db.transactions.find({"batch_id": batch_id}).to_list(None)
+    assert sorted(t["primatelj"] for t in stored) == [f"Vendor {i}" for i in range(1, 8)]
+    batch = await db.batches.find_one({"id": batch_id})
+    assert (batch["status"], batch["transaction_count"], batch["processed_rows"]) == ("completed", 7, 8)
+    await assert_batch_counted(db, batch_id, 7, -2800)
+
+
+async def test_late_cp1250_byte_replaces_rows_inserted_as_utf8(db, client, monkeypatch):
+    monkeypatch.setattr(server, "CSV_INSERT_CHUNK_SIZE", 50)
+    monkeypatch.setattr(server, "CSV_ENCODING_PROBE_BYTES", 1024)
+    chunks = record_insert_chunks(monkeypatch)
+    deleted = []
+    delete_batch_transactions = server.delete_batch_transactions
+
+    async def record_delete(user_id, batch_id):
+        deleted.append(batch_id)
+        return await delete_batch_transactions(user_id, batch_id)
+
+    monkeypatch.setattr(server, "delete_batch_transactions", record_delete)
+    # Well past the probe and the text decoder's first read, so some rows go in as UTF-8 first
+    content = (HEADER + "".join(statement_row(i) for i in range(1, 400))).encode("ascii")
+    content += statement_row(400, "Ljekarna Čačić").encode("cp1250")
+
+    response = client.post("/api/upload/csv", files={"file": ("izvod.csv", content, "text/csv")})
+
+    assert response.status_code == 200
+    batch_id = response.json()["batch_id"]
+    assert response.json()["transaction_count"] == 400
+    assert deleted == [batch_id]
+    assert sum(chunks) > 400
+    stored = await db.transactions.find({"batch_id": batch_id}).to_list(None)
+    assert len(stored) == len({t["primatelj"] for t in stored}) == 400
+    assert {"Ljekarna Čačić 400", "Vendor 1"} <= {t["primatelj"] for t in stored}
+    await assert_batch_counted(db, batch_id, 400, -sum(range(1, 401)) * 100)
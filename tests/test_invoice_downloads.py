@@ -0,0 +1,51 @@
+import hashlib
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+CONTENT = b"%PDF-1.4 " + bytes(range(256)) * 4
+
+
+async def test_download_sends_etag_and_answers_revalidation_with_304(invoice_file, client):
+    await invoice_file("t1", CONTENT)
+
+    response = client.get("/api/invoices/t1/download")
+    assert response.status_code == 200
+    assert response.content == CONTENT
+    etag = response.headers["ETag"]
+    assert etag == f'"{hashlib.sha256(CONTENT).hexdigest()}"'
+
+    revalidated = client.get("/api/invoices/t1/download", headers={"If-None-Match": f"W/{etag}"})
+    assert revalidated.status_code == 304
+    assert not revalidated.content
+
+
+async def test_download_serves_byte_ranges(invoice_file, client):
+    await invoice_file("t1", CONTENT)
+    size = len(CONTENT)
+
+    partial = client.get("/api/invoices/t1/download", headers={"Range": "bytes=100-199"})
+    assert partial.status_code == 206
+    assert partial.headers["Content-Range"] == f"bytes 100-199/{size}"
+    assert partial.content == CONTENT[100:200]
+
+    suffix = client.get("/api/invoices/t1/download", headers={"Range": "bytes=-10"})
+    assert suffix.status_code == 206
+    assert suffix.content == CONTENT[-10:]
+
+    beyond = client.get("/api/invoices/t1/download", headers={"Range": f"bytes={size}-"})
+    assert beyond.status_code == 416
+    assert beyond.headers["Content-Range"] == f"bytes */{size}"
+
+
+async def test_range_with_stale_if_range_gets_the_whole_file(invoice_file, client):
+    await invoice_file("t1", CONTENT)
+
+    response = client.get(
+        "/api/invoices/t1/download",
+        headers={"Range": "bytes=0-9", "If-Range": '"outdated"'}
+    )
+
+    assert response.status_code == 200
+    assert response.content == CONTENT
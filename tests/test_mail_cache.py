@@ -0,0 +1,91 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeMailbox:
+    """ZohoMailClient stand-in that counts the IMAP work it is asked for"""
+
+    def __init__(self):
+        self.uidnext = 10
+        self.status_calls = 0
+        self.searches = []
+        self.attachment_lookups = []
+
+    def get_mailbox_status(self, folder):
+        self.status_calls += 1
+        return {"messages": 3, "uidnext": self.uidnext, "uidvalidity": 7, "highestmodseq": None}
+
+    def search_emails_multi(self, terms, date_from, date_to, folder, ignore_date):
+        self.searches.append(list(terms))
+        return [
+            [{"email_id": "5", "subject": f"Račun {term}", "attachments": [{"filename": "racun.pdf"}]}]
+            for term in terms
+        ]
+
+    def get_email_attachments(self, email_id, folder):
+        self.attachment_lookups.append(email_id)
+        return []
+
+
+@pytest.fixture
+def mail_cache(db, monkeypatch):
+    cache = server.MailCache(use_mongo=False)
+    monkeypatch.setattr(server, "mail_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def session(mail_cache, user):
+    session = server.AsyncMailSession(user)
+    session.client = FakeMailbox()
+    return session
+
+
+def status_interval_elapses(mail_cache):
+    mail_cache.generations.delete_where(lambda key: True)
+
+
+async def test_search_entry_is_dropped_when_uidnext_moves(mail_cache):
+    key = ("search", "u1", "INBOX", 7, "hep", None, None, False)
+    await mail_cache.set(key, [{"email_id": "5"}], uidnext=10)
+
+    assert await mail_cache.get(key, 10) == [{"email_id": "5"}]
+    assert await mail_cache.get(key, 11) is None
+
+
+async def test_new_mail_invalidates_cached_searches_but_not_attachment_listings(session, mail_cache):
+    mailbox = session.client
+
+    first = await session.search_emails_multi(["HEP", "A1"])
+    again = await session.search_emails_multi(["A1", "HEP"])
+    assert again == first[::-1]
+    assert mailbox.searches == [["HEP", "A1"]]
+    assert mailbox.status_calls == 1
+
+    # New mail arrived; the next STATUS reports it
+    mailbox.uidnext = 12
+    await session.search_emails_multi(["HEP"])
+    assert mailbox.searches == [["HEP", "A1"]]
+    status_interval_elapses(mail_cache)
+    await session.search_emails_multi(["HEP"])
+    assert mailbox.searches == [["HEP", "A1"], ["HEP"]]
+
+    assert await session.get_email_attachments("5") == [{"filename": "racun.pdf"}]
+    assert mailbox.attachment_lookups == []
+
+
+async def test_results_shared_through_mongo_follow_uidnext(db, user):
+    writer = server.MailCache(use_mongo=True)
+    reader = server.MailCache(use_mongo=True)
+    key = ("search", user["id"], "INBOX", 7, "hep", None, None, False)
+
+    await writer.set(key, [{"email_id": "5"}], uidnext=10)
+
+    assert await reader.get(key, 11) is None
+    assert await reader.get(key, 10) == [{"email_id": "5"}]
+    assert reader.mongo_hits == 1
+    await writer.invalidate_user(user["id"])
+    assert await server.MailCache(use_mongo=True).get(key, 10) is None
@@ -0,0 +1,162 @@
+import asyncio
+import gc
+import imaplib
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+USER = {"id": "u1", "zoho_email": "me@example.com", "zoho_app_password": "secret"}
+KEY = {"user_id": "u1", "folder": "INBOX"}
+
+
+class FakeMailbox:
+    """Async stand-in for AsyncMailSession over an in-memory folder"""
+
+    def __init__(self, messages, uidvalidity=7):
+        self.messages = dict(messages)  # uid -> raw From header
+        self.uidvalidity = uidvalidity
+        self.failing_uids = set()
+        self.fetched = []
+
+    def __call__(self, user):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    async def get_mailbox_status(self, folder):
+        return {
+            "messages": len(self.messages),
+            "uidnext": max(self.messages, default=0) + 1,
+            "uidvalidity": self.uidvalidity,
+            "highestmodseq": None
+        }
+
+    async def list_uids(self, folder, min_uid=1):
+        return sorted(uid for uid in self.messages if uid >= min_uid)
+
+    async def fetch_index_records(self, uids, folder="INBOX"):
+        if self.failing_uids & set(uids):
+            raise imaplib.IMAP4.error("UID FETCH INBOX failed")
+        self.fetched.extend(uids)
+        return [
+            {
+                "uid": uid,
+                "subject": f"Račun {uid}",
+                "from": self.messages[uid],
+                "from_search": server.decode_mime_header(self.messages[uid]).casefold(),
+                "date": "",
+                "internal_date": None,
+                "attachments": [],
+                "has_pdf": False
+            }
+            for uid in uids
+        ]
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(server, "MAIL_INDEX_FETCH_CHUNK", 2)
+
+
+async def indexed_uids(db):
+    return sorted(await db.mail_index.distinct("uid", KEY))
+
+
+def test_fetch_index_records_raises_when_fetch_fails():
+    class Connection:
+        def uid(self, command, *args):
+            return "NO", [b"FETCH failed"]
+
+    client = server.ZohoMailClient("me@example.com", "secret")
+    client.connection = Connection()
+    client.selected_folder = "INBOX"
+
+    with pytest.raises(imaplib.IMAP4.error):
+        client.fetch_index_records([1, 2])
+
+
+async def test_failed_fetch_does_not_advance_uidnext(db, small_chunks):
+    mailbox = FakeMailbox({uid: "a@b.hr" for uid in range(1, 6)})
+    mailbox.failing_uids = {3}
+
+    with pytest.raises(imaplib.IMAP4.error):
+        await server.sync_mail_index(mailbox, USER)
+
+    state = await db.mail_index_state.find_one(KEY)
+    assert state["uidnext"] == 3
+    assert not state["synced_at"]
+
+    mailbox.failing_uids = set()
+    await server.sync_mail_index(mailbox, USER)
+    assert await indexed_uids(db) == [1, 2, 3, 4, 5]
+
+
+async def test_reconcile_backfills_missing_and_drops_expunged_uids(db):
+    mailbox = FakeMailbox({uid: "a@b.hr" for uid in range(1, 5)})
+    await server.sync_mail_index(mailbox, USER)
+    await db.mail_index.delete_one({**KEY, "uid": 2})
+    mailbox.messages[5] = "a@b.hr"
+
+    await server.sync_mail_index(mailbox, USER)
+    assert await indexed_uids(db) == [1, 2, 3, 4, 5]
+
+    del mailbox.messages[4]
+    mailbox.messages[6] = "a@b.hr"
+    mailbox.messages[7] = "a@b.hr"
+
+    await server.sync_mail_index(mailbox, USER)
+    assert await indexed_uids(db) == [1, 2, 3, 5, 6, 7]
+
+
+async def test_sender_matches_decoded_header_case_insensitively(db):
+    mailbox = FakeMailbox({
+        1: "=?utf-8?b?WmFncmViYcSNa2kgSG9sZGluZw==?= <racuni@zgh.hr>",
+        2: "HEP <noreply@hep.hr>"
+    })
+    await server.sync_mail_index(mailbox, USER)
+    searcher = server.MailIndexSearcher(USER)
+
+    results = await searcher.search_emails("HOLDING")
+
+    assert [r["email_id"] for r in results] == ["1"]
+    assert results[0]["from"].startswith("=?utf-8?b?")
+
+
+async def test_first_sync_runs_in_background(db, monkeypatch):
+    mailbox = FakeMailbox({uid: "a@b.hr" for uid in range(1, 4)})
+    monkeypatch.setattr(server, "AsyncMailSession", mailbox)
+    monkeypatch.setattr(server, "MAIL_INDEX_ENABLED", True)
+
+    assert await server.get_mail_index_searcher(USER) is None
+    task = server._mail_index_tasks[("u1", "INBOX")]
+    assert await server.get_mail_index_searcher(USER) is None
+    assert server._mail_index_tasks[("u1", "INBOX")] is task
+
+    await task
+    await asyncio.sleep(0)
+    assert isinstance(await server.get_mail_index_searcher(USER), server.MailIndexSearcher)
+    assert mailbox.fetched == [1, 2, 3]
+
+
+async def test_concurrent_syncs_of_a_folder_run_one_at_a_time_and_leave_no_lock(db, small_chunks):
+    mailbox = FakeMailbox({uid: "a@b.hr" for uid in range(1, 6)})
+    other = FakeMailbox({uid: "c@d.hr" for uid in range(1, 3)})
+    other_user = {**USER, "id": "u2"}
+
+    await asyncio.gather(
+        server.sync_mail_index(mailbox, USER),
+        server.sync_mail_index(mailbox, USER),
+        server.sync_mail_index(other, other_user),
+    )
+
+    assert mailbox.fetched == [1, 2, 3, 4, 5]
+    assert other.fetched == [1, 2]
+    gc.collect()
+    assert len(server._mail_index_locks) == 0
@@ -0,0 +1,69 @@
+import re
+
+import server
+
+
+class FakeImapConnection:
+    """Answers UID SEARCH over an in-memory folder of uid -> (subject, from)"""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.searches = []
+
+    def uid(self, command, query):
+        assert command == 'SEARCH'
+        terms = [t.lower() for t in re.findall(r'SUBJECT "([^"]*)"', query)]
+        self.searches.append(terms)
+        uids = [
+            uid for uid, (subject, sender) in sorted(self.messages.items())
+            if any(t in subject.lower() or t in sender.lower() for t in terms)
+        ]
+        return 'OK', [' '.join(map(str, uids)).encode()]
+
+
+def mail_client(messages):
+    client = server.ZohoMailClient("me@example.com", "secret")
+    client.connection = FakeImapConnection(messages)
+    client.selected_folder = "INBOX"
+    client.fetch_index_records = lambda uids, folder: [
+        {
+            "uid": uid,
+            "subject": messages[uid][0],
+            "from": messages[uid][1],
+            "from_search": messages[uid][1].casefold(),
+            "date": "",
+            "attachments": [],
+            "has_pdf": False
+        }
+        for uid in uids
+    ]
+    return client
+
+
+def found(results):
+    return [[int(r["email_id"]) for r in term_results] for term_results in results]
+
+
+def test_terms_share_one_search_while_candidates_fit():
+    client = mail_client({
+        1: ("Račun", "HEP <noreply@hep.hr>"),
+        2: ("Vaš A1 račun", "racuni@a1.hr"),
+        3: ("Newsletter", "news@example.com")
+    })
+
+    results = client.search_emails_multi(["HEP", "A1"])
+
+    assert found(results) == [[1], [2]]
+    assert client.connection.searches == [["hep", "a1"]]
+
+
+def test_busy_term_does_not_crowd_out_older_matches():
+    messages = {uid: ("Račun za struju", "HEP <noreply@hep.hr>") for uid in range(10, 160)}
+    messages.update({1: ("Vaš A1 račun", "racuni@a1.hr"), 2: ("A1 obavijest", "racuni@a1.hr")})
+    client = mail_client(messages)
+
+    hep, a1 = found(client.search_emails_multi(["HEP", "A1"]))
+
+    assert a1 == [1, 2]
+    assert hep == list(range(140, 160))
+    assert client.connection.searches == [["hep", "a1"], ["hep"], ["a1"]]
@@ -0,0 +1,102 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeMailClient:
+    """Stand-in for ZohoMailClient whose searches block until released"""
+    release_searches = threading.Event()
+
+    def __init__(self, email_address, app_password):
+        self.email_address = email_address
+        self.app_password = app_password
+        self.connection = None
+
+    def connect(self):
+        self.connection = object()
+
+    def disconnect(self):
+        self.connection = None
+
+    def is_alive(self):
+        return True
+
+    def search_emails_multi(self, terms, *args):
+        if self.email_address == "slow@example.com":
+            self.release_searches.wait(5)
+        return [[] for _ in terms]
+
+
+@pytest.fixture
+def mail_layer(monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=2)
+    FakeMailClient.release_searches.clear()
+    monkeypatch.setattr(server, "ZohoMailClient", FakeMailClient)
+    monkeypatch.setattr(server, "MAIL_CACHE_ENABLED", False)
+    monkeypatch.setattr(server, "mail_executor", executor)
+    monkeypatch.setattr(server, "mail_pool", server.ImapSessionPool(max_per_user=1))
+    monkeypatch.setattr(server, "mail_session_slots", server.MailSessionSlots(per_user=1, timeout=5))
+    yield
+    FakeMailClient.release_searches.set()
+    executor.shutdown(wait=True)
+
+
+def mail_user(user_id, email):
+    return {"id": user_id, "zoho_email": email, "zoho_app_password": "secret"}
+
+
+async def search(user):
+    async with server.AsyncMailSession(user) as session:
+        return await session.search_emails_multi(["HEP"])
+
+
+async def test_waiting_for_a_session_does_not_hold_executor_threads(mail_layer):
+    busy = mail_user("busy", "slow@example.com")
+    # One search holds the user's only session, three more wait for it
+    waiting = [asyncio.create_task(search(busy)) for _ in range(4)]
+    await asyncio.sleep(0.1)
+
+    # Another user's search still gets an executor thread straight away
+    assert await asyncio.wait_for(search(mail_user("other", "fast@example.com")), 1) == [[]]
+
+    FakeMailClient.release_searches.set()
+    assert await asyncio.gather(*waiting) == [[[]]] * 4
+    assert server.mail_pool.get_stats()["active_sessions"] == 0
+    assert server.mail_session_slots._holders == {}
+
+
+async def test_session_slot_wait_times_out_with_503(mail_layer, monkeypatch):
+    monkeypatch.setattr(server.mail_session_slots, "timeout", 0.1)
+    busy = mail_user("busy", "slow@example.com")
+    holder = asyncio.create_task(search(busy))
+    await asyncio.sleep(0.05)
+
+    with pytest.raises(server.HTTPException) as error:
+        await search(busy)
+    assert error.value.status_code == 503
+
+    FakeMailClient.release_searches.set()
+    await holder
+    assert server.mail_session_slots._holders == {}
+
+
+async def test_reaper_logs_out_sessions_left_idle(mail_layer, monkeypatch):
+    monkeypatch.setattr(server, "IMAP_POOL_IDLE_TIMEOUT", 0.1)
+    server.mail_pool.idle_timeout = 0.1
+    user = mail_user("u1", "fast@example.com")
+    session = server.mail_pool.acquire(user)
+    server.mail_pool.release("u1", session)
+    assert session.connection is not None
+
+    reaper = asyncio.create_task(server.mail_pool_reaper())
+    await asyncio.sleep(1.2)
+    reaper.cancel()
+
+    assert session.connection is None
+    assert server.mail_pool.get_stats()["idle_sessions"] == 0
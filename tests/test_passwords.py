@@ -0,0 +1,15 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_hashing_runs_in_fresh_worker_processes():
+    hasher = server.PasswordHasher(workers=1)
+    try:
+        hashed = await hasher.hash("tajna-lozinka")
+        assert await hasher.verify_and_update("tajna-lozinka", hashed) == (True, None)
+        assert (await hasher.verify_and_update("kriva", hashed))[0] is False
+    finally:
+        hasher.shutdown()
@@ -0,0 +1,135 @@
+import asyncio
+import imaplib
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def insert_job(db, item_overrides=None, total=1):
+    await db.search_jobs.insert_one({
+        "id": "j1", "user_id": "u1", "status": "running", "total": total,
+        "processed": 0, "found_count": 0, "failed_count": 0,
+        "created_at": "2025-12-01T00:00:00+00:00", "updated_at": "2025-12-01T00:00:00+00:00", "finished_at": None,
+    })
+    await db.search_job_items.insert_one({
+        "id": "i1", "job_id": "j1", "user_id": "u1", "transaction_id": "t1", "seq": 0,
+        "status": "pending", "attempts": 0, "lease_owner": None, "lease_expires_at": None, "result": None,
+        **(item_overrides or {}),
+    })
+
+
+def expired():
+    return datetime.now(timezone.utc) - timedelta(seconds=1)
+
+
+async def test_expired_lease_is_reclaimed_with_another_attempt(db):
+    await insert_job(db, {"status": "running", "attempts": 1, "lease_owner": "dead", "lease_expires_at": expired()})
+
+    item = await server.claim_search_job_item("w1")
+
+    assert item["lease_owner"] == "w1"
+    assert item["attempts"] == 2
+
+
+async def test_item_that_exhausted_its_attempts_fails_instead_of_looping(db):
+    await insert_job(db, {
+        "status": "running", "attempts": server.SEARCH_JOB_MAX_ATTEMPTS,
+        "lease_owner": "dead", "lease_expires_at": expired(),
+    })
+
+    assert await server.claim_search_job_item("w1") is None
+    assert await server.fail_exhausted_search_job_items() == 1
+
+    item = await db.search_job_items.find_one({"id": "i1"})
+    assert item["status"] == "failed"
+    assert item["result"]["error"]
+    job = await db.search_jobs.find_one({"id": "j1"})
+    assert (job["status"], job["processed"], job["failed_count"]) == ("completed", 1, 1)
+    assert await server.fail_exhausted_search_job_items() == 0
+
+
+class FakeSearcher:
+    def __init__(self, failures=0):
+        self.failures = failures
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def search_emails_multi(self, terms, date_from=None, date_to=None):
+        if self.failures:
+            self.failures -= 1
+            raise imaplib.IMAP4.abort("socket error: EOF")
+        invoice = {
+            "email_id": "7", "subject": "HEP račun", "from": "HEP <racuni@hep.hr>", "date": "",
+            "attachments": [{"filename": "racun.pdf", "is_pdf": True}], "has_pdf": True,
+        }
+        return [[invoice]] + [[] for _ in terms[1:]]
+
+
+async def test_lease_is_renewed_while_a_long_search_runs(db, monkeypatch):
+    monkeypatch.setattr(server, "SEARCH_JOB_LEASE_SECONDS", 0.3)
+    await insert_job(db)
+    await db.users.insert_one({"id": "u1", "zoho_email": "a@example.com", "zoho_app_password": "x"})
+    await db.transactions.insert_one({"id": "t1", "user_id": "u1", "batch_id": "b1", "status": "pending"})
+
+    async def get_searcher(user):
+        return FakeSearcher()
+
+    async def slow_search(mail_client, trans, user, **kwargs):
+        await asyncio.sleep(0.8)
+        return {"transaction_id": trans["id"], "found": True, "emails": []}
+
+    monkeypatch.setattr(server, "get_mail_index_searcher", get_searcher)
+    monkeypatch.setattr(server, "search_transaction_invoices", slow_search)
+
+    item = await server.claim_search_job_item("w1")
+    processing = asyncio.create_task(server.process_search_job_item(item, "w1"))
+    await asyncio.sleep(0.5)
+    # Past the original lease, but the heartbeat kept it
+    assert await server.claim_search_job_item("w2") is None
+    await processing
+
+    item = await db.search_job_items.find_one({"id": "i1"})
+    assert (item["status"], item["attempts"]) == ("done", 1)
+    job = await db.search_jobs.find_one({"id": "j1"})
+    assert (job["status"], job["found_count"]) == ("completed", 1)
+
+
+async def test_failed_search_is_retried_after_a_backoff(db, monkeypatch):
+    await insert_job(db)
+    await db.users.insert_one({"id": "u1", "zoho_email": "a@example.com", "zoho_app_password": "x"})
+    await db.transactions.insert_one({
+        "id": "t1", "user_id": "u1", "batch_id": "b1", "status": "pending", "primatelj": "HEP", "amount_cents": -100,
+    })
+    searcher = FakeSearcher(failures=1)
+
+    async def get_searcher(user):
+        return searcher
+
+    monkeypatch.setattr(server, "get_mail_index_searcher", get_searcher)
+
+    await server.process_search_job_item(await server.claim_search_job_item("w1"), "w1")
+
+    item = await db.search_job_items.find_one({"id": "i1"})
+    assert (item["status"], item["attempts"]) == ("pending", 1)
+    assert "EOF" in item["last_error"]
+    assert await server.claim_search_job_item("w1") is None  # still backing off
+    job = await db.search_jobs.find_one({"id": "j1"})
+    assert job["processed"] == 0
+
+    await db.search_job_items.update_one({"id": "i1"}, {"$set": {"not_before": expired()}})
+    await server.process_search_job_item(await server.claim_search_job_item("w1"), "w1")
+
+    item = await db.search_job_items.find_one({"id": "i1"})
+    assert (item["status"], item["attempts"]) == ("done", 2)
+    assert item["result"]["found"] is True
+    job = await db.search_jobs.find_one({"id": "j1"})
+    assert (job["status"], job["found_count"], job["failed_count"]) == ("completed", 1, 0)
+    assert (await db.transactions.find_one({"id": "t1"}))["status"] == "found"
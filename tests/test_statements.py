@@ -0,0 +1,114 @@
+import io
+from datetime import datetime
+
+import pytest
+
+import server
+
+
+def test_bank_export_header_resolves_to_its_layout():
+    for header in (
+        ['Datum izvršenja', 'Primatelj', 'Opis transakcije', 'Ukupan iznos', 'Valuta'],
+        ['Datum izvrsenja', 'Primatelj', 'Opis transa', 'Ukupan izn'],
+    ):
+        layout, mapping = server.resolve_statement_layout(header)
+
+        assert layout.name == "hr_bank_export"
+        assert mapping.extract(['01.12.2025', 'HEP', 'Struja', '-12,50', 'EUR']) == (
+            '01.12.2025', 'HEP', 'Struja', '-12,50'
+        )
+
+
+def test_generic_layout_reads_legacy_headers():
+    header = ['Datum izvrsenja', 'Naziv primatelja', 'Opis', 'Ukupan iznos', 'Iznos']
+
+    layout, mapping = server.resolve_statement_layout(header)
+
+    assert layout is server.DEFAULT_STATEMENT_LAYOUT
+    assert mapping.extract(['01.12.2025', 'HEP', 'Struja', '', '-12,50']) == (
+        '01.12.2025', 'HEP', 'Struja', '-12,50'
+    )
+
+
+def test_registered_layout_is_tried_before_the_generic_one(monkeypatch):
+    monkeypatch.setattr(server, "STATEMENT_LAYOUTS", list(server.STATEMENT_LAYOUTS))
+    bank = server.register_statement_layout(server.StatementLayout(
+        "bank",
+        {"datum": ('Value date',), "primatelj": ('Counterparty',), "opis": ('Details',), "iznos": ('Amount',)},
+        required=("datum", "iznos")
+    ))
+
+    layout, mapping = server.resolve_statement_layout(['Value date', 'Counterparty', 'Details', 'Amount'])
+    assert layout is bank
+    assert mapping.extract(['2025-12-01', 'A1', 'Mobitel']) == ('2025-12-01', 'A1', 'Mobitel', '')
+
+    layout, _ = server.resolve_statement_layout(['Datum', 'Primatelj', 'Opis', 'Iznos'])
+    assert layout is server.DEFAULT_STATEMENT_LAYOUT
+
+
+def test_statement_parsers_must_implement_detect_and_rows():
+    class Incomplete(server.StatementParser):
+        def detect(self, filename, prefix):
+            return False
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+CAMT053 = b"""<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.08">
+  <BkToCstmrStmt>
+    <Stmt>
+      <Ntry>
+        <Amt Ccy="EUR">1234.56</Amt>
+        <CdtDbtInd>DBIT</CdtDbtInd>
+        <BookgDt><Dt>2025-12-01</Dt></BookgDt>
+        <NtryDtls><TxDtls>
+          <RltdPties><Cdtr><Pty><Nm>HEP-ELEKTRA d.o.o.</Nm></Pty></Cdtr><Dbtr><Nm>Ana</Nm></Dbtr></RltdPties>
+          <RmtInf><Ustrd>Racun 11/2025</Ustrd><Ustrd>struja</Ustrd></RmtInf>
+        </TxDtls></NtryDtls>
+      </Ntry>
+      <Ntry>
+        <Amt Ccy="EUR">50.00</Amt>
+        <CdtDbtInd>CRDT</CdtDbtInd>
+        <BookgDt><DtTm>2025-12-03T10:15:00</DtTm></BookgDt>
+        <NtryDtls><TxDtls>
+          <RltdPties><Dbtr><Nm>Marko</Nm></Dbtr></RltdPties>
+          <AddtlTxInf>Povrat</AddtlTxInf>
+        </TxDtls></NtryDtls>
+      </Ntry>
+    </Stmt>
+  </BkToCstmrStmt>
+</Document>
+"""
+
+
+def test_camt053_entries_become_statement_rows():
+    parser = server.detect_statement_parser("izvod.xml", CAMT053[:4096])
+
+    assert parser.name == "camt053"
+    assert list(parser.rows(io.BytesIO(CAMT053), None)) == [
+        ("01.12.2025", "HEP-ELEKTRA d.o.o.", "Racun 11/2025 struja", "-1234,56 EUR"),
+        ("03.12.2025", "Marko", "Povrat", "50,00 EUR"),
+    ]
+
+
+def test_xlsx_rows_are_read_from_the_first_non_empty_row_on():
+    openpyxl = pytest.importorskip("openpyxl")
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append([None, None])
+    sheet.append(["Datum izvršenja", "Primatelj", "Opis transakcije", "Ukupan iznos"])
+    sheet.append([datetime(2025, 12, 1), "HEP", "Struja", -12.5])
+    sheet.append(["02.12.2025", "A1", None, "-30,00"])
+    raw = io.BytesIO()
+    workbook.save(raw)
+    content = raw.getvalue()
+
+    parser = server.detect_statement_parser("izvod.xlsx", content[:4096])
+
+    assert parser.name == "xlsx"
+    assert list(parser.rows(io.BytesIO(content), None)) == [
+        ("01.12.2025", "HEP", "Struja", "-12,50"),
+        ("02.12.2025", "A1", "", "-30,00"),
+    ]
@@ -0,0 +1,108 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def insert_transactions(db, user_id, batch_id, count):
+    await db.transactions.insert_many([
+        {
+            "id": f"{batch_id}-{i}",
+            "user_id": user_id,
+            "batch_id": batch_id,
+            "status": "pending",
+            "amount_cents": -100,
+            "datum_izvrsenja": "01.12.2025",
+            "primatelj": f"Vendor {i}",
+            "opis_transakcije": "Racun",
+            "iznos": "-1,00",
+            "created_at": "2025-12-01T00:00:00+00:00",
+        }
+        for i in range(count)
+    ])
+    await server.reconcile_counters(user_id)
+
+
+async def test_estimated_count_reads_own_batch_counter(db, client):
+    await insert_transactions(db, "u1", "b1", 3)
+
+    response = client.get("/api/transactions", params={"batch_id": "b1", "count": "estimate"})
+
+    assert response.headers["X-Total-Count"] == "3"
+
+
+async def test_estimated_count_ignores_another_users_batch_counter(db, client):
+    await insert_transactions(db, "u2", "foreign", 5)
+
+    response = client.get("/api/transactions", params={"batch_id": "foreign", "count": "estimate"})
+
+    assert response.json() == []
+    assert response.headers["X-Total-Count"] == "0"
+
+
+async def test_keyset_pages_cover_every_transaction_once_in_order(db, client):
+    days = [datetime(2025, 12, d, tzinfo=timezone.utc) for d in (3, 1, 2, 2, 1, 3, 2)] + [None]
+    await db.transactions.insert_many([
+        {
+            "id": f"t{i}",
+            "user_id": "u1",
+            "batch_id": "b1",
+            "status": "pending",
+            "transaction_date": day,
+            "datum_izvrsenja": "",
+            "primatelj": "Vendor",
+            "opis_transakcije": "Racun",
+            "iznos": "-1,00",
+            "created_at": "2025-12-01T00:00:00+00:00",
+        }
+        for i, day in enumerate(days)
+    ])
+
+    pages, cursor = [], None
+    while True:
+        params = {"limit": 3, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/api/transactions", params=params)
+        pages.append([t["id"] for t in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert pages == [["t5", "t0", "t6"], ["t3", "t2", "t4"], ["t1", "t7"]]
+
+
+def test_malformed_cursor_is_rejected(client):
+    response = client.get("/api/transactions", params={"cursor": "not-a-cursor"})
+
+    assert response.status_code == 400
+
+
+async def test_paging_headers_are_readable_from_the_frontend_origin(db, client):
+    await insert_transactions(db, "u1", "b1", 3)
+
+    response = client.get(
+        "/api/transactions",
+        params={"limit": 2, "count": "exact"},
+        headers={"Origin": "http://localhost:3000"}
+    )
+
+    exposed = {h.strip().lower() for h in response.headers["Access-Control-Expose-Headers"].split(",")}
+    assert {"x-next-cursor", "x-total-count"} <= exposed
+    assert response.headers["X-Next-Cursor"]
+
+
+async def test_unknown_status_is_rejected_on_single_and_bulk_updates(db, client):
+    await insert_transactions(db, "u1", "b1", 2)
+
+    single = client.put("/api/transactions/b1-0", json={"status": "bogus"})
+    bulk = client.patch("/api/transactions", json={"updates": [
+        {"id": "b1-0", "status": "found"},
+        {"id": "b1-1", "status": "$bogus"},
+    ]})
+
+    assert single.status_code == 422
+    assert bulk.status_code == 422
+    assert await db.transactions.count_documents({"status": "pending"}) == 2
+    assert await server.reconcile_counters("u1") == 0
@@ -0,0 +1,48 @@
+import base64
+import binascii
+import random
+
+import pytest
+
+import server
+
+
+PAYLOAD = b"%PDF-1.4\r\n" + bytes(range(256)) * 3 + "Račun br. 12 = 99,00 €".encode()
+
+
+def decode_in_chunks(decoder, encoded, sizes):
+    out, i = [], 0
+    for size in sizes:
+        out.append(decoder.decode(encoded[i:i + size]))
+        i += size
+    out.append(decoder.decode(encoded[i:]))
+    out.append(decoder.flush())
+    return b"".join(out)
+
+
+def base64_lines(data):
+    encoded = base64.b64encode(data)
+    return b"\r\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76)) + b"\r\n"
+
+
+@pytest.mark.parametrize("encoding, encoded", [
+    ("base64", base64_lines(PAYLOAD)),
+    ("quoted-printable", binascii.b2a_qp(PAYLOAD, istext=False)),
+    ("quoted-printable", binascii.b2a_qp(PAYLOAD, istext=False).replace(b"\n", b"\r\n")),
+    ("7bit", PAYLOAD),
+])
+def test_transfer_decoder_is_independent_of_chunk_boundaries(encoding, encoded):
+    for split in range(1, len(encoded)):
+        assert decode_in_chunks(server.TransferDecoder(encoding), encoded, [split]) == PAYLOAD
+
+    rng = random.Random(7)
+    for _ in range(50):
+        sizes = [rng.randint(1, 9) for _ in range(len(encoded) // 3)]
+        assert decode_in_chunks(server.TransferDecoder(encoding), encoded, sizes) == PAYLOAD
+
+
+def test_base64_without_final_padding_is_flushed():
+    encoded = base64.b64encode(b"racun.pdf!").rstrip(b"=")
+    decoder = server.TransferDecoder("BASE64")
+
+    assert decoder.decode(encoded) + decoder.flush() == b"racun.pdf!"
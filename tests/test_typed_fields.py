@@ -0,0 +1,74 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("1.234,56", (123456, "EUR")),
+    ("1,234.56", (123456, "EUR")),
+    ("1.234.567", (123456700, "EUR")),
+    ("-1.234,56", (-123456, "EUR")),
+    ("12,50-", (-1250, "EUR")),
+    ("(12,50)", (-1250, "EUR")),
+    ("EUR 1.234,56", (123456, "EUR")),
+    ("1 234,56 kn", (123456, "HRK")),
+    ("€12.5", (1250, "EUR")),
+    ("", (None, None)),
+    ("   ", (None, None)),
+    (None, (None, None)),
+    ("-", (None, None)),
+    ("n/a", (None, None)),
+])
+def test_parse_statement_amount(value, expected):
+    assert server.parse_statement_amount(value) == expected
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("01.12.2025", datetime(2025, 12, 1, tzinfo=timezone.utc)),
+    ("01.12.2025.", datetime(2025, 12, 1, tzinfo=timezone.utc)),
+    ("01.12.2025 10:15", datetime(2025, 12, 1, tzinfo=timezone.utc)),
+    ("2025-12-01", datetime(2025, 12, 1, tzinfo=timezone.utc)),
+    ("31/12/2025", datetime(2025, 12, 31, tzinfo=timezone.utc)),
+    ("31.02.2025", None),
+    ("", None),
+    (None, None),
+])
+def test_parse_statement_date(value, expected):
+    assert server.parse_statement_date(value) == expected
+
+
+@pytest.mark.anyio
+async def test_backfill_adds_typed_fields_to_legacy_transactions(db, monkeypatch):
+    monkeypatch.setattr(server, "MIGRATION_BATCH_SIZE", 2)
+    legacy = [
+        ("t1", "01.12.2025", "-1.234,56"),
+        ("t2", "2025-11-30", "(12,50)"),
+        ("t3", "15.11.2025.", "EUR 99,00"),
+        ("t4", "", ""),
+        ("t5", "nepoznato", "n/a"),
+    ]
+    await db.transactions.insert_many([
+        {"id": tid, "user_id": "u1", "datum_izvrsenja": datum, "iznos": iznos}
+        for tid, datum, iznos in legacy
+    ])
+    await db.transactions.insert_one({
+        "id": "typed", "user_id": "u1", "datum_izvrsenja": "01.12.2025", "iznos": "-1,00",
+        "transaction_date": None, "amount_cents": 7, "currency": "USD"
+    })
+
+    assert await server.backfill_typed_transaction_fields() == 5
+    assert await server.backfill_typed_transaction_fields() == 0
+
+    stored = {t["id"]: t async for t in db.transactions.find({}, {"_id": 0})}
+    # mongomock, like MongoDB, hands datetimes back without tzinfo
+    assert {tid: (t["transaction_date"], t["amount_cents"], t["currency"]) for tid, t in stored.items()} == {
+        "t1": (datetime(2025, 12, 1), -123456, "EUR"),
+        "t2": (datetime(2025, 11, 30), -1250, "EUR"),
+        "t3": (datetime(2025, 11, 15), 9900, "EUR"),
+        "t4": (None, None, None),
+        "t5": (None, None, None),
+        "typed": (None, 7, "USD"),
+    }
+    assert stored["t1"]["iznos"] == "-1.234,56"
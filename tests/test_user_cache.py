@@ -0,0 +1,130 @@
+import asyncio
+from datetime import datetime, timezone
+
+import mongomock_motor
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def user_cache(db, monkeypatch):
+    cache = server.UserCache()
+    monkeypatch.setattr(server, "user_cache", cache)
+    monkeypatch.setattr(server, "USER_CACHE_SYNC_INTERVAL", 0.01)
+    await db.users.insert_many([
+        {"id": "u1", "email": "ana@example.com", "name": "Ana"},
+        {"id": "u2", "email": "ivo@example.com", "name": "Ivo"},
+    ])
+    return cache
+
+
+async def write_from_another_worker(db, user_id, name):
+    """A profile write this worker's update_user_profile never saw"""
+    await db.users.update_one(
+        {"id": user_id},
+        {"$set": {"name": name, "profile_updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+
+async def eventually(predicate):
+    for _ in range(200):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    assert predicate()
+
+
+class FakeChangeStream:
+    """Async context manager and iterator over queued change events;
+    queued exceptions are raised from the stream"""
+
+    def __init__(self, changes: asyncio.Queue):
+        self.changes = changes
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        change = await self.changes.get()
+        if isinstance(change, Exception):
+            raise change
+        return change
+
+
+async def test_update_user_profile_drops_the_cached_user(db, user_cache):
+    assert (await user_cache.load("u1"))["name"] == "Ana"
+    await db.users.update_one({"id": "u1"}, {"$set": {"name": "Stale"}})
+    assert (await user_cache.load("u1"))["name"] == "Ana"
+
+    await server.update_user_profile("u1", {"name": "Ana Horvat"})
+
+    assert (await user_cache.load("u1"))["name"] == "Ana Horvat"
+    assert user_cache.stats()["invalidations"] == 1
+
+
+async def test_load_overlapping_an_invalidation_is_not_cached(db, user_cache, monkeypatch):
+    find_one = mongomock_motor.AsyncMongoMockCollection.find_one
+
+    async def find_then_profile_write(self, *args, **kwargs):
+        result = await find_one(self, *args, **kwargs)
+        if self.name == "users":
+            user_cache.invalidate("u1")
+        return result
+
+    monkeypatch.setattr(mongomock_motor.AsyncMongoMockCollection, "find_one", find_then_profile_write)
+    assert (await user_cache.load("u1"))["name"] == "Ana"
+
+    assert user_cache.memory.get("u1") is None
+
+
+async def test_sync_worker_polls_version_stamps_without_change_streams(db, user_cache):
+    await user_cache.load("u1")
+    await user_cache.load("u2")
+    worker = asyncio.create_task(user_cache.sync_worker())
+    try:
+        await eventually(lambda: user_cache.sync_mode == "poll")
+        await write_from_another_worker(db, "u1", "Ana Horvat")
+
+        await eventually(lambda: user_cache.memory.get("u1") is None)
+        assert (await user_cache.load("u1"))["name"] == "Ana Horvat"
+        assert user_cache.memory.get("u2") is not None
+    finally:
+        worker.cancel()
+
+
+async def test_sync_worker_applies_change_stream_events(db, user_cache, monkeypatch):
+    changes = asyncio.Queue()
+    monkeypatch.setattr(
+        mongomock_motor.AsyncMongoMockCollection, "watch",
+        lambda self, *args, **kwargs: FakeChangeStream(changes), raising=False
+    )
+    await user_cache.load("u1")
+    await user_cache.load("u2")
+    worker = asyncio.create_task(user_cache.sync_worker())
+    try:
+        await eventually(lambda: user_cache.sync_mode == "change_stream")
+
+        changes.put_nowait({"operationType": "update", "fullDocument": {"id": "u1", "name": "Ana Horvat"}})
+        await eventually(lambda: user_cache.memory.get("u1") is None)
+        assert user_cache.memory.get("u2") is not None
+
+        # A delete only names the _id, and an interrupted stream may have missed events
+        for event in ({"operationType": "delete"}, ConnectionError("stream closed")):
+            await user_cache.load("u1")
+            changes.put_nowait(event)
+            await eventually(lambda: user_cache.memory.get("u1") is None and user_cache.memory.get("u2") is None)
+            await user_cache.load("u2")
+
+        assert user_cache.sync_mode == "change_stream"
+        assert user_cache.stats()["invalidations"] == 3
+    finally:
+        worker.cancel()
@@ -0,0 +1,94 @@
+import random
+
+import pytest
+
+import server
+
+
+def reference_match(transaction_recipient, transaction_desc, vendors):
+    """The per-vendor loop VendorMatcher replaced: first listed vendor whose
+    normalised name or lowercased keyword occurs in the text wins"""
+    search_text = f"{transaction_recipient} {transaction_desc}".lower()
+    for vendor in vendors:
+        if server.normalize_vendor_name(vendor['name']) in server.normalize_vendor_name(search_text):
+            return vendor
+        for keyword in vendor.get('keywords', []):
+            if keyword.lower() in search_text:
+                return vendor
+    return None
+
+
+VENDORS = [
+    {"id": "ht-mobile", "name": "HT Mobile", "keywords": ["hrvatski telekom mobilni"]},
+    {"id": "ht", "name": "HT", "keywords": ["T-Com"]},
+    {"id": "hep", "name": "HEP d.d.", "keywords": ["Elektra", "struja"]},
+    {"id": "a1", "name": "A1 Hrvatska", "keywords": ["VIP"]},
+    {"id": "zet", "name": "ZET", "keywords": []},
+]
+
+
+@pytest.mark.parametrize("recipient, description, expected", [
+    ("HT MOBILE D.D.", "Račun 11/2025", "ht-mobile"),
+    ("HT d.d.", "Fiksna linija", "ht"),
+    ("Hrvatski Telekom", "ht mobile paket", "ht-mobile"),
+    ("t-com", "", "ht"),
+    ("HEP-ELEKTRA", "", "hep"),
+    ("Opskrba", "STRUJA prosinac", "hep"),
+    ("A1 HRVATSKA", "", "a1"),
+    ("", "plaćeno preko vip-a", "a1"),
+    ("Zagrebački električni tramvaj", "mjesečna ZET karta", "zet"),
+    ("Konzum", "Namirnice", None),
+    ("", "", None),
+])
+def test_matcher_gives_the_same_vendor_as_the_old_loop(recipient, description, expected):
+    matched = server.VendorMatcher(VENDORS).match(recipient, description)
+
+    assert matched == reference_match(recipient, description, VENDORS)
+    assert (matched["id"] if matched else None) == expected
+
+
+def test_first_listed_vendor_wins_when_several_match():
+    vendors = [VENDORS[1], VENDORS[0]]  # HT listed before HT Mobile
+
+    matched = server.VendorMatcher(vendors).match("HT MOBILE", "")
+
+    assert matched["id"] == "ht"
+    assert matched == reference_match("HT MOBILE", "", vendors)
+
+
+def test_vendor_with_an_empty_keyword_matches_everything_after_earlier_vendors():
+    vendors = VENDORS[:2] + [{"id": "any", "name": "Ostalo", "keywords": [""]}] + VENDORS[2:]
+    matcher = server.VendorMatcher(vendors)
+
+    for recipient in ("HEP", "HT", "Konzum"):
+        assert matcher.match(recipient, "") == reference_match(recipient, "", vendors)
+
+
+def test_matcher_agrees_with_the_old_loop_on_random_text():
+    rng = random.Random(12)
+    alphabet = "ahtepmobilezvcdk .-"
+    vendors = [
+        {
+            "id": str(i),
+            "name": "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))),
+            "keywords": ["".join(rng.choice(alphabet) for _ in range(rng.randint(2, 5))) for _ in range(rng.randint(0, 2))],
+        }
+        for i in range(25)
+    ]
+    matcher = server.VendorMatcher(vendors)
+
+    for _ in range(500):
+        recipient = "".join(rng.choice(alphabet.upper() + alphabet) for _ in range(rng.randint(0, 12)))
+        description = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 12)))
+        assert matcher.match(recipient, description) == reference_match(recipient, description, vendors)
+
+
+def test_cached_matcher_is_rebuilt_when_vendors_change():
+    first = server.get_vendor_matcher("u-vendors", VENDORS)
+    assert server.get_vendor_matcher("u-vendors", list(VENDORS)) is first
+
+    changed = VENDORS[:2] + [{**VENDORS[2], "keywords": ["plin"]}] + VENDORS[3:]
+    rebuilt = server.get_vendor_matcher("u-vendors", changed)
+
+    assert rebuilt is not first
+    assert rebuilt.match("Gradska plinara", "plin")["id"] == "hep"
@@ -0,0 +1,31 @@
+import io
+import zipfile
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_zip_export_streams_every_stored_invoice(invoice_file, client, monkeypatch):
+    monkeypatch.setattr(server, "ZIP_CHUNK_SIZE", 4)
+    await invoice_file("t1", b"%PDF first")
+    await invoice_file("t2", b"%PDF second")
+    missing = await invoice_file("t3", b"%PDF gone")
+    missing.unlink()
+
+    response = client.get("/api/export/zip/b1")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as archive:
+        assert archive.testzip() is None
+        assert sorted(archive.namelist()) == ["01122025_HEP_d_d_.pdf", "01122025_HEP_d_d__2.pdf"]
+        assert sorted(archive.read(name) for name in archive.namelist()) == [b"%PDF first", b"%PDF second"]
+
+
+async def test_zip_export_of_a_batch_without_invoices_is_404(db, client):
+    response = client.get("/api/export/zip/b1")
+
+    assert response.status_code == 404